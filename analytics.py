@@ -0,0 +1,560 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy é opcional: sem ele os endpoints de analytics respondem 503
+    np = None
+
+logger = logging.getLogger(__name__)
+
+AVAILABLE = np is not None
+
+SNAPSHOT_VERSION = 1
+
+# Status das transações como inteiros (coluna int8 do snapshot)
+STATUS_CODES = {'pending': 0, 'completed': 1, 'error': 2, 'refunded': 3}
+PENDING, COMPLETED, ERROR, REFUNDED = 0, 1, 2, 3
+
+# Downloads efetivamente servidos (mesmos status de download_events.SERVED_STATUSES)
+SERVED_STATUSES = (200, 206)
+
+WEEKDAYS = ('seg', 'ter', 'qua', 'qui', 'sex', 'sáb', 'dom')
+
+_STATUS_CASE = ' '.join(f"WHEN '{status}' THEN {code}" for status, code in STATUS_CODES.items())
+
+# Colunas copiadas do banco: (nome, dtype); a primeira é sempre o rowid (marca d'água)
+TRANSACTION_COLUMNS = (
+    ('id', 'int64'), ('user_id', 'int64'), ('product_id', 'int64'), ('amount', 'int64'),
+    ('created', 'int64'), ('completed', 'int64'), ('status', 'int8'),
+)
+EVENT_COLUMNS = (
+    ('id', 'int64'), ('user_id', 'int64'), ('product_id', 'int64'), ('occurred', 'int64'), ('status', 'int16'),
+)
+
+TRANSACTIONS_QUERY = f'''
+    SELECT id, user_id, product_id, amount_stars,
+           CAST(strftime('%s', created_at) AS INTEGER),
+           COALESCE(CAST(strftime('%s', completed_at) AS INTEGER), 0),
+           CASE status {_STATUS_CASE} ELSE -1 END
+    FROM transactions
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+
+# Faixa de transações ainda abertas: o status e a conclusão podem ter mudado desde a cópia
+OPEN_TRANSACTIONS_QUERY = f'''
+    SELECT id, COALESCE(CAST(strftime('%s', completed_at) AS INTEGER), 0),
+           CASE status {_STATUS_CASE} ELSE -1 END
+    FROM transactions
+    WHERE id BETWEEN ? AND ?
+'''
+
+EVENTS_QUERY = '''
+    SELECT id, COALESCE(user_id, 0), COALESCE(product_id, 0),
+           CAST(strftime('%s', occurred_at) AS INTEGER), status
+    FROM download_events
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+
+
+class ColumnSnapshot:
+    """Colunas de uma tabela em arquivos .npy mapeados em memória, com capacidade que dobra ao crescer"""
+    
+    def __init__(self, directory: str, name: str, columns: Tuple[Tuple[str, str], ...]):
+        self.directory = directory
+        self.name = name
+        self.columns = columns
+        self.length = 0
+        self.generation = 0
+        self.arrays: Dict[str, Any] = {}
+    
+    def _path(self, column: str, generation: int) -> str:
+        return os.path.join(self.directory, f'{self.name}.{column}.{generation}.npy')
+    
+    @property
+    def capacity(self) -> int:
+        return len(self.arrays[self.columns[0][0]]) if self.arrays else 0
+    
+    @property
+    def watermark(self) -> int:
+        """Maior rowid copiado (0 = vazio)"""
+        return int(self.arrays['id'][self.length - 1]) if self.length else 0
+    
+    def open(self, length: int, generation: int) -> bool:
+        """Mapeia os arquivos gravados; False se algum faltar ou não tiver o formato esperado"""
+        if not length:
+            # Tabela vazia na última atualização: ainda não há arquivos
+            self.arrays, self.length, self.generation = {}, 0, generation
+            return True
+        arrays = {}
+        for column, dtype in self.columns:
+            path = self._path(column, generation)
+            if not os.path.exists(path):
+                return False
+            array = np.load(path, mmap_mode='r+')
+            if array.dtype != np.dtype(dtype) or array.ndim != 1 or len(array) < length:
+                return False
+            arrays[column] = array
+        self.arrays, self.length, self.generation = arrays, length, generation
+        return True
+    
+    def reset(self):
+        self.arrays, self.length = {}, 0
+    
+    def append(self, rows: List[tuple]):
+        """Copia linhas (tuplas na ordem de self.columns) para o fim das colunas"""
+        if not rows:
+            return
+        data = np.array(rows, dtype=np.int64)
+        needed = self.length + len(rows)
+        if needed > self.capacity:
+            self._grow(max(needed, self.capacity * 2, 4096))
+        for index, (column, _) in enumerate(self.columns):
+            self.arrays[column][self.length:needed] = data[:, index]
+        self.length = needed
+    
+    def _grow(self, capacity: int):
+        """Copia as colunas para arquivos novos e maiores (nova geração; leitores antigos seguem válidos)"""
+        generation = self.generation + 1
+        arrays = {}
+        for column, dtype in self.columns:
+            array = np.lib.format.open_memmap(self._path(column, generation), mode='w+',
+                                              dtype=dtype, shape=(capacity,))
+            if self.length:
+                array[:self.length] = self.arrays[column][:self.length]
+            arrays[column] = array
+        self.arrays, self.generation = arrays, generation
+    
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+    
+    def remove_stale(self):
+        """Apaga gerações anteriores (no Windows, as ainda mapeadas ficam para a próxima vez)"""
+        prefix = f'{self.name}.'
+        current = f'.{self.generation}.npy'
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith('.npy') and not filename.endswith(current):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+    
+    def view(self) -> Dict[str, Any]:
+        """Colunas até o comprimento atual (fatias do mapa, sem cópia)"""
+        if not self.arrays:
+            return {column: np.zeros(0, dtype=dtype) for column, dtype in self.columns}
+        return {column: array[:self.length] for column, array in self.arrays.items()}
+
+
+def _group_starts(sorted_keys) -> Any:
+    """Índices onde começa cada grupo de chaves iguais num vetor ordenado"""
+    if not len(sorted_keys):
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+
+
+def period_index(times, period: str = 'month'):
+    """Período (mês ou semana iniciada na segunda) de cada timestamp Unix, como inteiro"""
+    if period == 'month':
+        return times.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    if period == 'week':
+        # 01/01/1970 foi uma quinta: +3 dias alinha as semanas na segunda
+        return (times // 86400 + 3) // 7
+    raise ValueError(f"Período inválido: {period}")
+
+
+def period_label(index: int, period: str) -> str:
+    if period == 'month':
+        return str(np.datetime64(int(index), 'M'))
+    return str(np.datetime64(int(index) * 7 - 3, 'D'))
+
+
+def cohort_retention(user_ids, times, period: str = 'month', max_age: int = 12,
+                     now: float = None) -> List[Dict[str, Any]]:
+    """Retenção por coorte da primeira compra: fração dos compradores que voltam a comprar N períodos depois"""
+    if not len(user_ids):
+        return []
+    periods = period_index(times, period)
+    users, inverse = np.unique(user_ids, return_inverse=True)
+    
+    # Primeiro período de cada comprador: ordena por (comprador, período) e pega o início de cada grupo
+    order = np.lexsort((periods, inverse))
+    first = periods[order][_group_starts(inverse[order])]
+    
+    ages = periods - first[inverse]
+    keep = ages < max_age
+    pairs = np.unique(inverse[keep] * max_age + ages[keep])
+    pair_users, pair_ages = pairs // max_age, pairs % max_age
+    
+    cohorts = np.unique(first)
+    cohort_index = np.searchsorted(cohorts, first[pair_users])
+    matrix = np.bincount(cohort_index * max_age + pair_ages,
+                         minlength=len(cohorts) * max_age).reshape(len(cohorts), max_age)
+    
+    current = int(period_index(np.array([int(now or time.time())], dtype=np.int64), period)[0])
+    result = []
+    for cohort, row in zip(cohorts.tolist(), matrix):
+        observed = min(max_age, current - cohort + 1)
+        size = int(row[0])
+        result.append({
+            'cohort': period_label(cohort, period),
+            'size': size,
+            'active': row[:observed].tolist(),
+            'retention': [round(count / size, 4) for count in row[:observed].tolist()]
+        })
+    return result
+
+
+def hourly_heatmap(times, amounts, utc_offset_hours: float = 0) -> Dict[str, Any]:
+    """Receita e vendas por dia da semana x hora do dia (7 x 24), no fuso pedido"""
+    local = times + int(utc_offset_hours * 3600)
+    cells = ((local // 86400 + 3) % 7) * 24 + (local // 3600) % 24
+    revenue = np.bincount(cells, weights=amounts, minlength=168).reshape(7, 24)
+    sales = np.bincount(cells, minlength=168).reshape(7, 24)
+    return {
+        'utc_offset_hours': utc_offset_hours,
+        'weekdays': list(WEEKDAYS),
+        'revenue': revenue.astype(np.int64).tolist(),
+        'sales': sales.tolist()
+    }
+
+
+def repeat_buyers(user_ids, amounts) -> Dict[str, Any]:
+    """Taxa de recompra: compradores com 2+ compras, sua parcela da receita e a distribuição de compras"""
+    if not len(user_ids):
+        return {'buyers': 0, 'repeat_buyers': 0, 'repeat_rate': 0, 'repeat_revenue_share': 0,
+                'purchases_per_buyer': 0, 'distribution': {}}
+    _, inverse = np.unique(user_ids, return_inverse=True)
+    purchases = np.bincount(inverse)
+    revenue = np.bincount(inverse, weights=amounts)
+    repeat = purchases >= 2
+    distribution = np.bincount(np.minimum(purchases, 5), minlength=6)[1:]
+    total_revenue = revenue.sum()
+    return {
+        'buyers': len(purchases),
+        'repeat_buyers': int(repeat.sum()),
+        'repeat_rate': round(float(repeat.mean()), 4),
+        'repeat_revenue_share': round(float(revenue[repeat].sum() / total_revenue), 4) if total_revenue else 0,
+        'purchases_per_buyer': round(float(purchases.mean()), 4),
+        'distribution': {('5+' if count == 5 else str(count)): int(value)
+                         for count, value in enumerate(distribution.tolist(), start=1)}
+    }
+
+
+def price_elasticity(product_ids, prices, times, min_prices: int = 2) -> List[Dict[str, Any]]:
+    """Elasticidade-preço por produto: inclinação log-log das vendas diárias em cada preço praticado"""
+    if not len(product_ids):
+        return []
+    days = times // 86400
+    base = int(prices.max()) + 1
+    keys = product_ids * base + prices
+    order = np.argsort(keys, kind='stable')
+    sorted_keys, sorted_days = keys[order], days[order]
+    starts = _group_starts(sorted_keys)
+    
+    # Por (produto, preço): vendas e dias em que o preço esteve em vigor (primeira à última venda)
+    units = np.diff(np.r_[starts, len(sorted_keys)])
+    active_days = np.maximum.reduceat(sorted_days, starts) - np.minimum.reduceat(sorted_days, starts) + 1
+    group_products, group_prices = sorted_keys[starts] // base, sorted_keys[starts] % base
+    
+    # Mínimos quadrados ponderados pelos dias de cada preço: log(vendas/dia) ~ e * log(preço)
+    x = np.log(np.maximum(group_prices, 1))
+    y = np.log(units / active_days)
+    w = active_days.astype(np.float64)
+    products, inverse = np.unique(group_products, return_inverse=True)
+    sums = {name: np.bincount(inverse, weights=values)
+            for name, values in (('w', w), ('wx', w * x), ('wy', w * y), ('wxx', w * x * x), ('wxy', w * x * y))}
+    denominator = sums['w'] * sums['wxx'] - sums['wx'] ** 2
+    price_points = np.bincount(inverse)
+    sales = np.bincount(inverse, weights=units)
+    
+    # Os grupos já estão ordenados por produto: os preços de cada um são uma fatia contígua
+    bounds = np.r_[_group_starts(group_products), len(group_products)]
+    result = []
+    for index, product_id in enumerate(products.tolist()):
+        elasticity = None
+        if price_points[index] >= min_prices and denominator[index] > 1e-12:
+            elasticity = round(float((sums['w'][index] * sums['wxy'][index]
+                                      - sums['wx'][index] * sums['wy'][index]) / denominator[index]), 4)
+        group = slice(bounds[index], bounds[index + 1])
+        result.append({
+            'product_id': product_id,
+            'sales': int(sales[index]),
+            'elasticity': elasticity,
+            'prices': [
+                {'price': price, 'sales': count, 'days': span, 'sales_per_day': round(count / span, 4)}
+                for price, count, span in zip(group_prices[group].tolist(), units[group].tolist(),
+                                              active_days[group].tolist())
+            ]
+        })
+    return result
+
+
+def download_engagement(sale_users, sale_products, event_users, event_products,
+                        event_statuses) -> Dict[str, Any]:
+    """Vendas cujo comprador baixou o produto ao menos uma vez, e downloads servidos por venda"""
+    served = np.isin(event_statuses, SERVED_STATUSES)
+    base = int(max(sale_products.max(initial=0), event_products.max(initial=0))) + 1
+    downloaded_pairs = np.unique(event_users[served] * base + event_products[served])
+    downloaded = np.isin(sale_users * base + sale_products, downloaded_pairs)
+    sales = len(sale_users)
+    return {
+        'sales': sales,
+        'downloaded_sales': int(downloaded.sum()),
+        'download_rate': round(float(downloaded.mean()), 4) if sales else 0,
+        'downloads': int(served.sum()),
+        'downloads_per_sale': round(float(served.sum() / sales), 4) if sales else 0
+    }
+
+
+class AnalyticsEngine:
+    """Cópia colunar de transactions/download_events em .npy mapeados, atualizada por marca d'água de rowid"""
+    
+    def __init__(self, db_manager, directory: str = None, refresh_interval: float = None,
+                 open_hours: float = None, chunk_size: int = None):
+        if not AVAILABLE:
+            raise RuntimeError("Analytics requer NumPy (pip install numpy)")
+        self.db = db_manager
+        self.directory = directory or os.getenv('ANALYTICS_DIR', 'analytics')
+        self.refresh_interval = (refresh_interval if refresh_interval is not None
+                                 else float(os.getenv('ANALYTICS_REFRESH_SECONDS', 60)))
+        
+        # Transações pendentes mais antigas que isso não são mais revisitadas (só num --rebuild)
+        self.open_hours = open_hours or float(os.getenv('ANALYTICS_OPEN_HOURS', 72))
+        self.chunk_size = chunk_size or int(os.getenv('ANALYTICS_CHUNK_SIZE', 50000))
+        
+        self.transactions = ColumnSnapshot(self.directory, 'transactions', TRANSACTION_COLUMNS)
+        self.events = ColumnSnapshot(self.directory, 'events', EVENT_COLUMNS)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._refreshed_at = 0.0
+        
+        # Contadores expostos em get_stats()
+        self._refreshes = 0
+        self._last_refresh: Optional[Dict[str, Any]] = None
+    
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, 'meta.json')
+    
+    def _load(self):
+        """Abre o snapshot gravado; recomeça do zero se não existir ou for de outro banco"""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if meta.get('version') != SNAPSHOT_VERSION or meta.get('db_path') != os.path.abspath(self.db.db_path):
+                raise ValueError("snapshot de outra versão ou banco")
+            if not all(snapshot.open(meta[snapshot.name]['length'], meta[snapshot.name]['generation'])
+                       for snapshot in (self.transactions, self.events)):
+                raise ValueError("arquivos do snapshot incompletos")
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self._meta_path):
+                logger.warning(f"Snapshot de analytics descartado: {e}")
+            self.transactions.reset()
+            self.events.reset()
+        self._loaded = True
+    
+    def _save_meta(self):
+        for snapshot in (self.transactions, self.events):
+            snapshot.flush()
+        meta = {
+            'version': SNAPSHOT_VERSION,
+            'db_path': os.path.abspath(self.db.db_path),
+            'updated_at': time.time(),
+            **{snapshot.name: {'length': snapshot.length, 'generation': snapshot.generation,
+                               'watermark': snapshot.watermark}
+               for snapshot in (self.transactions, self.events)}
+        }
+        
+        # Os dados vão antes do meta: numa queda, linhas além do comprimento gravado são ignoradas
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+        for snapshot in (self.transactions, self.events):
+            snapshot.remove_stale()
+    
+    def _append_new(self, conn, snapshot: ColumnSnapshot, query: str) -> int:
+        """Copia em blocos as linhas com rowid acima da marca d'água"""
+        appended = 0
+        while True:
+            rows = conn.execute(query, (snapshot.watermark, self.chunk_size)).fetchall()
+            snapshot.append([tuple(row) for row in rows])
+            appended += len(rows)
+            if len(rows) < self.chunk_size:
+                return appended
+    
+    def _sync_open(self, conn, copied: int) -> int:
+        """Atualiza status/conclusão das transações que estavam abertas (pendentes ou com erro)"""
+        view = self.transactions.view()
+        old = len(view['id']) - copied
+        cutoff = time.time() - self.open_hours * 3600
+        open_rows = np.flatnonzero(((view['status'][:old] == PENDING) | (view['status'][:old] == ERROR))
+                                   & (view['created'][:old] >= cutoff))
+        if not len(open_rows):
+            return 0
+        
+        rows = conn.execute(OPEN_TRANSACTIONS_QUERY,
+                            (int(view['id'][open_rows[0]]), int(view['id'][old - 1]))).fetchall()
+        if not rows:
+            return 0
+        data = np.array([tuple(row) for row in rows], dtype=np.int64)
+        positions = np.searchsorted(view['id'], data[:, 0])
+        changed = view['status'][positions] != data[:, 2]
+        self.transactions.arrays['completed'][positions[changed]] = data[changed, 1]
+        self.transactions.arrays['status'][positions[changed]] = data[changed, 2]
+        return int(changed.sum())
+    
+    def _sync_refunds(self, conn) -> int:
+        """Marca como reembolsadas as transações concluídas que o refundStarPayment devolveu"""
+        ids = np.array([row[0] for row in conn.execute(
+            "SELECT id FROM transactions WHERE status = 'refunded'"
+        )], dtype=np.int64)
+        if not len(ids) or not self.transactions.length:
+            return 0
+        view = self.transactions.view()
+        positions = np.searchsorted(view['id'], ids)
+        found = positions < len(view['id'])
+        positions, ids = positions[found], ids[found]
+        positions = positions[(view['id'][positions] == ids) & (view['status'][positions] != REFUNDED)]
+        self.transactions.arrays['status'][positions] = REFUNDED
+        return len(positions)
+    
+    def refresh(self, full: bool = False) -> Dict[str, Any]:
+        """Copia as linhas novas e atualiza as abertas; full=True reconstrói o snapshot"""
+        with self._lock:
+            started = time.monotonic()
+            if not self._loaded:
+                self._load()
+            
+            with self.db.connection() as conn:
+                # Banco restaurado de um backup (marca d'água adiante do banco): recomeça
+                max_ids = conn.execute('''
+                    SELECT (SELECT COALESCE(MAX(id), 0) FROM transactions),
+                           (SELECT COALESCE(MAX(id), 0) FROM download_events)
+                ''').fetchone()
+                if max_ids[0] < self.transactions.watermark or max_ids[1] < self.events.watermark:
+                    logger.warning("Marca d'água de analytics à frente do banco: reconstruindo o snapshot")
+                    full = True
+                if full:
+                    # Os arquivos novos são outra geração; os antigos saem em _save_meta
+                    self.transactions.reset()
+                    self.events.reset()
+                
+                copied = self._append_new(conn, self.transactions, TRANSACTIONS_QUERY)
+                updated = self._sync_open(conn, copied) + self._sync_refunds(conn)
+                events = self._append_new(conn, self.events, EVENTS_QUERY)
+            self._save_meta()
+            
+            self._refreshed_at = time.monotonic()
+            self._refreshes += 1
+            self._last_refresh = {
+                'transactions': copied,
+                'updated': updated,
+                'events': events,
+                'duration_ms': round((self._refreshed_at - started) * 1000, 3)
+            }
+            return self._last_refresh
+    
+    def _ensure_fresh(self):
+        if not self._loaded or time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+    
+    def sales(self, days: int = None) -> Dict[str, Any]:
+        """Colunas das vendas concluídas (sem reembolsadas), opcionalmente dos últimos N dias"""
+        self._ensure_fresh()
+        view = self.transactions.view()
+        mask = view['status'] == COMPLETED
+        if days:
+            mask &= view['completed'] >= time.time() - days * 86400
+        return {column: values[mask] for column, values in view.items()}
+    
+    def cohorts(self, period: str = 'month', max_age: int = 12) -> List[Dict[str, Any]]:
+        sales = self.sales()
+        return cohort_retention(sales['user_id'], sales['completed'], period, max_age)
+    
+    def heatmap(self, days: int = None, utc_offset_hours: float = 0) -> Dict[str, Any]:
+        sales = self.sales(days)
+        return hourly_heatmap(sales['completed'], sales['amount'], utc_offset_hours)
+    
+    def repeat_buyers(self, days: int = None) -> Dict[str, Any]:
+        sales = self.sales(days)
+        return repeat_buyers(sales['user_id'], sales['amount'])
+    
+    def elasticity(self, days: int = None) -> List[Dict[str, Any]]:
+        sales = self.sales(days)
+        return price_elasticity(sales['product_id'], sales['amount'], sales['completed'])
+    
+    def summary(self, days: int = None) -> Dict[str, Any]:
+        """Totais de vendas, reembolsos e uso dos downloads"""
+        sales = self.sales(days)
+        view = self.transactions.view()
+        refunded = view['status'] == REFUNDED
+        if days:
+            refunded &= view['completed'] >= time.time() - days * 86400
+        events = self.events.view()
+        count, refunds = len(sales['id']), int(refunded.sum())
+        revenue = int(sales['amount'].sum())
+        return {
+            'sales': count,
+            'revenue': revenue,
+            'average_ticket': round(revenue / count, 2) if count else 0,
+            'buyers': len(np.unique(sales['user_id'])),
+            'refunded': refunds,
+            'refund_rate': round(refunds / (refunds + count), 4) if refunds + count else 0,
+            'downloads': download_engagement(sales['user_id'], sales['product_id'], events['user_id'],
+                                             events['product_id'], events['status'])
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Tamanho do snapshot, marcas d'água e a última atualização"""
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'transactions': {'rows': self.transactions.length, 'watermark': self.transactions.watermark},
+                'events': {'rows': self.events.length, 'watermark': self.events.watermark},
+                'refreshes': self._refreshes,
+                'last_refresh': self._last_refresh
+            }
+
+
+def main(argv: List[str] = None) -> int:
+    """Atualiza ou reconstrói o snapshot de analytics"""
+    import argparse
+    from dotenv import load_dotenv
+    from database import DatabaseManager
+    
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Snapshot colunar de analytics (NumPy)')
+    parser.add_argument('--db', default='bot_database.db', help='Arquivo do banco')
+    parser.add_argument('--dir', default=None, help='Diretório do snapshot (padrão: ANALYTICS_DIR)')
+    parser.add_argument('--rebuild', action='store_true', help='Descarta o snapshot e copia tudo de novo')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not AVAILABLE:
+        print("❌ Instale o NumPy: pip install numpy")
+        return 1
+    
+    engine = AnalyticsEngine(DatabaseManager(args.db), directory=args.dir)
+    report = engine.refresh(full=args.rebuild)
+    stats = engine.get_stats()
+    print(f"✅ {report['transactions']} transações e {report['events']} eventos copiados, "
+          f"{report['updated']} atualizadas em {report['duration_ms']} ms "
+          f"({stats['transactions']['rows']} transações, {stats['events']['rows']} eventos no snapshot)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
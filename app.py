@@ -1,14 +1,26 @@
 import os
+import hmac
+import json
+import time
 import logging
 from datetime import datetime
 from flask import Flask, request, jsonify, send_file, abort, Response, render_template
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 from dotenv import load_dotenv
 import telebot
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson é opcional: só acelera o parse do webhook
+    json_loads = json.loads
 from bot import create_bot
+from dispatcher import UpdateDispatcher
 from database import DatabaseManager
 from download_manager import DownloadManager
 from delivery_system import SecureDeliverySystem, DeliveryScheduler
+import analytics
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -25,6 +37,8 @@ CORS(app)  # Permitir CORS para todas as rotas
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'SEU_TOKEN_AQUI')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
 SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
 
 app.config['SECRET_KEY'] = SECRET_KEY
 
@@ -33,7 +47,13 @@ db_manager = DatabaseManager()
 download_manager = DownloadManager(db_manager)
 delivery_system = SecureDeliverySystem(db_manager, SECRET_KEY)
 delivery_scheduler = DeliveryScheduler(db_manager)
-telegram_bot = create_bot(BOT_TOKEN)
+telegram_bot = create_bot(BOT_TOKEN, db_manager=db_manager, threaded=False)
+
+# Updates do webhook vão para uma fila limitada; a resposta ao Telegram não espera os handlers
+update_dispatcher = UpdateDispatcher(telegram_bot.handle_update, name='webhook')
+
+# Analytics vetorizado (NumPy opcional): sem ele os endpoints /api/analytics respondem 503
+analytics_engine = analytics.AnalyticsEngine(db_manager) if analytics.AVAILABLE else None
 
 @app.route('/')
 def index():
@@ -48,21 +68,59 @@ def index():
 def webhook():
     """Endpoint para receber updates do Telegram via webhook"""
     try:
-        if request.headers.get('content-type') == 'application/json':
-            json_string = request.get_data().decode('utf-8')
-            update = telebot.types.Update.de_json(json_string)
-            telegram_bot.bot.process_new_updates([update])
-            return jsonify({'status': 'ok'})
-        else:
+        # Segredo registrado no set_webhook: conferido antes de ler o corpo
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+            abort(403)
+        if request.headers.get('content-type') != 'application/json':
             abort(403)
+        if request.content_length is None:
+            abort(411)
+        if request.content_length > WEBHOOK_MAX_BODY:
+            abort(413)
+        
+        data = json_loads(request.get_data(cache=False))
+        update_id = data['update_id']
+        
+        # Parse antes do claim: um corpo inválido não deixa o update_id marcado como visto
+        update = telebot.types.Update.de_json(data)
+        
+        # Reentregas do Telegram (timeout, reinício) não são processadas de novo
+        if not db_manager.claim_update(update_id):
+            return jsonify({'status': 'duplicate'})
+        
+        if not update_dispatcher.submit(update):
+            # Fila cheia: o Telegram reenvia o update mais tarde
+            db_manager.release_update(update_id)
+            logger.warning(f"Fila do webhook cheia, update {update_id} recusado")
+            response = jsonify({'error': 'Queue full'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        return jsonify({'status': 'ok'})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro no webhook: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def download_event(token: str, user_ip: str, user_agent: str, result: dict, started: float) -> dict:
+    """Contexto do download para o log de eventos (gravado ao fim do streaming)"""
+    return {
+        'token': token,
+        'ip': user_ip,
+        'user_agent': user_agent,
+        'download_id': result.get('download_id'),
+        'user_id': result.get('user_id'),
+        'product_id': result.get('product_id'),
+        'started': started
+    }
+
 @app.route('/download/<token>')
 def download_video(token):
     """Endpoint para download de vídeos com token"""
     try:
+        started = time.monotonic()
+        
         # Obter informações do usuário
         user_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
         user_agent = request.headers.get('User-Agent', 'Unknown')
@@ -71,7 +129,8 @@ def download_video(token):
         result = download_manager.process_download(token, user_ip)
         
         if not result['success']:
-            delivery_system.log_download_attempt(token, user_ip, user_agent, False, result['error'])
+            delivery_system.log_download_attempt(token, user_ip, user_agent, False, result['error'],
+                                                 started=started)
             abort(404, description=result['error'])
         
         # Log de sucesso
@@ -80,7 +139,8 @@ def download_video(token):
         # Criar resposta de streaming segura
         return delivery_system.create_streaming_response(
             result['file_path'],
-            result['filename']
+            result['filename'],
+            event=download_event(token, user_ip, user_agent, result, started)
         )
         
     except Exception as e:
@@ -91,6 +151,8 @@ def download_video(token):
 def secure_download_video(token):
     """Endpoint para download seguro com URL assinada"""
     try:
+        started = time.monotonic()
+        
         # Obter parâmetros da URL assinada
         expires_at = int(request.args.get('expires', 0))
         signature = request.args.get('signature', '')
@@ -106,15 +168,19 @@ def secure_download_video(token):
         
         # Processar download normalmente
         user_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+        user_agent = request.headers.get('User-Agent', 'Unknown')
         result = download_manager.process_download(token, user_ip)
         
         if not result['success']:
+            delivery_system.log_download_attempt(token, user_ip, user_agent, False, result['error'],
+                                                 started=started)
             abort(404, description=result['error'])
         
         # Retornar arquivo com streaming seguro
         return delivery_system.create_streaming_response(
             result['file_path'],
-            result['filename']
+            result['filename'],
+            event=download_event(token, user_ip, user_agent, result, started)
         )
         
     except Exception as e:
@@ -128,7 +194,7 @@ def get_products():
         products = db_manager.get_active_products()
         return jsonify({
             'status': 'success',
-            'products': products
+            'products': [product.to_dict() for product in products]
         })
     except Exception as e:
         logger.error(f"Erro ao buscar produtos: {e}")
@@ -182,11 +248,118 @@ def health_check():
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """API para métricas internas (pool de conexões, caches, filas)"""
+    try:
+        return jsonify({
+            'status': 'success',
+            'metrics': {
+                'bot': telegram_bot.get_stats(),
+                'webhook_queue': update_dispatcher.get_stats(),
+                'db_pool': db_manager.get_pool_stats(),
+                'db_writer': db_manager.get_writer_stats(),
+                'catalog_cache': db_manager.get_catalog_stats(),
+                'token_cache': db_manager.get_token_cache_stats(),
+                'user_cache': db_manager.get_user_cache_stats(),
+                'file_id_cache': db_manager.get_file_id_stats(),
+                'search': db_manager.get_search_stats(),
+                'download_events': db_manager.get_download_event_stats(),
+                'cleanup': db_manager.get_cleanup_stats(),
+                'analytics': analytics_engine.get_stats() if analytics_engine else None
+            }
+        })
+    except Exception as e:
+        logger.error(f"Erro ao buscar métricas: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+def analytics_days():
+    """Janela opcional ?days=N dos endpoints de analytics"""
+    days = request.args.get('days', type=int)
+    return days if days and days > 0 else None
+
+def analytics_unavailable():
+    return jsonify({'error': 'Analytics indisponível: instale o NumPy'}), 503
+
+@app.route('/api/analytics/summary', methods=['GET'])
+def get_analytics_summary():
+    """API com totais de vendas, reembolsos e uso dos downloads"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    try:
+        return jsonify({'status': 'success', 'data': analytics_engine.summary(analytics_days())})
+    except Exception as e:
+        logger.error(f"Erro no resumo de analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/analytics/cohorts', methods=['GET'])
+def get_analytics_cohorts():
+    """API de retenção por coorte da primeira compra (?period=month|week&max_age=12)"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    period = request.args.get('period', 'month')
+    if period not in ('month', 'week'):
+        return jsonify({'error': 'period deve ser month ou week'}), 400
+    try:
+        max_age = min(max(request.args.get('max_age', 12, type=int), 1), 104)
+        return jsonify({'status': 'success', 'data': analytics_engine.cohorts(period, max_age)})
+    except Exception as e:
+        logger.error(f"Erro nas coortes de analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/analytics/heatmap', methods=['GET'])
+def get_analytics_heatmap():
+    """API de receita por dia da semana x hora (?days=N&utc_offset=-3)"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    try:
+        utc_offset = request.args.get('utc_offset', 0, type=float)
+        return jsonify({'status': 'success', 'data': analytics_engine.heatmap(analytics_days(), utc_offset)})
+    except Exception as e:
+        logger.error(f"Erro no heatmap de analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/analytics/repeat-buyers', methods=['GET'])
+def get_analytics_repeat_buyers():
+    """API de taxa de recompra (?days=N)"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    try:
+        return jsonify({'status': 'success', 'data': analytics_engine.repeat_buyers(analytics_days())})
+    except Exception as e:
+        logger.error(f"Erro na recompra de analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/analytics/elasticity', methods=['GET'])
+def get_analytics_elasticity():
+    """API de elasticidade-preço por produto (?days=N)"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    try:
+        return jsonify({'status': 'success', 'data': analytics_engine.elasticity(analytics_days())})
+    except Exception as e:
+        logger.error(f"Erro na elasticidade de analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/analytics/refresh', methods=['POST'])
+def refresh_analytics():
+    """API para atualizar o snapshot de analytics (?full=true reconstrói)"""
+    if analytics_engine is None:
+        return analytics_unavailable()
+    try:
+        full = request.args.get('full', 'false').lower() == 'true'
+        return jsonify({'status': 'success', 'data': analytics_engine.refresh(full=full)})
+    except Exception as e:
+        logger.error(f"Erro ao atualizar analytics: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 def setup_webhook():
     """Configura webhook se URL estiver definida"""
     if WEBHOOK_URL:
         try:
-            telegram_bot.set_webhook(f"{WEBHOOK_URL}/webhook")
+            if not WEBHOOK_SECRET:
+                logger.warning("WEBHOOK_SECRET não definido: /webhook aceitará chamadas sem o segredo")
+            telegram_bot.set_webhook(f"{WEBHOOK_URL}/webhook", secret_token=WEBHOOK_SECRET or None)
             logger.info(f"Webhook configurado: {WEBHOOK_URL}/webhook")
         except Exception as e:
             logger.error(f"Erro ao configurar webhook: {e}")
@@ -231,7 +404,8 @@ def cleanup_expired_downloads():
         removed_count = delivery_scheduler.cleanup_expired_downloads()
         return jsonify({
             'status': 'success',
-            'message': f'{removed_count} downloads expirados removidos'
+            'message': f'{removed_count} downloads expirados arquivados',
+            'stats': db_manager.get_cleanup_stats()
         })
     except Exception as e:
         logger.error(f"Erro na limpeza: {e}")
@@ -267,10 +441,15 @@ def create_product():
         name = request.form.get('name')
         description = request.form.get('description', '')
         price_stars = int(request.form.get('price_stars', 0))
+        category = request.form.get('category') or None
+        delivery_mode = request.form.get('delivery_mode') or None
         
         if not name or price_stars <= 0:
             return jsonify({'error': 'Nome e preço são obrigatórios'}), 400
         
+        if delivery_mode not in (None, 'link', 'telegram'):
+            return jsonify({'error': 'Modo de entrega inválido (use link ou telegram)'}), 400
+        
         # Upload do arquivo
         file = request.files.get('file')
         if not file:
@@ -291,7 +470,9 @@ def create_product():
             description=description,
             price_stars=price_stars,
             file_path=file_path,
-            thumbnail_path=thumbnail_path
+            thumbnail_path=thumbnail_path,
+            category=category,
+            delivery_mode=delivery_mode
         )
         
         return jsonify({
@@ -0,0 +1,476 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Dict, Any
+
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from database import DatabaseManager
+from payment_processor import PaymentProcessor
+from send_scheduler import scheduled_bot, PRIORITY_PAYMENT, PRIORITY_BULK
+from polling import PollingRunner, ALLOWED_UPDATES
+from bot import (
+    HELP_TEXT, EMPTY_CATALOG_TEXT, build_welcome_text, build_product_card,
+    build_invoice, pre_checkout_data, successful_payment_data,
+    build_payment_error_text, build_download_confirmation, CatalogPages, PreCheckoutMetrics,
+    parse_page_callback, is_not_modified_error, is_invalid_file_id_error, bot_id_from_token,
+    admin_ids, build_video_caption, FILE_KINDS, sent_file_id, delivers_via_telegram,
+    inline_results, purchase_chat_id
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTelegramVideoBot:
+    """Variante asyncio do TelegramVideoBot: handlers concorrentes e banco num executor limitado"""
+    
+    def __init__(self, token: str, db_manager: DatabaseManager, db_workers: int = None):
+        # Conexões HTTP simultâneas com a Bot API (sessão aiohttp compartilhada)
+        asyncio_helper.REQUEST_LIMIT = int(os.getenv('BOT_HTTP_CONNECTIONS', 100))
+        
+        # Envios passam pelo SendScheduler (limites da Bot API e prioridade de pagamentos)
+        self.bot = scheduled_bot(AsyncTeleBot(token))
+        self.db = db_manager
+        self.payment_processor = PaymentProcessor(db_manager, token)
+        self.catalog_pages = CatalogPages(db_manager)
+        self.bot_id = bot_id_from_token(token)
+        self.polling: Optional[PollingRunner] = None
+        self.pre_checkout_metrics = PreCheckoutMetrics()
+        
+        # Mais workers que conexões no pool só criaria fila dentro do pool
+        self.db_workers = db_workers or int(os.getenv('BOT_DB_WORKERS', db_manager.pool.max_size))
+        self.executor = ThreadPoolExecutor(max_workers=self.db_workers, thread_name_prefix='bot-db')
+        
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+        
+        # Contadores expostos em get_stats()
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        
+        self.setup_handlers()
+    
+    async def run_sync(self, func, *args, **kwargs):
+        """Executa uma função bloqueante (banco, disco) no executor sem travar o event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+    
+    def setup_handlers(self):
+        """Configura os handlers do bot"""
+        
+        @self.bot.message_handler(commands=['start'])
+        async def handle_start(message):
+            await self.handle_start_command(message)
+        
+        @self.bot.message_handler(commands=['help'])
+        async def handle_help(message):
+            await self.handle_help_command(message)
+        
+        @self.bot.message_handler(commands=['catalogo', 'catalog'])
+        async def handle_catalog(message):
+            await self.handle_catalog_command(message)
+        
+        @self.bot.message_handler(commands=['warmup'])
+        async def handle_warmup(message):
+            await self.handle_warmup_command(message)
+        
+        @self.bot.inline_handler(func=lambda query: True)
+        async def handle_inline(query):
+            await self.handle_inline_query(query)
+        
+        @self.bot.callback_query_handler(func=lambda call: True)
+        async def handle_callback(call):
+            await self.handle_callback_query(call)
+        
+        @self.bot.pre_checkout_query_handler(func=lambda query: True)
+        async def handle_pre_checkout(query):
+            await self.handle_pre_checkout_query(query)
+        
+        @self.bot.message_handler(content_types=['successful_payment'])
+        async def handle_successful_payment(message):
+            await self.handle_successful_payment_message(message)
+    
+    async def handle_start_command(self, message):
+        """Handler para comando /start"""
+        user = message.from_user
+        
+        # Registro do usuário e boas-vindas são independentes: seguem juntos
+        await asyncio.gather(
+            self.run_sync(
+                self.db.upsert_user,
+                telegram_id=user.id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            ),
+            self.bot.send_message(message.chat.id, build_welcome_text(user), parse_mode='Markdown')
+        )
+    
+    async def handle_help_command(self, message):
+        """Handler para comando /help"""
+        await self.bot.send_message(message.chat.id, HELP_TEXT, parse_mode='Markdown')
+    
+    async def handle_catalog_command(self, message):
+        """Handler para comando /catalogo"""
+        # Uma nova versão do catálogo recarrega os produtos do banco: executor
+        page = await self.run_sync(self.catalog_pages.get)
+        
+        if page is None:
+            await self.bot.send_message(message.chat.id, EMPTY_CATALOG_TEXT)
+            return
+        
+        text, keyboard = page
+        await self.bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=keyboard)
+    
+    async def show_catalog_page(self, call, category: int, page: int):
+        """Troca a página exibida editando a mensagem do catálogo"""
+        result = await self.run_sync(self.catalog_pages.get, category, page)
+        if result is None:
+            await self.bot.edit_message_text(EMPTY_CATALOG_TEXT, call.message.chat.id,
+                                             call.message.message_id)
+            return
+        
+        text, keyboard = result
+        try:
+            await self.bot.edit_message_text(
+                text,
+                call.message.chat.id,
+                call.message.message_id,
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+        except asyncio_helper.ApiTelegramException as e:
+            if not is_not_modified_error(e):
+                raise
+    
+    async def send_product_details(self, call, product_id: int):
+        """Envia o card do produto com a thumbnail (file_id em cache; upload só na primeira vez)"""
+        product = await self.run_sync(self.db.get_product_by_id, product_id)
+        
+        if not product:
+            await self.bot.answer_callback_query(call.id, "Produto não encontrado!")
+            return
+        
+        product_text, keyboard = build_product_card(product)
+        chat_id = purchase_chat_id(call)
+        
+        # Checagem do arquivo fora do event loop
+        path = product.get('thumbnail_path')
+        if path and await self.run_sync(os.path.exists, path):
+            await self.send_cached_file(
+                chat_id,
+                product,
+                'thumbnail',
+                caption=product_text,
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+        else:
+            await self.bot.send_message(
+                chat_id,
+                product_text,
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+    
+    async def send_cached_file(self, chat_id: int, product: Dict[str, Any], kind: str, **kwargs):
+        """Envia o arquivo pelo file_id já conhecido; só faz upload na primeira vez (ou se o id for recusado)"""
+        path_field, method = FILE_KINDS[kind]
+        path = product[path_field]
+        send = getattr(self.bot, method)
+        
+        file_id = await self.run_sync(self.db.get_file_id, self.bot_id, product['id'], kind, path)
+        if file_id:
+            try:
+                return await send(chat_id, file_id, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                if not is_invalid_file_id_error(e):
+                    raise
+                logger.warning(f"file_id ({kind}) do produto {product['id']} recusado: {e}")
+                await self.run_sync(self.db.forget_file_id, self.bot_id, product['id'], kind)
+        
+        # Arquivo aberto (não os bytes): o aiohttp lê em blocos durante o upload
+        file = await self.run_sync(open, path, 'rb')
+        try:
+            message = await send(chat_id, file, **kwargs)
+        finally:
+            await self.run_sync(file.close)
+        await self.run_sync(self.db.save_file_id, self.bot_id, product['id'], kind,
+                            sent_file_id(message), path)
+        return message
+    
+    async def handle_warmup_command(self, message):
+        """Handler para /warmup: pré-envia thumbnails e vídeos para este chat (só administradores)"""
+        if message.from_user.id not in admin_ids():
+            return
+        
+        await self.bot.send_message(message.chat.id, "⏳ Enviando arquivos para o cache de file_ids...")
+        result = await self.warm_up_file_ids(message.chat.id)
+        await self.bot.send_message(
+            message.chat.id,
+            f"✅ Cache aquecido: {result['uploaded']} enviadas, {result['cached']} já em cache, "
+            f"{result['failed']} com erro"
+        )
+    
+    async def warm_up_file_ids(self, chat_id: int) -> Dict[str, int]:
+        """Faz upload de todo arquivo ainda sem file_id para um chat privado e apaga as mensagens"""
+        result = {'uploaded': 0, 'cached': 0, 'failed': 0}
+        
+        for product in await self.run_sync(self.db.get_active_products):
+            # Vídeos só dos produtos entregues pelo Telegram
+            kinds = ['thumbnail', 'video'] if delivers_via_telegram(product) else ['thumbnail']
+            for kind in kinds:
+                path = product.get(FILE_KINDS[kind][0])
+                if not path or not await self.run_sync(os.path.exists, path):
+                    continue
+                if await self.run_sync(self.db.get_file_id, self.bot_id, product['id'], kind, path):
+                    result['cached'] += 1
+                    continue
+                
+                try:
+                    sent = await self.send_cached_file(chat_id, product, kind, disable_notification=True,
+                                                       priority=PRIORITY_BULK)
+                    await self.bot.delete_message(chat_id, sent.message_id, priority=PRIORITY_BULK)
+                    result['uploaded'] += 1
+                except Exception as e:
+                    logger.error(f"Erro ao pré-enviar {kind} do produto {product['id']}: {e}")
+                    result['failed'] += 1
+        
+        logger.info(f"Aquecimento de file_ids concluído: {result}")
+        return result
+    
+    async def handle_inline_query(self, query):
+        """Handler para buscas inline (@bot termo)"""
+        try:
+            results, next_offset = await self.run_sync(
+                inline_results, self.db, self.bot_id, query.query, query.offset
+            )
+            await self.bot.answer_inline_query(
+                query.id,
+                results,
+                cache_time=int(os.getenv('INLINE_CACHE_TIME', 60)),
+                next_offset=next_offset
+            )
+        except Exception as e:
+            logger.error(f"Erro na busca inline: {e}")
+    
+    async def handle_callback_query(self, call):
+        """Handler para callback queries (botões inline)"""
+        try:
+            if call.data.startswith('buy_'):
+                product_id = int(call.data.split('_')[1])
+                await self.process_purchase_request(call, product_id)
+            elif call.data.startswith('info_'):
+                product_id = int(call.data.split('_')[1])
+                await self.send_product_details(call, product_id)
+            elif call.data.startswith('page_'):
+                await self.show_catalog_page(call, *parse_page_callback(call.data))
+            
+            # Responder ao callback para remover loading
+            await self.bot.answer_callback_query(call.id)
+        
+        except Exception as e:
+            logger.error(f"Erro no callback query: {e}")
+            await self.bot.answer_callback_query(call.id, "Erro interno. Tente novamente.")
+    
+    async def process_purchase_request(self, call, product_id: int):
+        """Processa solicitação de compra"""
+        user = call.from_user
+        product = await self.run_sync(self.db.get_product_by_id, product_id)
+        
+        if not product:
+            await self.bot.answer_callback_query(call.id, "Produto não encontrado!")
+            return
+        
+        if self.payment_processor.signed_invoices:
+            # Fatura assinada: nenhuma escrita no banco até o pagamento
+            payload = self.payment_processor.create_invoice_payload(user.id, product)
+        else:
+            payload = await self.run_sync(self._create_purchase, user, product)
+        
+        # Criar fatura
+        await self.bot.send_invoice(**build_invoice(purchase_chat_id(call), product, payload),
+                                    priority=PRIORITY_PAYMENT)
+    
+    def _create_purchase(self, user, product) -> int:
+        """Registra usuário e transação pendente (roda no executor)"""
+        user_id = self.db.upsert_user(
+            telegram_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+        return self.db.create_transaction(
+            user_id=user_id,
+            product_id=product['id'],
+            amount_stars=product['price_stars']
+        )
+    
+    async def handle_pre_checkout_query(self, query):
+        """Handler para validação de pré-checkout"""
+        started = time.perf_counter()
+        try:
+            # Transação no cache de pendentes: valida direto no event loop, sem disputar o executor do banco
+            data = pre_checkout_data(query)
+            result = self.payment_processor.process_pre_checkout(data, cached_only=True)
+            if result is None:
+                # Fatura de antes de um reinício ou rejeição: a consulta ao banco vai para o executor
+                result = await self.run_sync(self.payment_processor.process_pre_checkout, data)
+            validated = time.perf_counter()
+            
+            # Responder ao Telegram (fora do escalonador de envios: não espera atrás de nenhum envio)
+            await self.bot.answer_pre_checkout_query(
+                query.id,
+                ok=result['ok'],
+                error_message=result.get('error_message')
+            )
+            self.pre_checkout_metrics.observe(query.id, validated - started, time.perf_counter() - started)
+            
+            if result['ok']:
+                logger.info(f"Pré-checkout aprovado para transação {query.invoice_payload}")
+            else:
+                logger.warning(f"Pré-checkout rejeitado: {result.get('error_message')}")
+        
+        except Exception as e:
+            logger.error(f"Erro no pré-checkout: {e}")
+            await self.bot.answer_pre_checkout_query(
+                query.id,
+                ok=False,
+                error_message="Erro interno. Tente novamente."
+            )
+    
+    async def handle_successful_payment_message(self, message):
+        """Handler para pagamento bem-sucedido"""
+        payment = None
+        try:
+            payment = message.successful_payment
+            
+            # Processar pagamento
+            download_info = await self.run_sync(
+                self.payment_processor.process_successful_payment,
+                successful_payment_data(payment),
+                message.from_user.id
+            )
+            
+            # Entregar o vídeo (ou o link de download)
+            await self.deliver_purchase(message.chat.id, download_info)
+            
+            logger.info(f"Pagamento processado com sucesso: {payment.telegram_payment_charge_id}")
+        
+        except Exception as e:
+            logger.error(f"Erro ao processar pagamento: {e}")
+            await self.bot.send_message(
+                message.chat.id,
+                build_payment_error_text(payment),
+                parse_mode='Markdown',
+                priority=PRIORITY_PAYMENT
+            )
+    
+    async def deliver_purchase(self, chat_id: int, download_info: Dict[str, Any]):
+        """Entrega a compra: o próprio vídeo pelo Telegram (se configurado) ou o link de download"""
+        product = await self.run_sync(self.db.get_product_by_id, download_info['product_id'])
+        if product and await self.run_sync(delivers_via_telegram, product):
+            try:
+                await self.send_cached_file(
+                    chat_id,
+                    product,
+                    'video',
+                    caption=build_video_caption(download_info),
+                    parse_mode='Markdown',
+                    protect_content=True,
+                    supports_streaming=True,
+                    priority=PRIORITY_PAYMENT
+                )
+                return
+            except Exception as e:
+                logger.error(f"Erro ao entregar vídeo pelo Telegram, enviando link: {e}")
+        
+        success_message, keyboard = build_download_confirmation(download_info)
+        await self.bot.send_message(
+            chat_id,
+            success_message,
+            parse_mode='Markdown',
+            reply_markup=keyboard,
+            priority=PRIORITY_PAYMENT
+        )
+    
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Event loop em thread própria, usado quando o bot é chamado de código síncrono (Flask)"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='bot-event-loop', daemon=True).start()
+            return self._loop
+    
+    def submit(self, coro) -> Future:
+        """Agenda uma corrotina no event loop do bot a partir de outra thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+    
+    def process_update(self, update: types.Update):
+        """Agenda um update do webhook e retorna sem esperar os handlers"""
+        with self._stats_lock:
+            self._in_flight += 1
+        self.submit(self.bot.process_new_updates([update])).add_done_callback(self._update_done)
+    
+    def handle_update(self, update: types.Update):
+        """Processa um update e espera os handlers (usado pelos workers do UpdateDispatcher)"""
+        with self._stats_lock:
+            self._in_flight += 1
+        future = self.submit(self.bot.process_new_updates([update]))
+        try:
+            future.result()
+        finally:
+            self._update_done(future)
+    
+    def _update_done(self, future: Future):
+        failed = future.exception() is not None
+        with self._stats_lock:
+            self._in_flight -= 1
+            self._processed += 1
+            self._failed += failed
+        if failed:
+            logger.error(f"Erro ao processar update: {future.exception()}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores do runtime assíncrono"""
+        return {
+            'runtime': 'asyncio',
+            'in_flight': self._in_flight,
+            'processed': self._processed,
+            'failed': self._failed,
+            'db_workers': self.db_workers,
+            'http_connections': asyncio_helper.REQUEST_LIMIT,
+            'send_scheduler': self.bot.scheduler.get_stats() if self.bot.scheduler else None,
+            'polling': self.polling.get_stats() if self.polling else None,
+            'pre_checkout': {
+                **self.pre_checkout_metrics.get_stats(),
+                'pending_cache': self.db.get_pending_cache_stats()
+            }
+        }
+    
+    def start_polling(self):
+        """Inicia o bot em modo polling (bloqueia até ser interrompido); handlers rodam no event loop do bot"""
+        logger.info("Bot assíncrono iniciado em modo polling")
+        self.polling = PollingRunner(self)
+        self.polling.run()
+    
+    def set_webhook(self, webhook_url: str, secret_token: Optional[str] = None):
+        """Configura webhook para o bot (secret_token volta no header X-Telegram-Bot-Api-Secret-Token)"""
+        self.submit(self.bot.set_webhook(webhook_url, secret_token=secret_token,
+                                         allowed_updates=ALLOWED_UPDATES)).result(timeout=30)
+        logger.info(f"Webhook configurado: {webhook_url}")
+
+
+def create_async_bot(token: str, db_path: str = "bot_database.db",
+                     db_manager: Optional[DatabaseManager] = None) -> AsyncTelegramVideoBot:
+    """Cria o bot assíncrono (reaproveita o db_manager/pool se informado)"""
+    if db_manager is None:
+        db_manager = DatabaseManager(db_path)
+    return AsyncTelegramVideoBot(token, db_manager)
@@ -31,7 +31,7 @@ echo.
 
 REM Backup do banco de dados
 echo Fazendo backup do banco de dados...
-copy bot_database.db backups\database_backup_%timestamp%.db
+python backup.py --db bot_database.db --dir backups
 
 REM Backup dos vídeos (se existirem)
 if exist "videos\*.*" (
@@ -49,7 +49,7 @@ echo    Backup concluído com sucesso!
 echo ========================================
 echo.
 echo Arquivos criados:
-echo - backups\database_backup_%timestamp%.db
+echo - backups\database_backup_*.db.gz (verificado com integrity_check)
 if exist "videos\*.*" echo - backups\videos_backup_%timestamp%.zip
 echo - backups\config_backup_%timestamp%.env
 echo.
@@ -0,0 +1,213 @@
+import os
+import sys
+import glob
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX = 'database_backup_'
+
+
+class BackupManager:
+    """Backups online do SQLite pela API de backup, em passos curtos que não travam os escritores"""
+    
+    def __init__(self, db_path: str, backup_dir: str = None, pages_per_step: int = None,
+                 step_sleep_ms: int = None, compress: bool = None, keep_count: int = None):
+        self.db_path = db_path
+        self.backup_dir = backup_dir or os.getenv('BACKUP_DIR', 'backups')
+        self.pages_per_step = pages_per_step or int(os.getenv('BACKUP_PAGES_PER_STEP', 256))
+        self.step_sleep = (step_sleep_ms if step_sleep_ms is not None
+                           else int(os.getenv('BACKUP_STEP_SLEEP_MS', 10))) / 1000
+        self.compress = (compress if compress is not None
+                         else os.getenv('BACKUP_COMPRESS', 'true').lower() in ('1', 'true', 'yes'))
+        self.keep_count = keep_count or int(os.getenv('BACKUP_KEEP', 7))
+    
+    def create_backup(self) -> Dict[str, Any]:
+        """Gera um snapshot verificado (e comprimido) do banco e aplica a retenção"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        backup_file = os.path.join(self.backup_dir, f"{BACKUP_PREFIX}{timestamp}.db")
+        tmp_file = f"{backup_file}.tmp"
+        
+        started = time.monotonic()
+        try:
+            steps = self._copy_pages(tmp_file)
+            integrity = self.check_integrity(tmp_file)
+            if integrity != 'ok':
+                raise sqlite3.DatabaseError(f"Backup corrompido: {integrity}")
+            
+            raw_size = os.path.getsize(tmp_file)
+            if self.compress:
+                backup_file += '.gz'
+                gz_tmp = f"{backup_file}.tmp"
+                with open(tmp_file, 'rb') as src, gzip.open(gz_tmp, 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.replace(gz_tmp, backup_file)
+                os.remove(tmp_file)
+            else:
+                os.replace(tmp_file, backup_file)
+        finally:
+            for leftover in (tmp_file, f"{backup_file}.tmp"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        
+        result = {
+            'file': backup_file,
+            'steps': steps,
+            'size': raw_size,
+            'stored_size': os.path.getsize(backup_file),
+            'duration_ms': round((time.monotonic() - started) * 1000, 1)
+        }
+        logger.info(f"Backup do banco criado: {backup_file} ({result['size']} bytes, "
+                    f"{result['stored_size']} gravados, {steps} passos, {result['duration_ms']} ms)")
+        
+        self.cleanup_old_backups(self.keep_count)
+        return result
+    
+    def _copy_pages(self, target_path: str) -> int:
+        """Copia o banco para target_path em lotes de páginas, pausando entre eles"""
+        steps = 0
+        
+        def progress(status, remaining, total):
+            nonlocal steps
+            steps += 1
+            if remaining and self.step_sleep:
+                # Libera o banco entre os passos para os escritores não esperarem
+                time.sleep(self.step_sleep)
+        
+        source = sqlite3.connect(self.db_path, timeout=30)
+        target = sqlite3.connect(target_path)
+        try:
+            # Transação de leitura fixa um snapshot: com WAL os escritores seguem
+            # livres e a cópia não reinicia quando o banco muda durante os passos
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            source.backup(target, pages=self.pages_per_step, progress=progress)
+            source.rollback()
+            # A cópia é um arquivo isolado: sem WAL para restaurar com um único arquivo
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+            source.close()
+        return steps
+    
+    @staticmethod
+    def check_integrity(path: str) -> str:
+        """Roda PRAGMA integrity_check num arquivo de banco ('ok' se íntegro)"""
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute("PRAGMA integrity_check").fetchall()
+            return '; '.join(row[0] for row in rows)
+        finally:
+            conn.close()
+    
+    def verify_backup(self, backup_file: str) -> bool:
+        """Descomprime (se preciso) e verifica a integridade de um backup existente"""
+        if not backup_file.endswith('.gz'):
+            return self.check_integrity(backup_file) == 'ok'
+        
+        tmp_file = f"{backup_file[:-3]}.verify.tmp"
+        try:
+            self._decompress(backup_file, tmp_file)
+            return self.check_integrity(tmp_file) == 'ok'
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    
+    def restore_backup(self, backup_file: str, target_path: str = None):
+        """Restaura um backup verificado sobre o banco (com o bot parado)"""
+        target_path = target_path or self.db_path
+        tmp_file = f"{target_path}.restore.tmp"
+        try:
+            if backup_file.endswith('.gz'):
+                self._decompress(backup_file, tmp_file)
+            else:
+                shutil.copyfile(backup_file, tmp_file)
+            
+            integrity = self.check_integrity(tmp_file)
+            if integrity != 'ok':
+                raise sqlite3.DatabaseError(f"Backup corrompido: {integrity}")
+            
+            # WAL/SHM antigos não pertencem ao arquivo restaurado
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(target_path + suffix):
+                    os.remove(target_path + suffix)
+            os.replace(tmp_file, target_path)
+            logger.info(f"Banco restaurado de {backup_file} para {target_path}")
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    
+    @staticmethod
+    def _decompress(source_path: str, target_path: str):
+        """Descomprime um backup .gz em blocos"""
+        with gzip.open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    
+    def list_backups(self) -> List[str]:
+        """Backups existentes, mais recentes primeiro"""
+        backup_files = (glob.glob(os.path.join(self.backup_dir, f"{BACKUP_PREFIX}*.db")) +
+                        glob.glob(os.path.join(self.backup_dir, f"{BACKUP_PREFIX}*.db.gz")))
+        # O timestamp no nome ordena; a extensão não importa
+        backup_files.sort(key=lambda path: os.path.basename(path).split('.')[0], reverse=True)
+        return backup_files
+    
+    def cleanup_old_backups(self, keep_count: Optional[int] = None) -> int:
+        """Remove backups antigos, mantendo apenas os mais recentes"""
+        keep_count = self.keep_count if keep_count is None else keep_count
+        removed = 0
+        for old_backup in self.list_backups()[keep_count:]:
+            try:
+                os.remove(old_backup)
+                removed += 1
+                logger.info(f"Backup antigo removido: {old_backup}")
+            except OSError as e:
+                logger.error(f"Erro ao remover backup {old_backup}: {e}")
+        return removed
+
+
+def main(argv: List[str] = None) -> int:
+    """Cria, verifica ou restaura backups do banco"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Backups online do banco de dados')
+    parser.add_argument('--db', default='bot_database.db', help='Arquivo do banco')
+    parser.add_argument('--dir', default=None, help='Diretório dos backups (padrão: BACKUP_DIR ou backups)')
+    parser.add_argument('--verify', metavar='ARQUIVO', help='Verifica a integridade de um backup')
+    parser.add_argument('--restore', metavar='ARQUIVO', help='Restaura um backup sobre --db (pare o bot antes)')
+    parser.add_argument('--list', action='store_true', help='Lista os backups existentes')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    manager = BackupManager(args.db, backup_dir=args.dir)
+    
+    if args.list:
+        for backup_file in manager.list_backups():
+            print(f"{backup_file} ({os.path.getsize(backup_file)} bytes)")
+        return 0
+    
+    if args.verify:
+        ok = manager.verify_backup(args.verify)
+        print(f"{'✅' if ok else '❌'} {args.verify}")
+        return 0 if ok else 1
+    
+    if args.restore:
+        manager.restore_backup(args.restore)
+        print(f"✅ Banco restaurado de {args.restore}")
+        return 0
+    
+    result = manager.create_backup()
+    print(f"✅ Backup criado: {result['file']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+import os
+import sys
+import math
+import time
+import tempfile
+import logging
+from typing import Dict, Any, List, Callable
+
+import analytics
+
+logger = logging.getLogger(__name__)
+
+# Equivalentes em SQL das métricas de analytics.py (mesmos resultados, calculados pelo SQLite)
+
+COHORTS_SQL = '''
+    -- full-scan-ok
+    WITH sales AS (
+        SELECT user_id,
+               (CAST(strftime('%Y', completed_at) AS INTEGER) - 1970) * 12
+               + CAST(strftime('%m', completed_at) AS INTEGER) - 1 AS period
+        FROM transactions
+        WHERE status = 'completed'
+    ), firsts AS (
+        SELECT user_id, MIN(period) AS cohort FROM sales GROUP BY user_id
+    )
+    SELECT f.cohort, s.period - f.cohort AS age, COUNT(DISTINCT s.user_id)
+    FROM sales s
+    JOIN firsts f ON f.user_id = s.user_id
+    WHERE s.period - f.cohort < ?
+    GROUP BY f.cohort, age
+'''
+
+HEATMAP_SQL = '''
+    -- full-scan-ok
+    SELECT (CAST(strftime('%w', completed_at) AS INTEGER) + 6) % 7 AS weekday,
+           CAST(strftime('%H', completed_at) AS INTEGER) AS hour,
+           SUM(amount_stars), COUNT(*)
+    FROM transactions
+    WHERE status = 'completed'
+    GROUP BY weekday, hour
+'''
+
+REPEAT_BUYERS_SQL = '''
+    -- full-scan-ok
+    SELECT COUNT(*), SUM(purchases >= 2), SUM(CASE WHEN purchases >= 2 THEN revenue ELSE 0 END),
+           SUM(revenue), SUM(purchases)
+    FROM (
+        SELECT user_id, COUNT(*) AS purchases, SUM(amount_stars) AS revenue
+        FROM transactions
+        WHERE status = 'completed'
+        GROUP BY user_id
+    )
+'''
+
+PRICE_POINTS_SQL = '''
+    -- full-scan-ok
+    SELECT product_id, amount_stars, COUNT(*),
+           MAX(CAST(strftime('%s', completed_at) AS INTEGER) / 86400)
+           - MIN(CAST(strftime('%s', completed_at) AS INTEGER) / 86400) + 1
+    FROM transactions
+    WHERE status = 'completed'
+    GROUP BY product_id, amount_stars
+    ORDER BY product_id, amount_stars
+'''
+
+DOWNLOADED_SALES_SQL = '''
+    -- full-scan-ok
+    SELECT COUNT(*), SUM(EXISTS (
+        SELECT 1 FROM download_events e
+        WHERE e.user_id = t.user_id AND e.product_id = t.product_id AND e.status IN (200, 206)
+    ))
+    FROM transactions t
+    WHERE t.status = 'completed'
+'''
+
+
+def sql_cohorts(conn, max_age: int = 12) -> Dict[tuple, int]:
+    return {(cohort, age): users for cohort, age, users in conn.execute(COHORTS_SQL, (max_age,))}
+
+
+def sql_heatmap(conn) -> Dict[str, List[List[int]]]:
+    revenue = [[0] * 24 for _ in range(7)]
+    sales = [[0] * 24 for _ in range(7)]
+    for weekday, hour, amount, count in conn.execute(HEATMAP_SQL):
+        revenue[weekday][hour], sales[weekday][hour] = amount, count
+    return {'revenue': revenue, 'sales': sales}
+
+
+def sql_repeat_buyers(conn) -> Dict[str, Any]:
+    buyers, repeat, repeat_revenue, revenue, purchases = conn.execute(REPEAT_BUYERS_SQL).fetchone()
+    return {
+        'buyers': buyers,
+        'repeat_buyers': repeat or 0,
+        'repeat_rate': round(repeat / buyers, 4) if buyers else 0,
+        'repeat_revenue_share': round(repeat_revenue / revenue, 4) if revenue else 0,
+        'purchases_per_buyer': round(purchases / buyers, 4) if buyers else 0
+    }
+
+
+def sql_elasticity(conn, min_prices: int = 2) -> Dict[int, Any]:
+    """Pontos de preço agregados no SQLite; a regressão log-log fica em Python puro"""
+    points: Dict[int, List[tuple]] = {}
+    for product_id, price, sales, days in conn.execute(PRICE_POINTS_SQL):
+        points.setdefault(product_id, []).append((math.log(max(price, 1)), math.log(sales / days), days))
+    
+    result = {}
+    for product_id, rows in points.items():
+        sw = sum(w for _, _, w in rows)
+        swx = sum(w * x for x, _, w in rows)
+        swy = sum(w * y for _, y, w in rows)
+        swxx = sum(w * x * x for x, _, w in rows)
+        swxy = sum(w * x * y for x, y, w in rows)
+        denominator = sw * swxx - swx ** 2
+        result[product_id] = (round((sw * swxy - swx * swy) / denominator, 4)
+                              if len(rows) >= min_prices and denominator > 1e-12 else None)
+    return result
+
+
+def sql_downloaded_sales(conn) -> Dict[str, int]:
+    sales, downloaded = conn.execute(DOWNLOADED_SALES_SQL).fetchone()
+    return {'sales': sales, 'downloaded_sales': downloaded or 0}
+
+
+def best_time(function: Callable, repeat: int) -> tuple:
+    """Menor tempo (ms) de N execuções e o resultado da última"""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return round(best * 1000, 3), result
+
+
+def populate(db_manager, transactions: int, seed: int = 42):
+    """Preenche um banco vazio com vendas sintéticas: 1 ano, preços que mudam a cada 30 dias"""
+    np = analytics.np
+    rng = np.random.default_rng(seed)
+    users = max(transactions // 5, 1)
+    products = 50
+    now = int(time.time())
+    
+    # Preço base por produto e um multiplicador por bloco de 30 dias; compras ~ preço^-1.5
+    base_prices = rng.integers(50, 500, products)
+    completed = now - rng.integers(0, 365 * 86400, transactions)
+    product_ids = rng.integers(0, products, transactions)
+    blocks = completed // (30 * 86400)
+    multipliers = np.array([0.8, 1.0, 1.25])[(blocks * 7 + product_ids) % 3]
+    prices = np.round(base_prices[product_ids] * multipliers).astype(np.int64)
+    keep = rng.random(transactions) < (multipliers / 0.8) ** -1.5
+    completed, product_ids, prices = completed[keep], product_ids[keep] + 1, prices[keep]
+    
+    # Compradores com peso de Zipf: poucos recorrentes, muitos de uma compra só
+    user_ids = np.minimum(rng.zipf(1.3, len(completed)), users)
+    statuses = np.where(rng.random(len(completed)) < 0.02, 'refunded', 'completed')
+    stamps = np.char.replace(np.datetime_as_string(completed.astype('datetime64[s]'), unit='s'), 'T', ' ')
+    
+    with db_manager.connection() as conn:
+        conn.executemany("INSERT INTO users (telegram_id, first_name) VALUES (?, 'bench')",
+                         [(1000000 + user,) for user in range(1, users + 1)])
+        conn.executemany("INSERT INTO products (name, price_stars, file_path) VALUES (?, ?, '/dev/null')",
+                         [(f'Produto {product}', int(price)) for product, price in enumerate(base_prices, 1)])
+        conn.executemany('''
+            INSERT INTO transactions (user_id, product_id, amount_stars, telegram_payment_id, status,
+                                      created_at, completed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', zip(user_ids.tolist(), product_ids.tolist(), prices.tolist(),
+                 (f'bench{index}' for index in range(len(completed))), statuses.tolist(),
+                 stamps.tolist(), stamps.tolist()))
+        
+        # Cerca de 70% das vendas com downloads servidos (1 a 3 eventos)
+        downloaded = rng.random(len(completed)) < 0.7
+        repeats = rng.integers(1, 4, int(downloaded.sum()))
+        event_users = np.repeat(user_ids[downloaded], repeats)
+        event_products = np.repeat(product_ids[downloaded], repeats)
+        event_stamps = np.repeat(stamps[downloaded], repeats)
+        conn.executemany('''
+            INSERT INTO download_events (occurred_at, download_token, user_id, product_id, status)
+            VALUES (?, 'bench', ?, ?, 200)
+        ''', zip(event_stamps.tolist(), event_users.tolist(), event_products.tolist()))
+    return len(completed), len(event_users)
+
+
+def same_elasticity(actual: Dict[int, Any], expected: Dict[int, Any]) -> bool:
+    """Compara as elasticidades (a ordem das somas muda o último dígito)"""
+    if actual.keys() != expected.keys():
+        return False
+    return all((actual[key] is None) == (expected[key] is None)
+               and (actual[key] is None or abs(actual[key] - expected[key]) < 1e-3) for key in actual)
+
+
+def run_benchmark(db_manager, directory: str, repeat: int = 3) -> tuple:
+    """Mede a carga do snapshot e cada métrica em SQL e em NumPy, conferindo se os resultados batem"""
+    engine = analytics.AnalyticsEngine(db_manager, directory=directory, refresh_interval=3600)
+    snapshot = {
+        'build_ms': best_time(lambda: engine.refresh(full=True), 1)[0],
+        'incremental_ms': best_time(engine.refresh, repeat)[0],
+        'rows': engine.get_stats()['transactions']['rows']
+    }
+    rows = []
+    
+    with db_manager.connection() as conn:
+        sql_ms, expected = best_time(lambda: sql_cohorts(conn), repeat)
+        numpy_ms, cohorts = best_time(engine.cohorts, repeat)
+        actual = {}
+        for cohort in cohorts:
+            index = int(analytics.np.datetime64(cohort['cohort'], 'M').astype('int64'))
+            actual.update({(index, age): users for age, users in enumerate(cohort['active']) if users})
+        rows.append({'metric': 'retenção por coorte', 'sql_ms': sql_ms, 'numpy_ms': numpy_ms,
+                     'match': actual == expected})
+        
+        sql_ms, expected = best_time(lambda: sql_heatmap(conn), repeat)
+        numpy_ms, heatmap = best_time(engine.heatmap, repeat)
+        rows.append({'metric': 'heatmap dia x hora', 'sql_ms': sql_ms, 'numpy_ms': numpy_ms,
+                     'match': heatmap['revenue'] == expected['revenue'] and heatmap['sales'] == expected['sales']})
+        
+        sql_ms, expected = best_time(lambda: sql_repeat_buyers(conn), repeat)
+        numpy_ms, repeat_stats = best_time(engine.repeat_buyers, repeat)
+        rows.append({'metric': 'taxa de recompra', 'sql_ms': sql_ms, 'numpy_ms': numpy_ms,
+                     'match': all(repeat_stats[key] == value for key, value in expected.items())})
+        
+        sql_ms, expected = best_time(lambda: sql_elasticity(conn), repeat)
+        numpy_ms, elasticity = best_time(engine.elasticity, repeat)
+        rows.append({'metric': 'elasticidade-preço', 'sql_ms': sql_ms, 'numpy_ms': numpy_ms,
+                     'match': same_elasticity({item['product_id']: item['elasticity'] for item in elasticity},
+                                              expected)})
+        
+        sql_ms, expected = best_time(lambda: sql_downloaded_sales(conn), repeat)
+        numpy_ms, summary = best_time(engine.summary, repeat)
+        rows.append({'metric': 'vendas com download', 'sql_ms': sql_ms, 'numpy_ms': numpy_ms,
+                     'match': all(summary['downloads'][key] == value for key, value in expected.items())})
+    return snapshot, rows
+
+
+def main(argv: List[str] = None) -> int:
+    """Compara as métricas de analytics.py com as consultas SQL equivalentes"""
+    import argparse
+    from database import DatabaseManager
+    
+    parser = argparse.ArgumentParser(description='Benchmark: analytics em NumPy x SQL')
+    parser.add_argument('--db', default=None, help='Banco a medir (padrão: banco sintético temporário)')
+    parser.add_argument('--synthetic', type=int, default=200000, help='Transações do banco sintético')
+    parser.add_argument('--repeat', type=int, default=3, help='Execuções por medida (vale a menor)')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not analytics.AVAILABLE:
+        print("❌ Instale o NumPy: pip install numpy")
+        return 1
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.db:
+            db_manager = DatabaseManager(args.db)
+        else:
+            db_manager = DatabaseManager(os.path.join(workdir, 'bench.db'))
+            started = time.perf_counter()
+            sales, events = populate(db_manager, args.synthetic)
+            print(f"📦 Banco sintético: {sales} vendas e {events} downloads "
+                  f"({time.perf_counter() - started:.1f}s)")
+        
+        snapshot, rows = run_benchmark(db_manager, os.path.join(workdir, 'analytics'), args.repeat)
+        db_manager.close()
+    
+    print(f"🗂️  Snapshot: {snapshot['rows']} transações copiadas em {snapshot['build_ms']:.1f} ms; "
+          f"atualização incremental sem mudanças em {snapshot['incremental_ms']:.1f} ms")
+    
+    print(f"{'métrica':<48} {'SQL (ms)':>10} {'NumPy (ms)':>11} {'ganho':>7}  resultado")
+    for row in rows:
+        speedup = row['sql_ms'] / row['numpy_ms'] if row['numpy_ms'] else float('inf')
+        print(f"{row['metric']:<48} {row['sql_ms']:>10.1f} {row['numpy_ms']:>11.1f} {speedup:>6.1f}x  "
+              f"{'ok' if row['match'] else 'DIFERENTE'}")
+    return 0 if all(row['match'] for row in rows) else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
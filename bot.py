@@ -1,24 +1,463 @@
 import os
+import time
 import logging
 import secrets
-from typing import Optional, List, Dict, Any
+import threading
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime
 import telebot
 from telebot import types
 from database import DatabaseManager
 from payment_processor import PaymentProcessor
+from send_scheduler import scheduled_bot, PRIORITY_PAYMENT, PRIORITY_BULK
+from polling import PollingRunner, ALLOWED_UPDATES
+from dispatcher import LatencyHistogram
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+HELP_TEXT = """
+🆘 **Central de Ajuda**
+
+**Comandos:**
+• `/start` - Iniciar o bot
+• `/catalogo` - Ver vídeos disponíveis
+• `/help` - Esta mensagem de ajuda
+
+**Como comprar:**
+1. Use `/catalogo` para ver os vídeos
+2. Clique em "Comprar" no vídeo desejado
+3. Pague com Telegram Stars ⭐
+4. Receba o link de download
+
+**Sobre os pagamentos:**
+• Pagamentos são processados pelo Telegram
+• Usamos Telegram Stars como moeda
+• Transações são seguras e instantâneas
+
+**Sobre os downloads:**
+• Links válidos por 24 horas
+• Máximo de 3 downloads por compra
+• Vídeos em alta qualidade
+
+**Suporte:**
+Se tiver problemas, entre em contato conosco!
+"""
+
+EMPTY_CATALOG_TEXT = "📭 Ainda não temos vídeos disponíveis. Volte em breve!"
+
+
+# Montagem das mensagens: compartilhada entre o bot síncrono e o assíncrono (async_bot.py)
+
+def build_welcome_text(user) -> str:
+    """Mensagem de boas-vindas do /start"""
+    return f"""
+🎬 **Bem-vindo ao VideoBot!**
+
+Olá {user.first_name}! 👋
+
+Aqui você pode comprar vídeos exclusivos de forma rápida e segura usando Telegram Stars ⭐
+
+**Comandos disponíveis:**
+• /catalogo - Ver todos os vídeos disponíveis
+• /help - Ajuda e suporte
+
+**Como funciona:**
+1. Navegue pelo catálogo
+2. Escolha o vídeo desejado
+3. Pague com Telegram Stars
+4. Receba o link de download instantaneamente
+
+Pronto para começar? Use /catalogo para ver nossos vídeos! 🚀
+"""
+
+
+def build_catalog_header(product_count: int) -> str:
+    """Título das páginas do catálogo"""
+    return f"🎬 **Catálogo de Vídeos** ({product_count} disponíveis)"
+
+
+def build_product_card(product: Dict[str, Any]) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """Texto e teclado do card de um produto"""
+    
+    # Formatação do preço
+    price_text = f"{product['price_stars']} ⭐"
+    
+    # Formatação da duração se disponível
+    duration_text = ""
+    if product.get('duration_seconds'):
+        minutes = product['duration_seconds'] // 60
+        seconds = product['duration_seconds'] % 60
+        duration_text = f"\n⏱️ Duração: {minutes}:{seconds:02d}"
+    
+    # Formatação do tamanho se disponível
+    size_text = ""
+    if product.get('file_size'):
+        size_mb = product['file_size'] / (1024 * 1024)
+        size_text = f"\n📁 Tamanho: {size_mb:.1f} MB"
+    
+    product_text = f"""
+🎬 **{product['name']}**
+
+{product['description'] or 'Vídeo exclusivo de alta qualidade'}{duration_text}{size_text}
+
+💰 Preço: {price_text}
+    """
+    
+    # Keyboard com botão de compra
+    keyboard = types.InlineKeyboardMarkup()
+    buy_button = types.InlineKeyboardButton(
+        f"💳 Comprar por {price_text}",
+        callback_data=f"buy_{product['id']}"
+    )
+    keyboard.add(buy_button)
+    
+    return product_text, keyboard
+
+
+def build_invoice(chat_id: int, product: Dict[str, Any], payload) -> Dict[str, Any]:
+    """Argumentos de send_invoice para a compra de um produto"""
+    
+    # Preços em formato da API (centavos de stars)
+    prices = [types.LabeledPrice(
+        label=product['name'],
+        amount=product['price_stars']
+    )]
+    
+    return dict(
+        chat_id=chat_id,
+        title=product['name'],
+        description=product['description'] or 'Vídeo exclusivo de alta qualidade',
+        invoice_payload=str(payload),  # ID da transação ou payload assinado
+        provider_token="",  # Vazio para produtos digitais
+        currency="XTR",  # Telegram Stars
+        prices=prices,
+        start_parameter=f"buy_{product['id']}",
+        photo_url=None,  # Pode adicionar URL da thumbnail aqui
+        photo_size=None,
+        photo_width=None,
+        photo_height=None,
+        need_name=False,
+        need_phone_number=False,
+        need_email=False,
+        need_shipping_address=False,
+        send_phone_number_to_provider=False,
+        send_email_to_provider=False,
+        is_flexible=False
+    )
+
+
+def pre_checkout_data(query) -> Dict[str, Any]:
+    """Dados do pré-checkout no formato do PaymentProcessor"""
+    return {
+        'id': query.id,
+        'from': {'id': query.from_user.id},
+        'currency': query.currency,
+        'total_amount': query.total_amount,
+        'invoice_payload': query.invoice_payload,
+        'shipping_option_id': query.shipping_option_id,
+        'order_info': query.order_info.to_dict() if query.order_info else None
+    }
+
+
+def successful_payment_data(payment) -> Dict[str, Any]:
+    """Dados do pagamento concluído no formato do PaymentProcessor"""
+    return {
+        'telegram_payment_charge_id': payment.telegram_payment_charge_id,
+        'provider_payment_charge_id': payment.provider_payment_charge_id,
+        'invoice_payload': payment.invoice_payload,
+        'total_amount': payment.total_amount,
+        'currency': payment.currency,
+        'shipping_option_id': payment.shipping_option_id,
+        'order_info': payment.order_info.to_dict() if payment.order_info else None
+    }
+
+
+def build_payment_error_text(payment=None) -> str:
+    """Mensagem de falha no processamento do pagamento"""
+    return ("❌ Erro ao processar pagamento. Entre em contato com o suporte.\n\n"
+            f"ID do pagamento: `{payment.telegram_payment_charge_id if payment else 'N/A'}`")
+
+
+def build_download_confirmation(download_info: Dict[str, Any]) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """Texto e teclado da confirmação de pagamento com link de download"""
+    
+    # Formatação da data de expiração
+    expires_at = datetime.fromisoformat(download_info['expires_at'].replace('Z', '+00:00'))
+    expires_formatted = expires_at.strftime('%d/%m/%Y às %H:%M')
+    
+    success_message = f"""
+✅ **Pagamento confirmado!**
+
+Obrigado pela compra de: **{download_info['product_name']}**
+
+🔗 **Link de download:**
+{download_info['download_url']}
+
+⚠️ **Informações importantes:**
+• Link válido até: {expires_formatted}
+• Máximo de downloads: {download_info['max_downloads']}
+• Downloads utilizados: {download_info.get('download_count', 0)}
+
+💡 **Dica:** Salve o arquivo em local seguro após o download!
+
+Aproveite seu vídeo! 🎬
+    """
+    
+    # Keyboard com botão para o link
+    keyboard = types.InlineKeyboardMarkup()
+    download_button = types.InlineKeyboardButton(
+        "📥 Baixar Vídeo",
+        url=download_info['download_url']
+    )
+    keyboard.add(download_button)
+    
+    return success_message, keyboard
+
+
+def build_video_caption(download_info: Dict[str, Any]) -> str:
+    """Legenda do vídeo entregue diretamente pelo Telegram"""
+    return (f"✅ **Pagamento confirmado!**\n\n"
+            f"Obrigado pela compra de: **{download_info['product_name']}**\n\n"
+            f"Aproveite seu vídeo! 🎬")
+
+
+# Arquivos enviados por file_id: tipo -> (campo com o caminho, método de envio)
+FILE_KINDS = {
+    'thumbnail': ('thumbnail_path', 'send_photo'),
+    'video': ('file_path', 'send_video'),
+}
+
+
+def sent_file_id(message) -> str:
+    """file_id do arquivo de uma mensagem enviada (foto, vídeo ou documento)"""
+    if message.photo:
+        return message.photo[-1].file_id
+    return (message.video or message.document).file_id
+
+
+def delivers_via_telegram(product: Dict[str, Any]) -> bool:
+    """Indica se o vídeo é entregue pelo Telegram (modo do produto ou DELIVERY_MODE) e cabe no limite de upload"""
+    mode = product.get('delivery_mode') or os.getenv('DELIVERY_MODE', 'link')
+    if mode != 'telegram':
+        return False
+    
+    limit = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB', 50)) * 1024 * 1024
+    size = product.get('file_size')
+    if size is None:
+        path = product.get('file_path')
+        size = os.path.getsize(path) if path and os.path.exists(path) else None
+    return size is not None and size <= limit
+
+
+def build_inline_result(product: Dict[str, Any], photo_file_id: Optional[str] = None):
+    """Resultado inline de um produto: foto já enviada (file_id) ou artigo de texto, com botão de compra"""
+    product_text, keyboard = build_product_card(product)
+    description = f"{product['price_stars']} ⭐ · {(product['description'] or '')[:80]}"
+    
+    if photo_file_id:
+        return types.InlineQueryResultCachedPhoto(
+            id=str(product['id']),
+            photo_file_id=photo_file_id,
+            title=product['name'],
+            description=description,
+            caption=product_text,
+            parse_mode='Markdown',
+            reply_markup=keyboard
+        )
+    return types.InlineQueryResultArticle(
+        id=str(product['id']),
+        title=product['name'],
+        input_message_content=types.InputTextMessageContent(product_text, parse_mode='Markdown'),
+        reply_markup=keyboard,
+        description=description
+    )
+
+
+def inline_results(db: DatabaseManager, bot_id: int, text: str, offset: str) -> Tuple[list, str]:
+    """Resultados de uma consulta inline e o next_offset da próxima página ('' = fim)"""
+    start = int(offset) if offset and offset.isdigit() else 0
+    page_size = int(os.getenv('INLINE_PAGE_SIZE', 20))
+    products, has_more = db.search_products(text, page_size, start)
+    
+    results = []
+    for product in products:
+        photo_file_id = None
+        if product.get('thumbnail_path'):
+            photo_file_id = db.get_file_id(bot_id, product['id'], 'thumbnail', product['thumbnail_path'])
+        results.append(build_inline_result(product, photo_file_id))
+    return results, str(start + len(products)) if has_more else ''
+
+
+def purchase_chat_id(call) -> int:
+    """Chat que recebe a fatura: o da mensagem ou, em mensagens inline, o privado do usuário"""
+    return call.message.chat.id if call.message is not None else call.from_user.id
+
+
+def parse_page_callback(data: str) -> Tuple[int, int]:
+    """Extrai (categoria, página) de um callback 'page_<categoria>_<página>'"""
+    _, category, page = data.split('_')
+    return int(category), int(page)
+
+
+def is_not_modified_error(error: Exception) -> bool:
+    """Erro da Bot API ao editar uma mensagem com o mesmo conteúdo (ex.: clique repetido)"""
+    return 'message is not modified' in str(error)
+
+
+def is_invalid_file_id_error(error: Exception) -> bool:
+    """Erro da Bot API para um file_id que não vale mais (ou é de outro bot)"""
+    message = str(error).lower()
+    return any(marker in message for marker in ('file identifier', 'file_id', 'file reference'))
+
+
+def bot_id_from_token(token: str) -> int:
+    """ID numérico do bot (prefixo do token): file_ids só valem para o bot que os gerou"""
+    return int(token.split(':', 1)[0])
+
+
+def admin_ids() -> set:
+    """IDs do Telegram autorizados a usar comandos administrativos (BOT_ADMIN_IDS)"""
+    return {int(value) for value in os.getenv('BOT_ADMIN_IDS', '').split(',') if value.strip()}
+
+
+class PreCheckoutMetrics:
+    """Latência do pré-checkout: validação (em memória) e resposta completa ao Telegram"""
+    
+    def __init__(self):
+        # O Telegram cancela a compra se a resposta não chegar em 10 s
+        self.validation = LatencyHistogram(float(os.getenv('PRE_CHECKOUT_VALIDATION_ALERT_MS', 10)))
+        self.answer = LatencyHistogram(float(os.getenv('PRE_CHECKOUT_ALERT_MS', 1000)))
+    
+    def observe(self, query_id: str, validation: float, answer: float):
+        self.validation.observe(validation)
+        if self.answer.observe(answer):
+            logger.warning(f"Pré-checkout {query_id} respondido em {answer * 1000:.0f} ms "
+                           f"(validação {validation * 1000:.1f} ms, limite {self.answer.alert_ms:.0f} ms)")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna os histogramas de validação e de resposta"""
+        return {'validation': self.validation.get_stats(), 'answer': self.answer.get_stats()}
+
+
+class CatalogPages:
+    """Páginas do catálogo (texto + teclado) montadas uma vez por versão do catálogo"""
+    
+    def __init__(self, db_manager: DatabaseManager, page_size: int = None):
+        self.db = db_manager
+        self.page_size = page_size or int(os.getenv('CATALOG_PAGE_SIZE', 8))
+        
+        self._version = None
+        self._pages: Dict[Tuple[int, int], Tuple[str, types.InlineKeyboardMarkup]] = {}
+        self._page_counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, category: int = 0, page: int = 0) -> Optional[Tuple[str, types.InlineKeyboardMarkup]]:
+        """Texto e teclado da página (None se o catálogo estiver vazio)"""
+        version = self.db.catalog.current_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._rebuild(version)
+        
+        pages, page_counts = self._pages, self._page_counts
+        if category not in page_counts:
+            category = 0
+        if not page_counts.get(category):
+            return None
+        
+        # Callbacks antigos podem apontar para páginas que não existem mais
+        page = min(max(page, 0), page_counts[category] - 1)
+        return pages[(category, page)]
+    
+    def _rebuild(self, version: int):
+        """Monta todas as páginas de todas as categorias para o snapshot atual"""
+        products = self.db.get_active_products()
+        categories = sorted({product.get('category') for product in products} - {None, ''})
+        
+        # Categoria 0 = todos os produtos; as demais seguem a ordem alfabética
+        groups = [('Todos', list(products))] + [
+            (name, [product for product in products if product.get('category') == name])
+            for name in categories
+        ]
+        
+        pages = {}
+        page_counts = {}
+        for index, (name, items) in enumerate(groups):
+            chunks = [items[i:i + self.page_size] for i in range(0, len(items), self.page_size)]
+            page_counts[index] = len(chunks)
+            for page, chunk in enumerate(chunks):
+                pages[(index, page)] = self._build_page(groups, index, page, len(chunks), chunk, len(products))
+        
+        self._pages = pages
+        self._page_counts = page_counts
+        self._version = version
+        logger.debug(f"Catálogo paginado: {len(pages)} páginas (versão {version})")
+    
+    @staticmethod
+    def _build_page(groups, category: int, page: int, page_count: int,
+                    chunk: List[Dict[str, Any]], total: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+        lines = [build_catalog_header(total)]
+        if category:
+            lines.append(f"📂 Categoria: {groups[category][0]}")
+        lines.append(f"Página {page + 1}/{page_count}\n")
+        
+        keyboard = types.InlineKeyboardMarkup()
+        for product in chunk:
+            duration_text = ""
+            if product.get('duration_seconds'):
+                minutes, seconds = divmod(product['duration_seconds'], 60)
+                duration_text = f" · ⏱️ {minutes}:{seconds:02d}"
+            lines.append(f"🎬 **{product['name']}** — {product['price_stars']} ⭐{duration_text}")
+            keyboard.row(
+                types.InlineKeyboardButton(
+                    f"💳 {product['name']} — {product['price_stars']} ⭐",
+                    callback_data=f"buy_{product['id']}"
+                ),
+                types.InlineKeyboardButton("ℹ️", callback_data=f"info_{product['id']}")
+            )
+        lines.append("\nToque em um vídeo para comprar ou em ℹ️ para ver os detalhes:")
+        
+        # Navegação entre páginas
+        if page_count > 1:
+            keyboard.row(
+                types.InlineKeyboardButton(
+                    "◀️", callback_data=f"page_{category}_{(page - 1) % page_count}"),
+                types.InlineKeyboardButton(
+                    f"{page + 1}/{page_count}", callback_data=f"page_{category}_{page}"),
+                types.InlineKeyboardButton(
+                    "▶️", callback_data=f"page_{category}_{(page + 1) % page_count}")
+            )
+        
+        # Filtro por categoria (só aparece se houver categorias cadastradas)
+        if len(groups) > 1:
+            buttons = [
+                types.InlineKeyboardButton(
+                    f"• {name}" if index == category else name,
+                    callback_data=f"page_{index}_0"
+                )
+                for index, (name, _) in enumerate(groups)
+            ]
+            for i in range(0, len(buttons), 3):
+                keyboard.row(*buttons[i:i + 3])
+        
+        return '\n'.join(lines), keyboard
+
+
 class TelegramVideoBot:
     """Bot principal para vendas de vídeos no Telegram"""
     
-    def __init__(self, token: str, db_manager: DatabaseManager):
-        self.bot = telebot.TeleBot(token)
+    def __init__(self, token: str, db_manager: DatabaseManager, threaded: bool = True):
+        # threaded=False: handlers rodam na thread que entrega o update (ex.: UpdateDispatcher)
+        # Envios passam pelo SendScheduler (limites da Bot API e prioridade de pagamentos)
+        self.bot = scheduled_bot(telebot.TeleBot(token, threaded=threaded))
         self.db = db_manager
         self.payment_processor = PaymentProcessor(db_manager, token)
+        self.catalog_pages = CatalogPages(db_manager)
+        self.bot_id = bot_id_from_token(token)
+        self.polling: Optional[PollingRunner] = None
+        self.pre_checkout_metrics = PreCheckoutMetrics()
         self.setup_handlers()
     
     def setup_handlers(self):
@@ -36,6 +475,14 @@ class TelegramVideoBot:
         def handle_catalog(message):
             self.handle_catalog_command(message)
         
+        @self.bot.message_handler(commands=['warmup'])
+        def handle_warmup(message):
+            self.handle_warmup_command(message)
+        
+        @self.bot.inline_handler(func=lambda query: True)
+        def handle_inline(query):
+            self.handle_inline_query(query)
+        
         @self.bot.callback_query_handler(func=lambda call: True)
         def handle_callback(call):
             self.handle_callback_query(call)
@@ -52,144 +499,81 @@ class TelegramVideoBot:
         """Handler para comando /start"""
         user = message.from_user
         
-        # Buscar ou criar usuário no banco
-        db_user = self.db.get_user_by_telegram_id(user.id)
-        if not db_user:
-            self.db.create_user(
-                telegram_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-            logger.info(f"Novo usuário criado: {user.id} (@{user.username})")
-        
-        welcome_text = f"""
-🎬 **Bem-vindo ao VideoBot!**
-
-Olá {user.first_name}! 👋
-
-Aqui você pode comprar vídeos exclusivos de forma rápida e segura usando Telegram Stars ⭐
-
-**Comandos disponíveis:**
-• /catalogo - Ver todos os vídeos disponíveis
-• /help - Ajuda e suporte
-
-**Como funciona:**
-1. Navegue pelo catálogo
-2. Escolha o vídeo desejado
-3. Pague com Telegram Stars
-4. Receba o link de download instantaneamente
-
-Pronto para começar? Use /catalogo para ver nossos vídeos! 🚀
-        """
+        # Criar ou atualizar usuário no banco (uma consulta; nenhuma se já conhecido)
+        self.db.upsert_user(
+            telegram_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
         
         self.bot.send_message(
-            message.chat.id, 
-            welcome_text, 
+            message.chat.id,
+            build_welcome_text(user),
             parse_mode='Markdown'
         )
     
     def handle_help_command(self, message):
         """Handler para comando /help"""
-        help_text = """
-🆘 **Central de Ajuda**
-
-**Comandos:**
-• `/start` - Iniciar o bot
-• `/catalogo` - Ver vídeos disponíveis
-• `/help` - Esta mensagem de ajuda
-
-**Como comprar:**
-1. Use `/catalogo` para ver os vídeos
-2. Clique em "Comprar" no vídeo desejado
-3. Pague com Telegram Stars ⭐
-4. Receba o link de download
-
-**Sobre os pagamentos:**
-• Pagamentos são processados pelo Telegram
-• Usamos Telegram Stars como moeda
-• Transações são seguras e instantâneas
-
-**Sobre os downloads:**
-• Links válidos por 24 horas
-• Máximo de 3 downloads por compra
-• Vídeos em alta qualidade
-
-**Suporte:**
-Se tiver problemas, entre em contato conosco!
-        """
-        
         self.bot.send_message(
             message.chat.id,
-            help_text,
+            HELP_TEXT,
             parse_mode='Markdown'
         )
     
     def handle_catalog_command(self, message):
         """Handler para comando /catalogo"""
-        products = self.db.get_active_products()
+        # Uma única mensagem paginada; a navegação edita essa mesma mensagem
+        page = self.catalog_pages.get()
         
-        if not products:
-            self.bot.send_message(
-                message.chat.id,
-                "📭 Ainda não temos vídeos disponíveis. Volte em breve!"
-            )
+        if page is None:
+            self.bot.send_message(message.chat.id, EMPTY_CATALOG_TEXT)
             return
         
-        self.bot.send_message(
-            message.chat.id,
-            f"🎬 **Catálogo de Vídeos** ({len(products)} disponíveis)\n\nEscolha um vídeo abaixo:",
-            parse_mode='Markdown'
-        )
-        
-        for product in products:
-            self.send_product_card(message.chat.id, product)
+        text, keyboard = page
+        self.bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=keyboard)
     
-    def send_product_card(self, chat_id: int, product: Dict[str, Any]):
-        """Envia card do produto com botão de compra"""
-        
-        # Formatação do preço
-        price_text = f"{product['price_stars']} ⭐"
+    def show_catalog_page(self, call, category: int, page: int):
+        """Troca a página exibida editando a mensagem do catálogo"""
+        result = self.catalog_pages.get(category, page)
+        if result is None:
+            self.bot.edit_message_text(EMPTY_CATALOG_TEXT, call.message.chat.id, call.message.message_id)
+            return
         
-        # Formatação da duração se disponível
-        duration_text = ""
-        if product.get('duration_seconds'):
-            minutes = product['duration_seconds'] // 60
-            seconds = product['duration_seconds'] % 60
-            duration_text = f"\n⏱️ Duração: {minutes}:{seconds:02d}"
+        text, keyboard = result
+        try:
+            self.bot.edit_message_text(
+                text,
+                call.message.chat.id,
+                call.message.message_id,
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
+        except telebot.apihelper.ApiTelegramException as e:
+            if not is_not_modified_error(e):
+                raise
+    
+    def send_product_details(self, call, product_id: int):
+        """Envia o card do produto com a thumbnail (file_id em cache; upload só na primeira vez)"""
+        product = self.db.get_product_by_id(product_id)
         
-        # Formatação do tamanho se disponível
-        size_text = ""
-        if product.get('file_size'):
-            size_mb = product['file_size'] / (1024 * 1024)
-            size_text = f"\n📁 Tamanho: {size_mb:.1f} MB"
+        if not product:
+            self.bot.answer_callback_query(call.id, "Produto não encontrado!")
+            return
         
-        product_text = f"""
-🎬 **{product['name']}**
-
-{product['description'] or 'Vídeo exclusivo de alta qualidade'}{duration_text}{size_text}
-
-💰 Preço: {price_text}
-        """
+        product_text, keyboard = build_product_card(product)
+        chat_id = purchase_chat_id(call)
         
-        # Keyboard com botão de compra
-        keyboard = types.InlineKeyboardMarkup()
-        buy_button = types.InlineKeyboardButton(
-            f"💳 Comprar por {price_text}",
-            callback_data=f"buy_{product['id']}"
-        )
-        keyboard.add(buy_button)
-        
-        # Enviar thumbnail se disponível
-        if product.get('thumbnail_path') and os.path.exists(product['thumbnail_path']):
-            with open(product['thumbnail_path'], 'rb') as photo:
-                self.bot.send_photo(
-                    chat_id,
-                    photo,
-                    caption=product_text,
-                    parse_mode='Markdown',
-                    reply_markup=keyboard
-                )
+        path = product.get('thumbnail_path')
+        if path and os.path.exists(path):
+            self.send_cached_file(
+                chat_id,
+                product,
+                'thumbnail',
+                caption=product_text,
+                parse_mode='Markdown',
+                reply_markup=keyboard
+            )
         else:
             self.bot.send_message(
                 chat_id,
@@ -198,16 +582,95 @@ Se tiver problemas, entre em contato conosco!
                 reply_markup=keyboard
             )
     
+    def send_cached_file(self, chat_id: int, product: Dict[str, Any], kind: str, **kwargs):
+        """Envia o arquivo pelo file_id já conhecido; só faz upload na primeira vez (ou se o id for recusado)"""
+        path_field, method = FILE_KINDS[kind]
+        path = product[path_field]
+        send = getattr(self.bot, method)
+        
+        file_id = self.db.get_file_id(self.bot_id, product['id'], kind, path)
+        if file_id:
+            try:
+                return send(chat_id, file_id, **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if not is_invalid_file_id_error(e):
+                    raise
+                logger.warning(f"file_id ({kind}) do produto {product['id']} recusado: {e}")
+                self.db.forget_file_id(self.bot_id, product['id'], kind)
+        
+        with open(path, 'rb') as f:
+            message = send(chat_id, f, **kwargs)
+        self.db.save_file_id(self.bot_id, product['id'], kind, sent_file_id(message), path)
+        return message
+    
+    def handle_warmup_command(self, message):
+        """Handler para /warmup: pré-envia thumbnails e vídeos para este chat (só administradores)"""
+        if message.from_user.id not in admin_ids():
+            return
+        
+        self.bot.send_message(message.chat.id, "⏳ Enviando arquivos para o cache de file_ids...")
+        result = self.warm_up_file_ids(message.chat.id)
+        self.bot.send_message(
+            message.chat.id,
+            f"✅ Cache aquecido: {result['uploaded']} enviadas, {result['cached']} já em cache, "
+            f"{result['failed']} com erro"
+        )
+    
+    def warm_up_file_ids(self, chat_id: int) -> Dict[str, int]:
+        """Faz upload de todo arquivo ainda sem file_id para um chat privado e apaga as mensagens"""
+        result = {'uploaded': 0, 'cached': 0, 'failed': 0}
+        
+        for product in self.db.get_active_products():
+            # Vídeos só dos produtos entregues pelo Telegram
+            kinds = ['thumbnail', 'video'] if delivers_via_telegram(product) else ['thumbnail']
+            for kind in kinds:
+                path = product.get(FILE_KINDS[kind][0])
+                if not path or not os.path.exists(path):
+                    continue
+                if self.db.get_file_id(self.bot_id, product['id'], kind, path):
+                    result['cached'] += 1
+                    continue
+                
+                try:
+                    sent = self.send_cached_file(chat_id, product, kind, disable_notification=True,
+                                                 priority=PRIORITY_BULK)
+                    self.bot.delete_message(chat_id, sent.message_id, priority=PRIORITY_BULK)
+                    result['uploaded'] += 1
+                except Exception as e:
+                    logger.error(f"Erro ao pré-enviar {kind} do produto {product['id']}: {e}")
+                    result['failed'] += 1
+        
+        logger.info(f"Aquecimento de file_ids concluído: {result}")
+        return result
+    
+    def handle_inline_query(self, query):
+        """Handler para buscas inline (@bot termo)"""
+        try:
+            results, next_offset = inline_results(self.db, self.bot_id, query.query, query.offset)
+            self.bot.answer_inline_query(
+                query.id,
+                results,
+                cache_time=int(os.getenv('INLINE_CACHE_TIME', 60)),
+                next_offset=next_offset
+            )
+        except Exception as e:
+            logger.error(f"Erro na busca inline: {e}")
+    
     def handle_callback_query(self, call):
         """Handler para callback queries (botões inline)"""
         try:
             if call.data.startswith('buy_'):
                 product_id = int(call.data.split('_')[1])
                 self.process_purchase_request(call, product_id)
+            elif call.data.startswith('info_'):
+                product_id = int(call.data.split('_')[1])
+                self.send_product_details(call, product_id)
+            elif call.data.startswith('page_'):
+                self.show_catalog_page(call, *parse_page_callback(call.data))
             
             # Responder ao callback para remover loading
             self.bot.answer_callback_query(call.id)
-            
+        
         except Exception as e:
             logger.error(f"Erro no callback query: {e}")
             self.bot.answer_callback_query(call.id, "Erro interno. Tente novamente.")
@@ -221,17 +684,19 @@ Se tiver problemas, entre em contato conosco!
             self.bot.answer_callback_query(call.id, "Produto não encontrado!")
             return
         
+        # Fatura assinada: nenhuma escrita no banco até o pagamento
+        if self.payment_processor.signed_invoices:
+            payload = self.payment_processor.create_invoice_payload(user.id, product)
+            self.send_invoice(purchase_chat_id(call), product, payload)
+            return
+        
         # Buscar ou criar usuário
-        db_user = self.db.get_user_by_telegram_id(user.id)
-        if not db_user:
-            user_id = self.db.create_user(
-                telegram_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-        else:
-            user_id = db_user['id']
+        user_id = self.db.upsert_user(
+            telegram_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
         
         # Criar transação
         transaction_id = self.db.create_transaction(
@@ -241,65 +706,33 @@ Se tiver problemas, entre em contato conosco!
         )
         
         # Criar fatura
-        self.send_invoice(call.message.chat.id, product, transaction_id)
+        self.send_invoice(purchase_chat_id(call), product, transaction_id)
     
-    def send_invoice(self, chat_id: int, product: Dict[str, Any], transaction_id: int):
-        """Envia fatura para pagamento"""
-        
-        # Preços em formato da API (centavos de stars)
-        prices = [types.LabeledPrice(
-            label=product['name'],
-            amount=product['price_stars']
-        )]
-        
-        self.bot.send_invoice(
-            chat_id=chat_id,
-            title=product['name'],
-            description=product['description'] or 'Vídeo exclusivo de alta qualidade',
-            invoice_payload=str(transaction_id),  # ID da transação como payload
-            provider_token="",  # Vazio para produtos digitais
-            currency="XTR",  # Telegram Stars
-            prices=prices,
-            start_parameter=f"buy_{product['id']}",
-            photo_url=None,  # Pode adicionar URL da thumbnail aqui
-            photo_size=None,
-            photo_width=None,
-            photo_height=None,
-            need_name=False,
-            need_phone_number=False,
-            need_email=False,
-            need_shipping_address=False,
-            send_phone_number_to_provider=False,
-            send_email_to_provider=False,
-            is_flexible=False
-        )
+    def send_invoice(self, chat_id: int, product: Dict[str, Any], payload):
+        """Envia fatura para pagamento (payload = ID da transação ou payload assinado)"""
+        self.bot.send_invoice(**build_invoice(chat_id, product, payload), priority=PRIORITY_PAYMENT)
     
     def handle_pre_checkout_query(self, query):
-        """Handler para validação de pré-checkout"""
+        """Handler para validação de pré-checkout (roda nos workers de pagamento do dispatcher)"""
+        started = time.perf_counter()
         try:
             # Usar o processador de pagamentos para validação
-            result = self.payment_processor.process_pre_checkout({
-                'id': query.id,
-                'from': query.from_user.to_dict(),
-                'currency': query.currency,
-                'total_amount': query.total_amount,
-                'invoice_payload': query.invoice_payload,
-                'shipping_option_id': query.shipping_option_id,
-                'order_info': query.order_info.to_dict() if query.order_info else None
-            })
+            result = self.payment_processor.process_pre_checkout(pre_checkout_data(query))
+            validated = time.perf_counter()
             
-            # Responder ao Telegram
+            # Responder ao Telegram (fora do escalonador de envios: não espera atrás de nenhum envio)
             self.bot.answer_pre_checkout_query(
                 query.id,
                 ok=result['ok'],
                 error_message=result.get('error_message')
             )
+            self.pre_checkout_metrics.observe(query.id, validated - started, time.perf_counter() - started)
             
             if result['ok']:
                 logger.info(f"Pré-checkout aprovado para transação {query.invoice_payload}")
             else:
                 logger.warning(f"Pré-checkout rejeitado: {result.get('error_message')}")
-            
+        
         except Exception as e:
             logger.error(f"Erro no pré-checkout: {e}")
             self.bot.answer_pre_checkout_query(
@@ -310,96 +743,104 @@ Se tiver problemas, entre em contato conosco!
     
     def handle_successful_payment_message(self, message):
         """Handler para pagamento bem-sucedido"""
+        payment = None
         try:
             payment = message.successful_payment
             user = message.from_user
             
-            # Preparar dados do pagamento
-            payment_data = {
-                'telegram_payment_charge_id': payment.telegram_payment_charge_id,
-                'provider_payment_charge_id': payment.provider_payment_charge_id,
-                'invoice_payload': payment.invoice_payload,
-                'total_amount': payment.total_amount,
-                'currency': payment.currency,
-                'shipping_option_id': payment.shipping_option_id,
-                'order_info': payment.order_info.to_dict() if payment.order_info else None
-            }
-            
             # Processar pagamento
             download_info = self.payment_processor.process_successful_payment(
-                payment_data, 
+                successful_payment_data(payment),
                 user.id
             )
             
             # Enviar confirmação com link de download
-            self.send_download_confirmation(message.chat.id, download_info)
+            self.deliver_purchase(message.chat.id, download_info)
             
             logger.info(f"Pagamento processado com sucesso: {payment.telegram_payment_charge_id}")
-            
+        
         except Exception as e:
             logger.error(f"Erro ao processar pagamento: {e}")
             self.bot.send_message(
                 message.chat.id,
-                "❌ Erro ao processar pagamento. Entre em contato com o suporte.\n\n"
-                f"ID do pagamento: `{payment.telegram_payment_charge_id if 'payment' in locals() else 'N/A'}`",
-                parse_mode='Markdown'
+                build_payment_error_text(payment),
+                parse_mode='Markdown',
+                priority=PRIORITY_PAYMENT
             )
     
+    def deliver_purchase(self, chat_id: int, download_info: Dict[str, Any]):
+        """Entrega a compra: o próprio vídeo pelo Telegram (se configurado) ou o link de download"""
+        product = self.db.get_product_by_id(download_info['product_id'])
+        if product and delivers_via_telegram(product):
+            try:
+                self.send_cached_file(
+                    chat_id,
+                    product,
+                    'video',
+                    caption=build_video_caption(download_info),
+                    parse_mode='Markdown',
+                    protect_content=True,
+                    supports_streaming=True,
+                    priority=PRIORITY_PAYMENT
+                )
+                return
+            except Exception as e:
+                logger.error(f"Erro ao entregar vídeo pelo Telegram, enviando link: {e}")
+        
+        self.send_download_confirmation(chat_id, download_info)
+    
     def send_download_confirmation(self, chat_id: int, download_info: Dict[str, Any]):
         """Envia confirmação de pagamento com link de download"""
-        
-        # Formatação da data de expiração
-        from datetime import datetime
-        expires_at = datetime.fromisoformat(download_info['expires_at'].replace('Z', '+00:00'))
-        expires_formatted = expires_at.strftime('%d/%m/%Y às %H:%M')
-        
-        success_message = f"""
-✅ **Pagamento confirmado!**
-
-Obrigado pela compra de: **{download_info['product_name']}**
-
-🔗 **Link de download:**
-{download_info['download_url']}
-
-⚠️ **Informações importantes:**
-• Link válido até: {expires_formatted}
-• Máximo de downloads: {download_info['max_downloads']}
-• Downloads utilizados: {download_info.get('download_count', 0)}
-
-💡 **Dica:** Salve o arquivo em local seguro após o download!
-
-Aproveite seu vídeo! 🎬
-        """
-        
-        # Keyboard com botão para o link
-        keyboard = types.InlineKeyboardMarkup()
-        download_button = types.InlineKeyboardButton(
-            "📥 Baixar Vídeo",
-            url=download_info['download_url']
-        )
-        keyboard.add(download_button)
+        success_message, keyboard = build_download_confirmation(download_info)
         
         self.bot.send_message(
             chat_id,
             success_message,
             parse_mode='Markdown',
-            reply_markup=keyboard
+            reply_markup=keyboard,
+            priority=PRIORITY_PAYMENT
         )
     
+    def process_update(self, update: types.Update):
+        """Processa um update recebido pelo webhook"""
+        self.bot.process_new_updates([update])
+    
+    def handle_update(self, update: types.Update):
+        """Processa um update até o fim (usado pelos workers do UpdateDispatcher)"""
+        self.bot.process_new_updates([update])
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna o tipo de runtime e o estado do escalonador de envios"""
+        scheduler = self.bot.scheduler
+        return {
+            'runtime': 'sync',
+            'send_scheduler': scheduler.get_stats() if scheduler else None,
+            'polling': self.polling.get_stats() if self.polling else None,
+            'pre_checkout': {
+                **self.pre_checkout_metrics.get_stats(),
+                'pending_cache': self.db.get_pending_cache_stats()
+            }
+        }
+    
     def start_polling(self):
-        """Inicia o bot em modo polling"""
+        """Inicia o bot em modo polling (offset persistido no banco, workers com ordem por chat)"""
         logger.info("Bot iniciado em modo polling")
-        self.bot.infinity_polling()
+        self.polling = PollingRunner(self)
+        self.polling.run()
     
-    def set_webhook(self, webhook_url: str):
-        """Configura webhook para o bot"""
-        self.bot.set_webhook(webhook_url)
+    def set_webhook(self, webhook_url: str, secret_token: Optional[str] = None):
+        """Configura webhook para o bot (secret_token volta no header X-Telegram-Bot-Api-Secret-Token)"""
+        self.bot.set_webhook(webhook_url, secret_token=secret_token, allowed_updates=ALLOWED_UPDATES)
         logger.info(f"Webhook configurado: {webhook_url}")
 
 
 # Função para inicializar o bot
-def create_bot(token: str, db_path: str = "bot_database.db") -> TelegramVideoBot:
-    """Cria e configura o bot"""
-    db_manager = DatabaseManager(db_path)
-    return TelegramVideoBot(token, db_manager)
-
+def create_bot(token: str, db_path: str = "bot_database.db",
+               db_manager: Optional[DatabaseManager] = None, threaded: bool = True):
+    """Cria e configura o bot (BOT_ASYNC=true usa o runtime asyncio; reaproveita o db_manager se informado)"""
+    if db_manager is None:
+        db_manager = DatabaseManager(db_path)
+    if os.getenv('BOT_ASYNC', 'false').lower() == 'true':
+        from async_bot import AsyncTelegramVideoBot
+        return AsyncTelegramVideoBot(token, db_manager)
+    return TelegramVideoBot(token, db_manager, threaded=threaded)
@@ -0,0 +1,34 @@
+import os
+import time
+from typing import Dict, Any
+
+import requests
+
+
+def api_base_url(api_url: str = None) -> str:
+    """URL base da Bot API (TELEGRAM_API_URL permite um servidor local ou de testes)"""
+    return (api_url or os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')).rstrip('/')
+
+
+class BotApiError(Exception):
+    """Resposta de erro da Bot API (ok=false)"""
+    
+    def __init__(self, method: str, result: Dict[str, Any]):
+        super().__init__(f"{method}: {result.get('error_code')} {result.get('description')}")
+        self.error_code = result.get('error_code')
+        self.result_json = result
+
+
+def call_bot_api(session: requests.Session, api_url: str, token: str, method: str,
+                 params: Dict[str, Any], timeout: float = 30, max_retries: int = 3) -> Any:
+    """Chama um método da Bot API (respeitando o retry_after de um 429) e devolve o 'result'"""
+    for attempt in range(max_retries + 1):
+        response = session.post(f"{api_url}/bot{token}/{method}", json=params, timeout=timeout)
+        result = response.json()
+        if result.get('ok'):
+            return result['result']
+        
+        retry_after = (result.get('parameters') or {}).get('retry_after')
+        if result.get('error_code') != 429 or retry_after is None or attempt == max_retries:
+            raise BotApiError(method, result)
+        time.sleep(retry_after)
@@ -0,0 +1,227 @@
+import os
+import time
+import logging
+import secrets
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Optional, Dict, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Cache LRU limitado e thread-safe, com expiração (TTL) opcional por entrada"""
+    
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Contadores expostos em get_stats()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+    
+    def get(self, key, default=None):
+        """Retorna o valor (e o marca como recente) ou default se ausente/expirado"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._misses += 1
+                return default
+            
+            value, deadline = item
+            if deadline is not None and deadline <= time.monotonic():
+                del self._data[key]
+                self._expirations += 1
+                self._misses += 1
+                return default
+            
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+    
+    def put(self, key, value, ttl: float = None):
+        """Insere ou substitui uma entrada; ttl sobrepõe o padrão do cache"""
+        ttl = self.ttl if ttl is None else ttl
+        deadline = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, deadline)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._evictions += 1
+    
+    def update(self, key, func) -> bool:
+        """Aplica func ao valor de uma entrada existente, mantendo sua expiração"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False
+            self._data[key] = (func(item[0]), item[1])
+            return True
+    
+    def discard(self, key):
+        """Remove a entrada, se existir"""
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def clear(self):
+        """Remove todas as entradas"""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores de acerto, falha e remoção"""
+        lookups = self._hits + self._misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups, 4) if lookups else 0,
+            'evictions': self._evictions,
+            'expirations': self._expirations
+        }
+
+
+class ProductRecord(Mapping):
+    """Registro imutável e compacto de produto (valores numa tupla, chaves compartilhadas)"""
+    
+    __slots__ = ('_index', '_values')
+    
+    def __init__(self, index: Dict[str, int], values: Tuple[Any, ...]):
+        self._index = index
+        self._values = values
+    
+    def __getitem__(self, key: str) -> Any:
+        return self._values[self._index[key]]
+    
+    def __iter__(self):
+        return iter(self._index)
+    
+    def __len__(self) -> int:
+        return len(self._values)
+    
+    def __repr__(self) -> str:
+        return f"ProductRecord({dict(self)!r})"
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Cópia mutável do registro (para JSON ou edição)"""
+        return dict(zip(self._index, self._values))
+
+
+class CatalogCache:
+    """Cache em memória do catálogo de produtos ativos, com versão e invalidação entre processos"""
+    
+    def __init__(self, db_manager, check_interval_ms: int = None):
+        self.db = db_manager
+        self.stamp_path = f"{db_manager.db_path}.catalog"
+        self.check_interval = (check_interval_ms if check_interval_ms is not None
+                               else int(os.getenv('CATALOG_CHECK_INTERVAL_MS', 500))) / 1000
+        
+        self.version = 0
+        self._products: Tuple[ProductRecord, ...] = ()
+        self._by_id: Dict[int, ProductRecord] = {}
+        self._loaded = False
+        self._stamp = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        
+        # Contadores expostos em get_stats()
+        self._reads = 0
+        self._loads = 0
+        self._invalidations = 0
+    
+    def _read_stamp(self) -> Optional[Tuple[int, int, int]]:
+        """Assinatura do arquivo-marcador escrito a cada alteração do catálogo"""
+        try:
+            st = os.stat(self.stamp_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def _ensure_fresh(self):
+        """Recarrega o catálogo se foi invalidado aqui ou em outro processo"""
+        now = time.monotonic()
+        if self._loaded and now < self._next_check:
+            return
+        
+        with self._lock:
+            if self._loaded and now < self._next_check:
+                return
+            stamp = self._read_stamp()
+            if not self._loaded or stamp != self._stamp:
+                self._reload()
+                self._stamp = stamp
+            self._next_check = now + self.check_interval
+    
+    def _reload(self):
+        """Lê os produtos ativos do banco e troca o snapshot de uma vez"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM products
+                WHERE is_active = 1
+                ORDER BY created_at DESC
+            ''')
+            rows = cursor.fetchall()
+            columns = [col[0] for col in cursor.description]
+        
+        index = {name: i for i, name in enumerate(columns)}
+        products = tuple(ProductRecord(index, tuple(row)) for row in rows)
+        
+        self._products = products
+        self._by_id = {product['id']: product for product in products}
+        self._loaded = True
+        self._loads += 1
+        self.version += 1
+        logger.debug(f"Catálogo recarregado: {len(products)} produtos (versão {self.version})")
+    
+    def active_products(self) -> Tuple[ProductRecord, ...]:
+        """Produtos ativos, mais recentes primeiro"""
+        self._ensure_fresh()
+        self._reads += 1
+        return self._products
+    
+    def get(self, product_id: int) -> Optional[ProductRecord]:
+        """Produto ativo pelo ID"""
+        self._ensure_fresh()
+        self._reads += 1
+        return self._by_id.get(product_id)
+    
+    def current_version(self) -> int:
+        """Versão do snapshot atual (muda a cada recarga)"""
+        self._ensure_fresh()
+        return self.version
+    
+    def invalidate(self):
+        """Descarta o snapshot local e sinaliza os demais processos"""
+        with self._lock:
+            self._loaded = False
+            self._invalidations += 1
+        
+        try:
+            # Arquivo novo a cada sinal: muda inode e mtime mesmo em sistemas de baixa resolução
+            tmp_path = f"{self.stamp_path}.{secrets.token_hex(4)}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(secrets.token_hex(8))
+            os.replace(tmp_path, self.stamp_path)
+        except OSError as e:
+            logger.warning(f"Não foi possível sinalizar invalidação do catálogo: {e}")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores do cache do catálogo"""
+        return {
+            'version': self.version,
+            'products': len(self._products),
+            'reads': self._reads,
+            'loads': self._loads,
+            'invalidations': self._invalidations
+        }
@@ -1,181 +1,888 @@
 import os
+import re
+import time
+import queue
+import atexit
 import sqlite3
 import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
+import rollups
+from download_events import DownloadEventLog
+from migrations import apply_migrations, LATEST_VERSION
+from cache import CatalogCache, ProductRecord, LRUCache
+from search import ProductSearch
 
-class DatabaseManager:
-    """Gerenciador do banco de dados SQLite"""
+# Formato dos tokens gerados por secrets.token_urlsafe (com folga de tamanho)
+DOWNLOAD_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,128}$')
+
+# Arquivos já migrados neste processo (evita repetir a checagem a cada instância)
+_migrated_paths = set()
+_migrated_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Pool de conexões SQLite de longa duração (uma conexão por thread em uso)"""
     
-    def __init__(self, db_path: str = "bot_database.db"):
+    def __init__(self, db_path: str, max_size: int = None, timeout: float = 30.0):
         self.db_path = db_path
-        self.init_database()
+        self.max_size = max_size or int(os.getenv('DB_POOL_SIZE', 8))
+        self.timeout = timeout
+        self.mmap_size = int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024))
+        self.cache_size_kb = int(os.getenv('DB_CACHE_SIZE_KB', 16384))
+        
+        self._idle: List[sqlite3.Connection] = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        
+        # Contadores expostos em get_stats()
+        self._created = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
     
-    def init_database(self):
-        """Inicializa o banco de dados com as tabelas necessárias"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+    def _connect(self) -> sqlite3.Connection:
+        """Abre uma nova conexão já com os pragmas de desempenho aplicados"""
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        cursor.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+        return conn
+    
+    def _acquire(self) -> sqlite3.Connection:
+        """Retira uma conexão do pool, criando ou aguardando se necessário"""
+        with self._cond:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Pool de conexões fechado")
             
-            # Tabela de usuários
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    telegram_id INTEGER UNIQUE NOT NULL,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1
-                )
-            ''')
+            if not self._idle and self._size >= self.max_size:
+                started = time.monotonic()
+                deadline = started + self.timeout
+                self._waits += 1
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        self._timeouts += 1
+                        raise sqlite3.OperationalError("Tempo esgotado aguardando conexão do pool")
+                    self._cond.wait(remaining)
+                waited = time.monotonic() - started
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
             
-            # Tabela de produtos (vídeos)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    price_stars INTEGER NOT NULL,
-                    file_path TEXT NOT NULL,
-                    thumbnail_path TEXT,
-                    file_size INTEGER,
-                    duration_seconds INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT 1
-                )
-            ''')
-            
-            # Tabela de transações
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    product_id INTEGER NOT NULL,
-                    amount_stars INTEGER NOT NULL,
-                    telegram_payment_id TEXT UNIQUE,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (product_id) REFERENCES products (id)
-                )
-            ''')
+            self._checkouts += 1
+            if self._idle:
+                return self._idle.pop()
             
-            # Tabela de downloads/acessos
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS downloads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    transaction_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    product_id INTEGER NOT NULL,
-                    download_token TEXT UNIQUE NOT NULL,
-                    download_count INTEGER DEFAULT 0,
-                    max_downloads INTEGER DEFAULT 3,
-                    last_access TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (transaction_id) REFERENCES transactions (id),
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (product_id) REFERENCES products (id)
-                )
-            ''')
+            # Reservar a vaga antes de conectar fora do lock
+            self._size += 1
+        
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        
+        with self._cond:
+            self._created += 1
+        return conn
+    
+    def _release(self, conn: sqlite3.Connection):
+        """Devolve a conexão ao pool"""
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+    
+    def _discard(self, conn: sqlite3.Connection):
+        """Descarta uma conexão com problema, liberando a vaga"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    @contextmanager
+    def connection(self):
+        """Conexão da thread atual; commit ao sair do bloco mais externo, rollback em erro"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None:
+            # Uso aninhado na mesma thread: reaproveita a conexão e a transação externa
+            yield holder
+            return
+        
+        conn = self._acquire()
+        self._local.holder = conn
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error:
+                self._local.holder = None
+                self._discard(conn)
+                raise
+            self._local.holder = None
+            self._release(conn)
+            raise
+        else:
+            self._local.holder = None
+            self._release(conn)
+    
+    def in_connection(self) -> bool:
+        """Indica se a thread atual já está dentro de um bloco connection()"""
+        return getattr(self._local, 'holder', None) is not None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores de tamanho e espera do pool"""
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'created': self._created,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'wait_time_total_ms': round(self._wait_time_total * 1000, 3),
+                'wait_time_max_ms': round(self._wait_time_max * 1000, 3)
+            }
+    
+    def close(self):
+        """Fecha as conexões ociosas; as em uso são fechadas ao serem devolvidas"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+            self._cond.notify_all()
+
+
+class GroupCommitWriter:
+    """Thread escritora única que agrupa escritas em transações a cada poucos milissegundos"""
+    
+    _STOP = object()
+    
+    def __init__(self, pool: ConnectionPool, flush_interval_ms: int = None, max_batch: int = None):
+        self.pool = pool
+        self.flush_interval = (flush_interval_ms or int(os.getenv('DB_GROUP_COMMIT_MS', 5))) / 1000
+        self.max_batch = max_batch or int(os.getenv('DB_GROUP_COMMIT_MAX_BATCH', 256))
+        
+        self._queue = queue.Queue()
+        self._stopping = False
+        self._lock = threading.Lock()
+        
+        # Contadores expostos em get_stats()
+        self._batches = 0
+        self._writes = 0
+        self._failed_writes = 0
+        self._largest_batch = 0
+        
+        self._thread = threading.Thread(target=self._run, name='db-group-commit', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def submit(self, operation, *args) -> Future:
+        """Enfileira operation(conn, *args) e devolve um Future com o resultado"""
+        future = Future()
+        with self._lock:
+            if self._stopping:
+                raise sqlite3.ProgrammingError("Escritor em lote já foi encerrado")
+            self._queue.put((operation, args, future))
+        return future
+    
+    def flush(self, timeout: float = None):
+        """Aguarda até que todas as escritas enfileiradas até agora estejam gravadas"""
+        self.submit(lambda conn: None).result(timeout)
+    
+    def _run(self):
+        """Loop da thread escritora"""
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
             
-            # Tabela de configurações
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    description TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                    break
+                batch.append(item)
             
-            conn.commit()
+            self._commit_batch(batch)
+    
+    def _commit_batch(self, batch: List[tuple]):
+        """Executa um lote numa única transação; cada escrita isolada por SAVEPOINT"""
+        outcomes = []
+        try:
+            with self.pool.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for operation, args, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT group_write")
+                    try:
+                        result = operation(conn, *args)
+                        conn.execute("RELEASE group_write")
+                        outcomes.append((future, result, None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO group_write")
+                        conn.execute("RELEASE group_write")
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            logging.error(f"Erro ao gravar lote de {len(batch)} escritas: {e}")
+            self._failed_writes += len(batch)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        # Resultados só são liberados após o commit (leitura das próprias escritas)
+        self._batches += 1
+        self._writes += len(outcomes)
+        self._largest_batch = max(self._largest_batch, len(batch))
+        for future, result, error in outcomes:
+            if error is not None:
+                self._failed_writes += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores do escritor em lote"""
+        return {
+            'queue_depth': self._queue.qsize(),
+            'batches': self._batches,
+            'writes': self._writes,
+            'failed_writes': self._failed_writes,
+            'largest_batch': self._largest_batch,
+            'avg_batch_size': round(self._writes / self._batches, 2) if self._batches else 0
+        }
+    
+    def close(self, timeout: float = 10.0):
+        """Grava o que estiver pendente e encerra a thread (hook de desligamento)"""
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        # Escritas que chegaram depois do sinal de parada
+        leftovers = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                leftovers.append(item)
+        if leftovers:
+            self._commit_batch(leftovers)
+
+
+class DatabaseManager:
+    """Gerenciador do banco de dados SQLite"""
+    
+    def __init__(self, db_path: str = "bot_database.db", pool_size: int = None,
+                 group_commit: bool = None):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, max_size=pool_size)
+        self.init_database()
+        self.catalog = CatalogCache(self)
+        self.search = ProductSearch(self)
+        
+        # Cache de tokens de download: positivos (com TTL curto) e negativos
+        self.token_cache = LRUCache(
+            maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 10000)),
+            ttl=float(os.getenv('TOKEN_CACHE_TTL', 30))
+        )
+        self.missing_tokens = LRUCache(
+            maxsize=int(os.getenv('NEGATIVE_TOKEN_CACHE_SIZE', 50000)),
+            ttl=float(os.getenv('NEGATIVE_TOKEN_CACHE_TTL', 300))
+        )
+        self._malformed_tokens = 0
+        
+        # Mapa telegram_id -> (user_id, perfil): usuários recorrentes não consultam o banco
+        self.user_ids = LRUCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 100000)))
+        
+        # Janela de update_ids já recebidos (espelho em memória da tabela webhook_updates)
+        self.seen_updates = LRUCache(maxsize=int(os.getenv('WEBHOOK_DEDUP_WINDOW', 10000)))
+        
+        # file_ids do Telegram por (bot, produto, tipo); (None, None) = ainda não enviado
+        self.file_ids = LRUCache(maxsize=int(os.getenv('FILE_ID_CACHE_SIZE', 10000)))
+        
+        # Faturas em aberto (transaction_id -> transação pendente): o pré-checkout não consulta o banco
+        self.pending_transactions = LRUCache(maxsize=int(os.getenv('PENDING_CACHE_SIZE', 10000)))
+        
+        self.download_events = DownloadEventLog(self)
+        self._last_cleanup: Optional[Dict[str, Any]] = None
+        
+        if group_commit is None:
+            group_commit = os.getenv('DB_GROUP_COMMIT', 'false').lower() == 'true'
+        self.writer = GroupCommitWriter(self.pool) if group_commit else None
+    
+    def connection(self):
+        """Conexão do pool para a thread atual (use com 'with')"""
+        return self.pool.connection()
+    
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do pool de conexões"""
+        return self.pool.get_stats()
+    
+    def get_writer_stats(self) -> Optional[Dict[str, Any]]:
+        """Retorna estatísticas do escritor em lote (None se desativado)"""
+        return self.writer.get_stats() if self.writer else None
+    
+    def submit_write(self, operation, *args) -> Future:
+        """Executa operation(conn, *args) pelo escritor em lote e devolve um Future"""
+        if self.writer is not None and not self.pool.in_connection():
+            return self.writer.submit(operation, *args)
+        
+        # Sem escritor (ou dentro de uma transação da thread): executa na hora
+        future = Future()
+        try:
+            with self.connection() as conn:
+                result = operation(conn, *args)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        
+        # Resolvido só depois do commit: callbacks não veem dados ainda não gravados
+        future.set_result(result)
+        return future
+    
+    def _write(self, wait: bool, operation, *args):
+        """Despacha uma escrita; com wait=True devolve o resultado já gravado"""
+        future = self.submit_write(operation, *args)
+        return future.result() if wait else future
+    
+    def flush(self):
+        """Aguarda a gravação de todas as escritas enfileiradas"""
+        if self.writer is not None:
+            self.writer.flush()
+    
+    def close(self):
+        """Grava escritas e eventos pendentes e fecha as conexões do pool"""
+        self.download_events.close()
+        if self.writer is not None:
+            self.writer.close()
+        self.pool.close()
+    
+    def init_database(self):
+        """Aplica as migrações pendentes do esquema (uma vez por processo e arquivo)"""
+        key = os.path.abspath(self.db_path)
+        with _migrated_lock:
+            if key in _migrated_paths:
+                return
+            with self.connection() as conn:
+                applied = apply_migrations(conn)
+            _migrated_paths.add(key)
+        
+        if applied:
+            logging.info(f"Banco de dados migrado para a versão {LATEST_VERSION}")
+        else:
             logging.info("Banco de dados inicializado com sucesso")
     
     def get_user_by_telegram_id(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Busca usuário pelo ID do Telegram"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
     
     def create_user(self, telegram_id: int, username: str = None, 
-                   first_name: str = None, last_name: str = None) -> int:
-        """Cria um novo usuário"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO users (telegram_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            ''', (telegram_id, username, first_name, last_name))
-            conn.commit()
-            return cursor.lastrowid
-    
-    def get_active_products(self) -> List[Dict[str, Any]]:
-        """Retorna todos os produtos ativos"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM products 
-                WHERE is_active = 1 
-                ORDER BY created_at DESC
-            ''')
-            return [dict(row) for row in cursor.fetchall()]
-    
-    def get_product_by_id(self, product_id: int) -> Optional[Dict[str, Any]]:
-        """Busca produto pelo ID"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM products WHERE id = ? AND is_active = 1", (product_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+                   first_name: str = None, last_name: str = None, wait: bool = True) -> int:
+        """Cria um novo usuário (wait=False devolve um Future)"""
+        return self._write(wait, self._create_user, telegram_id, username, first_name, last_name)
     
-    def create_transaction(self, user_id: int, product_id: int, amount_stars: int) -> int:
-        """Cria uma nova transação"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transactions (user_id, product_id, amount_stars)
-                VALUES (?, ?, ?)
-            ''', (user_id, product_id, amount_stars))
-            conn.commit()
-            return cursor.lastrowid
-    
-    def update_transaction_payment(self, transaction_id: int, telegram_payment_id: str, status: str = 'completed'):
-        """Atualiza transação com dados do pagamento"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE transactions 
-                SET telegram_payment_id = ?, status = ?, completed_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (telegram_payment_id, status, transaction_id))
-            conn.commit()
+    @staticmethod
+    def _create_user(conn, telegram_id, username, first_name, last_name) -> int:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+        ''', (telegram_id, username, first_name, last_name))
+        return cursor.lastrowid
+    
+    def upsert_user(self, telegram_id: int, username: str = None,
+                    first_name: str = None, last_name: str = None) -> int:
+        """Cria ou atualiza o usuário numa única consulta e devolve seu ID (sem consulta se já conhecido)"""
+        profile = (username, first_name, last_name)
+        cached = self.user_ids.get(telegram_id)
+        if cached is not None and cached[1] == profile:
+            return cached[0]
+        
+        user_id = self._write(True, self._upsert_user, telegram_id, *profile)
+        self.user_ids.put(telegram_id, (user_id, profile))
+        return user_id
+    
+    @staticmethod
+    def _upsert_user(conn, telegram_id, username, first_name, last_name) -> int:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO users (telegram_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name
+            RETURNING id
+        ''', (telegram_id, username, first_name, last_name))
+        return cursor.fetchone()[0]
+    
+    def get_or_create_user_id(self, telegram_id: int) -> int:
+        """ID interno do usuário, criando um registro mínimo se necessário (sem alterar o perfil)"""
+        cached = self.user_ids.get(telegram_id)
+        if cached is not None:
+            return cached[0]
+        return self._write(True, self._get_or_create_user_id, telegram_id)
+    
+    @staticmethod
+    def _get_or_create_user_id(conn, telegram_id) -> int:
+        return conn.execute('''
+            INSERT INTO users (telegram_id) VALUES (?)
+            ON CONFLICT (telegram_id) DO UPDATE SET telegram_id = excluded.telegram_id
+            RETURNING id
+        ''', (telegram_id,)).fetchone()[0]
+    
+    def get_user_cache_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do mapa telegram_id → user_id"""
+        return self.user_ids.get_stats()
+    
+    def claim_update(self, update_id: int) -> bool:
+        """Registra o update_id recebido; False se já foi visto (reentrega do Telegram)"""
+        if self.seen_updates.get(update_id) is not None:
+            return False
+        
+        claimed = self._write(True, self._claim_update, update_id, self.seen_updates.maxsize)
+        self.seen_updates.put(update_id, True)
+        return claimed
+    
+    @staticmethod
+    def _claim_update(conn, update_id, window) -> bool:
+        cursor = conn.execute('''
+            INSERT INTO webhook_updates (update_id) VALUES (?)
+            ON CONFLICT (update_id) DO NOTHING
+        ''', (update_id,))
+        if cursor.rowcount and update_id % 256 == 0:
+            # update_ids são sequenciais: mantém só a janela mais recente
+            conn.execute("DELETE FROM webhook_updates WHERE update_id < ?", (update_id - window,))
+        return cursor.rowcount == 1
+    
+    def release_update(self, update_id: int):
+        """Desfaz claim_update quando o update não pôde ser aceito (o Telegram vai reenviá-lo)"""
+        self.seen_updates.discard(update_id)
+        self._write(True, self._release_update, update_id)
+    
+    @staticmethod
+    def _release_update(conn, update_id):
+        conn.execute("DELETE FROM webhook_updates WHERE update_id = ?", (update_id,))
+    
+    def store_polled_updates(self, offset_key: str, offset: int, updates: List[tuple]):
+        """Grava um lote do getUpdates (update_id, JSON) junto com o novo offset, numa transação"""
+        self._write(True, self._store_polled_updates, offset_key, offset, updates)
+    
+    @staticmethod
+    def _store_polled_updates(conn, offset_key, offset, updates):
+        conn.executemany('''
+            INSERT INTO polled_updates (update_id, payload) VALUES (?, ?)
+            ON CONFLICT (update_id) DO NOTHING
+        ''', updates)
+        DatabaseManager._set_setting(conn, offset_key, str(offset), 'Próximo update_id do long polling')
+    
+    def get_polled_updates(self) -> List[str]:
+        """Updates do polling ainda não processados (JSON), em ordem de chegada"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT payload FROM polled_updates ORDER BY update_id").fetchall()
+        return [row[0] for row in rows]
+    
+    def finish_polled_update(self, update_id: int):
+        """Retira um update processado da tabela (sem esperar a gravação)"""
+        self._write(False, self._finish_polled_update, update_id)
+    
+    @staticmethod
+    def _finish_polled_update(conn, update_id):
+        conn.execute("DELETE FROM polled_updates WHERE update_id = ?", (update_id,))
+    
+    def get_setting(self, key: str) -> Optional[str]:
+        """Valor de uma chave da tabela settings (None se não existir)"""
+        with self.connection() as conn:
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_setting(self, key: str, value: str, description: str = None):
+        """Grava (ou substitui) uma chave da tabela settings"""
+        self._write(True, self._set_setting, key, value, description)
+    
+    @staticmethod
+    def _set_setting(conn, key, value, description):
+        conn.execute('''
+            INSERT INTO settings (key, value, description) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = excluded.value,
+                description = COALESCE(excluded.description, settings.description),
+                updated_at = CURRENT_TIMESTAMP
+        ''', (key, value, description))
+    
+    def get_active_products(self) -> List[ProductRecord]:
+        """Retorna todos os produtos ativos (do cache do catálogo)"""
+        return list(self.catalog.active_products())
+    
+    def get_product_by_id(self, product_id: int) -> Optional[ProductRecord]:
+        """Busca produto ativo pelo ID (do cache do catálogo)"""
+        return self.catalog.get(product_id)
+    
+    def invalidate_catalog(self):
+        """Invalida o cache do catálogo neste e nos demais processos"""
+        self.catalog.invalidate()
+    
+    def get_catalog_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do cache do catálogo"""
+        return self.catalog.get_stats()
+    
+    def search_products(self, query: str, limit: int = 20, offset: int = 0):
+        """Busca textual nos produtos ativos: (produtos, há mais resultados)"""
+        return self.search.search(query, limit, offset)
+    
+    def get_search_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas da busca de produtos"""
+        return self.search.get_stats()
+    
+    def get_file_id(self, bot_id: int, product_id: int, kind: str,
+                    source_path: str = None) -> Optional[str]:
+        """file_id já enviado deste arquivo pelo bot (None se nunca enviado ou se o arquivo mudou)"""
+        key = (bot_id, product_id, kind)
+        cached = self.file_ids.get(key)
+        if cached is None:
+            with self.connection() as conn:
+                row = conn.execute('''
+                    SELECT file_id, source_path FROM product_file_ids
+                    WHERE bot_id = ? AND product_id = ? AND kind = ?
+                ''', (bot_id, product_id, kind)).fetchone()
+            cached = (row[0], row[1]) if row else (None, None)
+            self.file_ids.put(key, cached)
+        
+        file_id, cached_path = cached
+        if file_id is None or (source_path is not None and cached_path != source_path):
+            return None
+        return file_id
+    
+    def save_file_id(self, bot_id: int, product_id: int, kind: str, file_id: str,
+                     source_path: str = None):
+        """Guarda o file_id devolvido pelo Telegram após o primeiro upload"""
+        self._write(True, self._save_file_id, bot_id, product_id, kind, file_id, source_path)
+        self.file_ids.put((bot_id, product_id, kind), (file_id, source_path))
+    
+    @staticmethod
+    def _save_file_id(conn, bot_id, product_id, kind, file_id, source_path):
+        conn.execute('''
+            INSERT INTO product_file_ids (bot_id, product_id, kind, file_id, source_path)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (bot_id, product_id, kind) DO UPDATE SET
+                file_id = excluded.file_id,
+                source_path = excluded.source_path,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (bot_id, product_id, kind, file_id, source_path))
+    
+    def forget_file_id(self, bot_id: int, product_id: int, kind: str):
+        """Descarta um file_id recusado pelo Telegram (o próximo envio refaz o upload)"""
+        self._write(True, self._forget_file_id, bot_id, product_id, kind)
+        self.file_ids.put((bot_id, product_id, kind), (None, None))
+    
+    @staticmethod
+    def _forget_file_id(conn, bot_id, product_id, kind):
+        conn.execute('''
+            DELETE FROM product_file_ids
+            WHERE bot_id = ? AND product_id = ? AND kind = ?
+        ''', (bot_id, product_id, kind))
+    
+    def get_file_id_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do cache de file_ids"""
+        return self.file_ids.get_stats()
+    
+    def create_transaction(self, user_id: int, product_id: int, amount_stars: int,
+                           wait: bool = True) -> int:
+        """Cria uma nova transação (wait=False devolve um Future)"""
+        future = self.submit_write(self._create_transaction, user_id, product_id, amount_stars)
+        
+        def remember(done: Future):
+            if done.exception() is None:
+                self.pending_transactions.put(done.result(), {
+                    'user_id': user_id,
+                    'product_id': product_id,
+                    'amount_stars': amount_stars
+                })
+        
+        future.add_done_callback(remember)
+        return future.result() if wait else future
+    
+    @staticmethod
+    def _create_transaction(conn, user_id, product_id, amount_stars) -> int:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO transactions (user_id, product_id, amount_stars)
+            VALUES (?, ?, ?)
+        ''', (user_id, product_id, amount_stars))
+        return cursor.lastrowid
+    
+    def get_pending_transaction(self, transaction_id: int, cached_only: bool = False) -> Optional[Dict[str, Any]]:
+        """Transação pendente (user_id, product_id, amount_stars), da memória; None se não estiver pendente"""
+        cached = self.pending_transactions.get(transaction_id)
+        if cached is not None or cached_only:
+            return cached
+        
+        # Fatura criada antes de um reinício (ou por outro processo)
+        with self.connection() as conn:
+            row = conn.execute('''
+                SELECT user_id, product_id, amount_stars FROM transactions
+                WHERE id = ? AND status = 'pending'
+            ''', (transaction_id,)).fetchone()
+        if row is None:
+            return None
+        
+        pending = dict(row)
+        self.pending_transactions.put(transaction_id, pending)
+        return pending
+    
+    def get_pending_cache_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do cache de transações pendentes"""
+        return self.pending_transactions.get_stats()
+    
+    def update_transaction_payment(self, transaction_id: int, telegram_payment_id: str,
+                                   status: str = 'completed', wait: bool = True):
+        """Atualiza transação com dados do pagamento (wait=False devolve um Future)"""
+        self.pending_transactions.discard(transaction_id)
+        return self._write(wait, self._update_transaction_payment,
+                           transaction_id, telegram_payment_id, status)
+    
+    @staticmethod
+    def _update_transaction_payment(conn, transaction_id, telegram_payment_id, status):
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT status, product_id, amount_stars, completed_at FROM transactions WHERE id = ?",
+            (transaction_id,)
+        )
+        previous = cursor.fetchone()
+        
+        cursor.execute('''
+            UPDATE transactions 
+            SET telegram_payment_id = ?, status = ?, completed_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (telegram_payment_id, status, transaction_id))
+        
+        # Rollups contam apenas a entrada e a saída do estado 'completed'
+        if previous is None or (previous['status'] == 'completed') == (status == 'completed'):
+            return
+        if status == 'completed':
+            rollups.bump(conn, previous['product_id'], sales=1, revenue=previous['amount_stars'])
+        else:
+            rollups.bump(conn, previous['product_id'], at=previous['completed_at'],
+                         sales=-1, revenue=-previous['amount_stars'])
+    
+    def complete_payment(self, transaction_id: int, telegram_payment_id: str, download_token: str,
+                         expiry_hours: int = 24, max_downloads: int = 3) -> Optional[Dict[str, Any]]:
+        """Conclui a transação e cria o download numa única transação; None se ela não estava pendente"""
+        expires_at = datetime.now() + timedelta(hours=expiry_hours)
+        self.pending_transactions.discard(transaction_id)
+        completed = self._write(True, self._complete_payment, transaction_id, telegram_payment_id,
+                                download_token, expires_at, max_downloads)
+        if completed is not None:
+            self.missing_tokens.discard(download_token)
+        return completed
+    
+    @staticmethod
+    def _complete_payment(conn, transaction_id, telegram_payment_id, download_token, expires_at,
+                          max_downloads):
+        # O UPDATE condicional decide a corrida: só uma entrega do pagamento muda o status
+        # ('error' = tentativa anterior falhou depois da cobrança)
+        row = conn.execute('''
+            UPDATE transactions
+            SET telegram_payment_id = ?, status = 'completed', completed_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('pending', 'error')
+            RETURNING user_id, product_id, amount_stars
+        ''', (telegram_payment_id, transaction_id)).fetchone()
+        if row is None:
+            return None
+        
+        return DatabaseManager._insert_purchase_download(
+            conn, transaction_id, row['user_id'], row['product_id'], row['amount_stars'],
+            download_token, expires_at, max_downloads
+        )
+    
+    def create_completed_purchase(self, user_id: int, product_id: int, amount_stars: int,
+                                  telegram_payment_id: str, download_token: str, expiry_hours: int = 24,
+                                  max_downloads: int = 3) -> Optional[Dict[str, Any]]:
+        """Grava a transação já paga (fatura assinada) e o download juntos; None se o pagamento já estava registrado"""
+        expires_at = datetime.now() + timedelta(hours=expiry_hours)
+        completed = self._write(True, self._create_completed_purchase, user_id, product_id, amount_stars,
+                                telegram_payment_id, download_token, expires_at, max_downloads)
+        if completed is not None:
+            self.missing_tokens.discard(download_token)
+        return completed
+    
+    @staticmethod
+    def _create_completed_purchase(conn, user_id, product_id, amount_stars, telegram_payment_id,
+                                   download_token, expires_at, max_downloads):
+        row = conn.execute('''
+            INSERT INTO transactions (user_id, product_id, amount_stars, telegram_payment_id,
+                                      status, completed_at)
+            VALUES (?, ?, ?, ?, 'completed', CURRENT_TIMESTAMP)
+            ON CONFLICT (telegram_payment_id) DO NOTHING
+            RETURNING id
+        ''', (user_id, product_id, amount_stars, telegram_payment_id)).fetchone()
+        if row is None:
+            return None
+        
+        return DatabaseManager._insert_purchase_download(
+            conn, row[0], user_id, product_id, amount_stars, download_token, expires_at, max_downloads
+        )
+    
+    @staticmethod
+    def _insert_purchase_download(conn, transaction_id, user_id, product_id, amount_stars,
+                                  download_token, expires_at, max_downloads) -> Dict[str, Any]:
+        """Download de uma compra recém-concluída, na mesma transação da conclusão"""
+        download_id = conn.execute('''
+            INSERT INTO downloads (transaction_id, user_id, product_id, download_token,
+                                   max_downloads, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (transaction_id, user_id, product_id, download_token, max_downloads, expires_at)).lastrowid
+        rollups.bump(conn, product_id, sales=1, revenue=amount_stars, deliveries=1)
+        
+        product = conn.execute("SELECT name FROM products WHERE id = ?", (product_id,)).fetchone()
+        return {
+            'transaction_id': transaction_id,
+            'user_id': user_id,
+            'product_id': product_id,
+            'product_name': product['name'] if product else None,
+            'download_id': download_id,
+            'expires_at': expires_at
+        }
+    
+    def find_payment_ids(self, telegram_payment_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Transações (id, status) já gravadas para estes pagamentos do Telegram, pelo índice único"""
+        if not telegram_payment_ids:
+            return {}
+        placeholders = ', '.join('?' for _ in telegram_payment_ids)
+        with self.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT id, telegram_payment_id, status FROM transactions
+                WHERE telegram_payment_id IN ({placeholders})
+            ''', list(telegram_payment_ids)).fetchall()
+        return {row['telegram_payment_id']: {'id': row['id'], 'status': row['status']} for row in rows}
+    
+    def repair_payments(self, cursor_key: str, cursor: int,
+                        repairs: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+        """Conclui pagamentos perdidos (com download) e grava o cursor da conciliação numa transação"""
+        for repair in repairs:
+            if repair.get('transaction_id') is not None:
+                self.pending_transactions.discard(repair['transaction_id'])
+        purchases = self._write(True, self._repair_payments, cursor_key, cursor, repairs)
+        for repair, purchase in zip(repairs, purchases):
+            if purchase:
+                self.missing_tokens.discard(repair['download_token'])
+        return purchases
+    
+    @staticmethod
+    def _repair_payments(conn, cursor_key, cursor, repairs):
+        purchases = []
+        for repair in repairs:
+            # Cada reparo isolado: um conflito não desfaz os demais do lote
+            conn.execute("SAVEPOINT repair_payment")
+            try:
+                if repair.get('transaction_id') is not None:
+                    purchase = DatabaseManager._complete_payment(
+                        conn, repair['transaction_id'], repair['telegram_payment_id'],
+                        repair['download_token'], repair['expires_at'], repair['max_downloads']
+                    )
+                else:
+                    user_id = DatabaseManager._get_or_create_user_id(conn, repair['telegram_user_id'])
+                    purchase = DatabaseManager._create_completed_purchase(
+                        conn, user_id, repair['product_id'], repair['amount_stars'],
+                        repair['telegram_payment_id'], repair['download_token'],
+                        repair['expires_at'], repair['max_downloads']
+                    )
+                conn.execute("RELEASE repair_payment")
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO repair_payment")
+                conn.execute("RELEASE repair_payment")
+                logging.error(f"Erro ao reparar pagamento {repair['telegram_payment_id']}: {e}")
+                purchase = None
+            purchases.append(purchase)
+        
+        DatabaseManager._set_setting(conn, cursor_key, str(cursor), 'Posição no getStarTransactions')
+        return purchases
+    
+    def get_transaction_id_by_payment(self, telegram_payment_id: str) -> Optional[int]:
+        """ID da transação de um pagamento do Telegram"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT id FROM transactions WHERE telegram_payment_id = ?", (telegram_payment_id,)
+            ).fetchone()
+        return row[0] if row else None
     
     def create_download_access(self, transaction_id: int, user_id: int, product_id: int, 
                               download_token: str, expiry_hours: int = 24, max_downloads: int = 3) -> int:
         """Cria acesso de download para uma transação"""
         expires_at = datetime.now() + timedelta(hours=expiry_hours)
         
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO downloads (transaction_id, user_id, product_id, download_token, 
                                      max_downloads, expires_at)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (transaction_id, user_id, product_id, download_token, max_downloads, expires_at))
-            conn.commit()
-            return cursor.lastrowid
+            download_id = cursor.lastrowid
+            rollups.bump(conn, product_id, deliveries=1)
+        
+        self.missing_tokens.discard(download_token)
+        return download_id
     
     def get_download_access(self, download_token: str) -> Optional[Dict[str, Any]]:
-        """Busca acesso de download pelo token"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        """Busca acesso de download pelo token (com cache positivo e negativo)"""
+        if not download_token or not DOWNLOAD_TOKEN_PATTERN.match(download_token):
+            self._malformed_tokens += 1
+            return None
+        
+        cached = self.token_cache.get(download_token)
+        if cached is not None:
+            return dict(cached)
+        if self.missing_tokens.get(download_token):
+            return None
+        
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT d.*, p.file_path, p.name as product_name
@@ -184,17 +891,147 @@ class DatabaseManager:
                 WHERE d.download_token = ? AND d.expires_at > CURRENT_TIMESTAMP
             ''', (download_token,))
             row = cursor.fetchone()
-            return dict(row) if row else None
+        
+        if not row:
+            self.missing_tokens.put(download_token, True)
+            return None
+        
+        download_access = dict(row)
+        self.token_cache.put(download_token, download_access, ttl=self._token_ttl(download_access))
+        return dict(download_access)
     
-    def increment_download_count(self, download_token: str) -> bool:
-        """Incrementa contador de downloads e retorna se ainda é válido"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE downloads 
-                SET download_count = download_count + 1, last_access = CURRENT_TIMESTAMP
-                WHERE download_token = ? AND download_count < max_downloads
-            ''', (download_token,))
-            conn.commit()
-            return cursor.rowcount > 0
+    def _token_ttl(self, download_access: Dict[str, Any]) -> float:
+        """TTL da entrada no cache, sem ultrapassar a expiração do próprio token"""
+        try:
+            remaining = (datetime.fromisoformat(str(download_access['expires_at'])) - datetime.now()).total_seconds()
+        except ValueError:
+            return self.token_cache.ttl
+        return max(0.0, min(self.token_cache.ttl, remaining))
+    
+    def invalidate_download_token(self, download_token: str):
+        """Remove o token do cache (após bloqueio ou alteração externa)"""
+        self.token_cache.discard(download_token)
+    
+    def get_token_cache_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do cache de tokens de download"""
+        return {
+            'positive': self.token_cache.get_stats(),
+            'negative': self.missing_tokens.get_stats(),
+            'malformed_rejects': self._malformed_tokens
+        }
+    
+    def get_download_event_stats(self) -> Dict[str, Any]:
+        """Retorna estatísticas do log de eventos de download"""
+        return self.download_events.get_stats()
+    
+    def archive_expired_downloads(self, batch_size: int = None, pause_ms: int = None) -> Dict[str, Any]:
+        """Move downloads expirados para downloads_archive em lotes curtos, na ordem do índice"""
+        batch_size = batch_size or int(os.getenv('CLEANUP_BATCH_SIZE', 500))
+        pause = (pause_ms if pause_ms is not None else int(os.getenv('CLEANUP_PAUSE_MS', 50))) / 1000
+        
+        # expires_at é gravado no horário local (ver create_download_access)
+        cutoff = datetime.now().isoformat(' ')
+        last_key = ('', 0)
+        archived = batches = 0
+        lock_total = lock_max = 0.0
+        started = time.monotonic()
+        
+        while True:
+            with self.connection() as conn:
+                # Leitura fora da transação de escrita: o lock só cobre a movimentação
+                rows = conn.execute('''
+                    SELECT id, expires_at, download_token FROM downloads
+                    WHERE expires_at < ? AND (expires_at, id) > (?, ?)
+                    ORDER BY expires_at, id
+                    LIMIT ?
+                ''', (cutoff, *last_key, batch_size)).fetchall()
+                if not rows:
+                    break
+                
+                lock_started = time.monotonic()
+                conn.execute("BEGIN IMMEDIATE")
+                archived += self._archive_batch(conn, [row['id'] for row in rows])
+                conn.commit()
+                held = time.monotonic() - lock_started
+            
+            lock_total += held
+            lock_max = max(lock_max, held)
+            batches += 1
+            last_key = (rows[-1]['expires_at'], rows[-1]['id'])
+            for row in rows:
+                self.token_cache.discard(row['download_token'])
+            
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause)
+        
+        duration = time.monotonic() - started
+        self._last_cleanup = {
+            'archived': archived,
+            'batches': batches,
+            'duration_ms': round(duration * 1000, 1),
+            'rows_per_sec': round(archived / duration, 1) if duration > 0 else 0,
+            'lock_hold_total_ms': round(lock_total * 1000, 3),
+            'lock_hold_max_ms': round(lock_max * 1000, 3),
+            'finished_at': datetime.now().isoformat()
+        }
+        if archived:
+            logging.info(f"Arquivados {archived} downloads expirados em {batches} lotes "
+                         f"({self._last_cleanup['rows_per_sec']} linhas/s, "
+                         f"lock máximo {self._last_cleanup['lock_hold_max_ms']} ms)")
+        return self._last_cleanup
+    
+    @staticmethod
+    def _archive_batch(conn, ids: List[int]) -> int:
+        placeholders = ', '.join('?' for _ in ids)
+        conn.execute(f'''
+            INSERT INTO downloads_archive
+                (id, transaction_id, user_id, product_id, download_token, download_count,
+                 max_downloads, last_access, expires_at, created_at)
+            SELECT id, transaction_id, user_id, product_id, download_token, download_count,
+                   max_downloads, last_access, expires_at, created_at
+            FROM downloads
+            WHERE id IN ({placeholders})
+        ''', ids)
+        cursor = conn.execute(f"DELETE FROM downloads WHERE id IN ({placeholders})", ids)
+        return cursor.rowcount
+    
+    def get_cleanup_stats(self) -> Optional[Dict[str, Any]]:
+        """Retorna as métricas da última limpeza de downloads expirados (None se não houve)"""
+        return self._last_cleanup
+    
+    def increment_download_count(self, download_token: str, wait: bool = True) -> bool:
+        """Incrementa contador de downloads e retorna se ainda é válido (wait=False devolve Future do novo contador)"""
+        future = self.submit_write(self._increment_download_count, download_token)
+        future.add_done_callback(lambda f: self._sync_cached_count(download_token, f))
+        if not wait:
+            return future
+        return future.result() is not None
+    
+    @staticmethod
+    def _increment_download_count(conn, download_token) -> Optional[int]:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE downloads 
+            SET download_count = download_count + 1
+            WHERE download_token = ? AND download_count < max_downloads
+            RETURNING download_count, product_id, created_at
+        ''', (download_token,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        # last_access e downloads por horário de acesso vêm do log de eventos
+        count, product_id, created_at = row
+        rollups.bump(conn, product_id, at=created_at,
+                     delivery_downloads=1, used_deliveries=1 if count == 1 else 0)
+        return count
+    
+    def _sync_cached_count(self, download_token: str, future: Future):
+        """Mantém o contador em cache igual ao gravado (chamado após o commit)"""
+        count = None if future.exception() else future.result()
+        if count is None:
+            self.token_cache.discard(download_token)
+            return
+        self.token_cache.update(download_token, lambda cached: {**cached, 'download_count': count})
 
@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 import hashlib
 import hmac
@@ -8,6 +9,7 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List
 from urllib.parse import quote
 from flask import Flask, request, jsonify, send_file, abort, Response, render_template_string
+import rollups
 
 logger = logging.getLogger(__name__)
 
@@ -69,8 +71,9 @@ class SecureDeliverySystem:
             logger.error(f"Erro na validação da URL: {e}")
             return False
     
-    def create_streaming_response(self, file_path: str, filename: str) -> Response:
-        """Cria resposta de streaming para download"""
+    def create_streaming_response(self, file_path: str, filename: str,
+                                  event: Dict[str, Any] = None) -> Response:
+        """Cria resposta de streaming para download (event: contexto para o log de downloads)"""
         try:
             if not os.path.exists(file_path):
                 abort(404, description="Arquivo não encontrado")
@@ -93,7 +96,7 @@ class SecureDeliverySystem:
             # Suporte a range requests (para downloads resumíveis)
             range_header = request.headers.get('Range')
             if range_header:
-                return self.handle_range_request(file_path, range_header, headers)
+                return self.handle_range_request(file_path, range_header, headers, event)
             
             # Download completo
             def generate():
@@ -104,13 +107,14 @@ class SecureDeliverySystem:
                             break
                         yield chunk
             
-            return Response(generate(), headers=headers)
+            return Response(self.track_stream(generate(), event, 200), headers=headers)
             
         except Exception as e:
             logger.error(f"Erro na criação da resposta de streaming: {e}")
             abort(500, description="Erro interno do servidor")
     
-    def handle_range_request(self, file_path: str, range_header: str, base_headers: Dict[str, str]) -> Response:
+    def handle_range_request(self, file_path: str, range_header: str, base_headers: Dict[str, str],
+                             event: Dict[str, Any] = None) -> Response:
         """Manipula requisições de range (downloads resumíveis)"""
         try:
             file_size = os.path.getsize(file_path)
@@ -147,12 +151,42 @@ class SecureDeliverySystem:
                         remaining -= len(chunk)
                         yield chunk
             
-            return Response(generate(), status=206, headers=headers)
+            return Response(
+                self.track_stream(generate(), event, 206, range_start=start, range_end=end),
+                status=206,
+                headers=headers
+            )
             
         except Exception as e:
             logger.error(f"Erro no range request: {e}")
             abort(500, description="Erro interno do servidor")
     
+    def track_stream(self, chunks, event: Optional[Dict[str, Any]], status: int,
+                     range_start: int = None, range_end: int = None):
+        """Repassa os blocos do arquivo e registra o evento de download ao final do envio"""
+        served = 0
+        try:
+            for chunk in chunks:
+                served += len(chunk)
+                yield chunk
+        finally:
+            # Também executa quando o cliente desconecta no meio (GeneratorExit)
+            if event is not None:
+                started = event.get('started')
+                self.db.download_events.record(
+                    download_token=event['token'],
+                    status=status,
+                    ip=event.get('ip'),
+                    user_agent=event.get('user_agent'),
+                    bytes_served=served,
+                    range_start=range_start,
+                    range_end=range_end,
+                    latency_ms=(time.monotonic() - started) * 1000 if started else None,
+                    download_id=event.get('download_id'),
+                    user_id=event.get('user_id'),
+                    product_id=event.get('product_id')
+                )
+    
     def add_watermark_info(self, download_access: Dict[str, Any]) -> Dict[str, str]:
         """Adiciona informações de marca d'água (metadados)"""
         try:
@@ -175,8 +209,9 @@ class SecureDeliverySystem:
             logger.error(f"Erro ao gerar marca d'água: {e}")
             return {}
     
-    def log_download_attempt(self, token: str, user_ip: str, user_agent: str, success: bool, reason: str = None):
-        """Registra tentativa de download para auditoria"""
+    def log_download_attempt(self, token: str, user_ip: str, user_agent: str, success: bool,
+                             reason: str = None, status: int = 404, started: float = None):
+        """Registra tentativa de download para auditoria (recusas também vão para o log de eventos)"""
         try:
             log_entry = {
                 'timestamp': datetime.now().isoformat(),
@@ -190,7 +225,16 @@ class SecureDeliverySystem:
             # Log estruturado
             logger.info(f"Download attempt: {log_entry}")
             
-            # Aqui você pode salvar em arquivo ou banco separado para auditoria
+            # Downloads servidos são registrados por track_stream ao fim do envio
+            if not success:
+                self.db.download_events.record(
+                    download_token=token,
+                    status=status,
+                    ip=user_ip,
+                    user_agent=user_agent,
+                    latency_ms=(time.monotonic() - started) * 1000 if started else None,
+                    reason=reason
+                )
             
         except Exception as e:
             logger.error(f"Erro no log de download: {e}")
@@ -203,32 +247,9 @@ class DeliveryScheduler:
         self.db = db_manager
     
     def cleanup_expired_downloads(self) -> int:
-        """Remove downloads expirados"""
+        """Arquiva downloads expirados em lotes curtos (o histórico vai para downloads_archive)"""
         try:
-            import sqlite3
-            
-            with sqlite3.connect(self.db.db_path) as conn:
-                cursor = conn.cursor()
-                
-                # Contar downloads expirados
-                cursor.execute('''
-                    SELECT COUNT(*) FROM downloads 
-                    WHERE expires_at < datetime('now')
-                ''')
-                expired_count = cursor.fetchone()[0]
-                
-                # Remover downloads expirados
-                cursor.execute('''
-                    DELETE FROM downloads 
-                    WHERE expires_at < datetime('now')
-                ''')
-                conn.commit()
-                
-                if expired_count > 0:
-                    logger.info(f"Removidos {expired_count} downloads expirados")
-                
-                return expired_count
-                
+            return self.db.archive_expired_downloads()['archived']
         except Exception as e:
             logger.error(f"Erro na limpeza de downloads: {e}")
             return 0
@@ -236,11 +257,8 @@ class DeliveryScheduler:
     def send_expiry_warnings(self) -> int:
         """Envia avisos de expiração próxima"""
         try:
-            import sqlite3
-            
             # Buscar downloads que expiram em 2 horas
-            with sqlite3.connect(self.db.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT d.*, u.telegram_id, p.name as product_name
@@ -266,72 +284,52 @@ class DeliveryScheduler:
             return 0
     
     def generate_delivery_report(self, days: int = 7) -> Dict[str, Any]:
-        """Gera relatório de entregas"""
+        """Gera relatório de entregas (a partir dos rollups)"""
         try:
-            import sqlite3
-            
-            with sqlite3.connect(self.db.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                
-                # Estatísticas gerais
-                cursor.execute('''
-                    SELECT 
-                        COUNT(*) as total_deliveries,
-                        COUNT(DISTINCT user_id) as unique_users,
-                        SUM(download_count) as total_downloads,
-                        AVG(download_count) as avg_downloads_per_delivery
-                    FROM downloads 
-                    WHERE created_at >= datetime('now', '-{} days')
-                '''.format(days))
-                
-                stats = cursor.fetchone()
-                
-                # Downloads por produto
-                cursor.execute('''
-                    SELECT 
-                        p.name,
-                        COUNT(*) as deliveries,
-                        SUM(d.download_count) as total_downloads
-                    FROM downloads d
-                    JOIN products p ON d.product_id = p.id
-                    WHERE d.created_at >= datetime('now', '-{} days')
-                    GROUP BY p.id, p.name
-                    ORDER BY deliveries DESC
-                '''.format(days))
-                
-                product_stats = cursor.fetchall()
+            with self.db.connection() as conn:
+                products = rollups.window_totals(conn, days)
                 
-                # Taxa de utilização
+                # Usuários distintos não somam entre baldes: consulta indexada na janela
+                cursor = conn.cursor()
                 cursor.execute('''
-                    SELECT 
-                        COUNT(CASE WHEN download_count > 0 THEN 1 END) as used_deliveries,
-                        COUNT(*) as total_deliveries
-                    FROM downloads 
-                    WHERE created_at >= datetime('now', '-{} days')
-                '''.format(days))
-                
-                usage = cursor.fetchone()
-                usage_rate = (usage['used_deliveries'] / usage['total_deliveries'] * 100) if usage['total_deliveries'] > 0 else 0
-                
-                return {
-                    'period_days': days,
-                    'summary': {
-                        'total_deliveries': stats['total_deliveries'] or 0,
-                        'unique_users': stats['unique_users'] or 0,
-                        'total_downloads': stats['total_downloads'] or 0,
-                        'avg_downloads_per_delivery': round(stats['avg_downloads_per_delivery'] or 0, 2),
-                        'usage_rate': round(usage_rate, 2)
-                    },
-                    'products': [
-                        {
-                            'name': row['name'],
-                            'deliveries': row['deliveries'],
-                            'downloads': row['total_downloads']
-                        }
-                        for row in product_stats
-                    ]
-                }
+                    SELECT COUNT(DISTINCT user_id) as unique_users
+                    FROM (
+                        SELECT user_id FROM downloads
+                        WHERE created_at >= datetime('now', ?)
+                        UNION ALL
+                        SELECT user_id FROM downloads_archive
+                        WHERE created_at >= datetime('now', ?)
+                    )
+                ''', (f'-{int(days)} days',) * 2)
+                unique_users = cursor.fetchone()['unique_users']
+            
+            delivered = [row for row in products if row['deliveries'] > 0]
+            total_deliveries = sum(row['deliveries'] for row in delivered)
+            total_downloads = sum(row['delivery_downloads'] for row in delivered)
+            used_deliveries = sum(row['used_deliveries'] for row in delivered)
+            
+            # Taxa de utilização
+            usage_rate = (used_deliveries / total_deliveries * 100) if total_deliveries > 0 else 0
+            avg_downloads = total_downloads / total_deliveries if total_deliveries > 0 else 0
+            
+            return {
+                'period_days': days,
+                'summary': {
+                    'total_deliveries': total_deliveries,
+                    'unique_users': unique_users or 0,
+                    'total_downloads': total_downloads,
+                    'avg_downloads_per_delivery': round(avg_downloads, 2),
+                    'usage_rate': round(usage_rate, 2)
+                },
+                'products': [
+                    {
+                        'name': row['name'],
+                        'deliveries': row['deliveries'],
+                        'downloads': row['delivery_downloads']
+                    }
+                    for row in sorted(delivered, key=lambda row: row['deliveries'], reverse=True)
+                ]
+            }
                 
         except Exception as e:
             logger.error(f"Erro na geração do relatório: {e}")
@@ -348,41 +346,42 @@ class AntiPiracySystem:
     def detect_suspicious_activity(self, user_id: int, ip_address: str) -> Dict[str, Any]:
         """Detecta atividade suspeita"""
         try:
-            import sqlite3
-            
-            with sqlite3.connect(self.db.db_path) as conn:
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 
-                # Verificar múltiplos downloads do mesmo IP
+                # Verificar múltiplos usuários baixando do mesmo IP
                 cursor.execute('''
                     SELECT COUNT(DISTINCT user_id) as unique_users
-                    FROM downloads d
-                    JOIN users u ON d.user_id = u.id
-                    WHERE d.last_access >= datetime('now', '-1 day')
-                    -- Aqui você adicionaria filtro por IP se armazenasse
-                ''')
+                    FROM download_events
+                    WHERE ip = ? AND occurred_at >= datetime('now', '-1 day')
+                ''', (ip_address,))
                 
-                # Por enquanto, análise básica
-                warnings = []
+                ip_users = cursor.fetchone()[0] or 0
                 
                 # Verificar downloads excessivos
                 cursor.execute('''
-                    SELECT SUM(download_count) as total_downloads
-                    FROM downloads 
-                    WHERE user_id = ? AND last_access >= datetime('now', '-1 day')
+                    SELECT COUNT(*) as total_downloads
+                    FROM download_events 
+                    WHERE user_id = ? AND occurred_at >= datetime('now', '-1 day')
+                    AND status IN (200, 206)
                 ''', (user_id,))
                 
-                result = cursor.fetchone()
-                daily_downloads = result[0] or 0
+                daily_downloads = cursor.fetchone()[0] or 0
+                
+                warnings = []
                 
                 if daily_downloads > 10:  # Limite arbitrário
                     warnings.append("Downloads excessivos detectados")
                 
+                if ip_users > 3:  # Limite arbitrário
+                    warnings.append("Múltiplos usuários no mesmo IP")
+                
                 return {
                     'user_id': user_id,
                     'risk_level': 'high' if warnings else 'low',
                     'warnings': warnings,
-                    'daily_downloads': daily_downloads
+                    'daily_downloads': daily_downloads,
+                    'ip_unique_users': ip_users
                 }
                 
         except Exception as e:
@@ -392,18 +391,16 @@ class AntiPiracySystem:
     def block_suspicious_token(self, token: str, reason: str):
         """Bloqueia token suspeito"""
         try:
-            import sqlite3
-            
-            with sqlite3.connect(self.db.db_path) as conn:
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     UPDATE downloads 
                     SET max_downloads = 0
                     WHERE download_token = ?
                 ''', (token,))
-                conn.commit()
-                
-                logger.warning(f"Token bloqueado: {token}, Razão: {reason}")
+            
+            self.db.invalidate_download_token(token)
+            logger.warning(f"Token bloqueado: {token}, Razão: {reason}")
                 
         except Exception as e:
             logger.error(f"Erro ao bloquear token: {e}")
@@ -0,0 +1,251 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, Any, List, Callable
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_key(update) -> int:
+    """Chave de ordenação do update: o chat (ou usuário) a que ele pertence"""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, attr, None)
+        if message is not None:
+            return message.chat.id
+    
+    callback = getattr(update, 'callback_query', None)
+    if callback is not None:
+        if callback.message is not None:
+            return callback.message.chat.id
+        return callback.from_user.id
+    
+    for attr in ('pre_checkout_query', 'shipping_query', 'inline_query', 'chosen_inline_result'):
+        query = getattr(update, attr, None)
+        if query is not None:
+            return query.from_user.id
+    
+    return update.update_id
+
+
+def is_payment_update(update) -> bool:
+    """Pré-checkout e confirmação de pagamento: vão para a fila de pagamentos"""
+    if getattr(update, 'pre_checkout_query', None) is not None:
+        return True
+    message = getattr(update, 'message', None)
+    return message is not None and getattr(message, 'successful_payment', None) is not None
+
+
+def percentiles(samples: List[float], points=(50, 95, 99)) -> Dict[str, float]:
+    """Percentis (em ms) de uma amostra de latências em segundos"""
+    if not samples:
+        return {f'p{point}_ms': 0 for point in points}
+    ordered = sorted(samples)
+    return {
+        f'p{point}_ms': round(ordered[min(len(ordered) - 1, len(ordered) * point // 100)] * 1000, 3)
+        for point in points
+    }
+
+
+class LatencyHistogram:
+    """Histograma de latências em baldes fixos (ms), com percentis recentes e contagem de alertas"""
+    
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    
+    def __init__(self, alert_ms: float, buckets_ms=BUCKETS_MS):
+        self.alert_ms = alert_ms
+        self.buckets_ms = tuple(buckets_ms)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets_ms) + 1)
+        self._samples = deque(maxlen=2048)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._alerts = 0
+    
+    def observe(self, seconds: float) -> bool:
+        """Registra uma latência; True se passou do limite de alerta"""
+        elapsed_ms = seconds * 1000
+        alert = elapsed_ms > self.alert_ms
+        with self._lock:
+            self._counts[bisect_left(self.buckets_ms, elapsed_ms)] += 1
+            self._samples.append(seconds)
+            self._count += 1
+            self._total += elapsed_ms
+            self._max = max(self._max, elapsed_ms)
+            self._alerts += alert
+        return alert
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contagem por balde, percentis recentes e alertas"""
+        with self._lock:
+            samples = list(self._samples)
+            buckets = {f'le_{bound}ms': count for bound, count in zip(self.buckets_ms, self._counts)}
+            buckets[f'gt_{self.buckets_ms[-1]}ms'] = self._counts[-1]
+            stats = {
+                'count': self._count,
+                'mean_ms': round(self._total / self._count, 3) if self._count else 0,
+                'max_ms': round(self._max, 3),
+                'alert_ms': self.alert_ms,
+                'alerts': self._alerts,
+                'buckets': buckets
+            }
+        stats.update(percentiles(samples))
+        return stats
+
+
+class UpdateDispatcher:
+    """Fila limitada de updates servida por workers; cada chat cai sempre no mesmo worker (ordem garantida)"""
+    
+    _STOP = object()
+    
+    def __init__(self, handler: Callable, workers: int = None, max_queue: int = None,
+                 name: str = 'updates', payment_workers: int = None):
+        self.handler = handler
+        self.workers = workers or int(os.getenv('WEBHOOK_WORKERS', 8))
+        self.max_queue = max_queue or int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+        self.payment_workers = payment_workers or int(os.getenv('PAYMENT_WORKERS', 2))
+        self.name = name
+        
+        # Uma fila por worker: o limite total é dividido entre elas
+        shard_size = max(1, self.max_queue // self.workers)
+        self._queues = [queue.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        
+        # Pagamentos têm workers próprios: nunca esperam atrás de catálogo ou envios em massa
+        self._payment_queues = [queue.Queue(maxsize=shard_size) for _ in range(self.payment_workers)]
+        self._threads: List[threading.Thread] = []
+        self._closed = False
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        
+        # Contadores expostos em get_stats()
+        self._enqueued = 0
+        self._rejected = 0
+        self._processed = 0
+        self._failed = 0
+        self._busy = 0
+        self._handler_times = deque(maxlen=2048)
+        self._wait_times = deque(maxlen=2048)
+        self._payment_processed = 0
+        self._payment_wait_times = deque(maxlen=2048)
+        
+        for index, shard in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(shard, False),
+                                      name=f'{name}-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        for index, shard in enumerate(self._payment_queues):
+            thread = threading.Thread(target=self._run, args=(shard, True),
+                                      name=f'{name}-payment-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.close)
+    
+    def submit(self, update) -> bool:
+        """Enfileira o update; False se a fila do chat estiver cheia (o chamador deve recusar)"""
+        if self._closed:
+            return False
+        
+        shards = self._payment_queues if is_payment_update(update) else self._queues
+        shard = shards[hash(update_chat_key(update)) % len(shards)]
+        
+        # Conta antes de enfileirar: o worker nunca vê processed > enqueued
+        with self._lock:
+            self._enqueued += 1
+        try:
+            shard.put_nowait((update, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self._enqueued -= 1
+                self._rejected += 1
+            return False
+        return True
+    
+    def _run(self, shard: queue.Queue, payment: bool):
+        """Loop de um worker: processa os updates da sua fila em ordem"""
+        while True:
+            item = shard.get()
+            if item is self._STOP:
+                return
+            
+            update, enqueued_at = item
+            started = time.monotonic()
+            with self._lock:
+                self._busy += 1
+            try:
+                self.handler(update)
+                failed = False
+            except Exception as e:
+                failed = True
+                logger.error(f"Erro ao processar update {getattr(update, 'update_id', '?')}: {e}")
+            
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._busy -= 1
+                self._processed += 1
+                self._failed += failed
+                self._handler_times.append(elapsed)
+                self._wait_times.append(started - enqueued_at)
+                if payment:
+                    self._payment_processed += 1
+                    self._payment_wait_times.append(started - enqueued_at)
+                if self._processed == self._enqueued:
+                    self._idle.notify_all()
+    
+    def wait_idle(self, timeout: float = None) -> bool:
+        """Aguarda todos os updates enfileirados terminarem; False se o timeout vencer antes"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._processed == self._enqueued, timeout)
+    
+    def depth(self) -> int:
+        """Updates aguardando nas filas"""
+        return sum(shard.qsize() for shard in self._queues + self._payment_queues)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna profundidade das filas, vazão e latências recentes"""
+        with self._lock:
+            handler_times = list(self._handler_times)
+            wait_times = list(self._wait_times)
+            payment_wait_times = list(self._payment_wait_times)
+            stats = {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'depth': self.depth(),
+                'max_shard_depth': max(shard.qsize() for shard in self._queues),
+                'busy_workers': self._busy,
+                'enqueued': self._enqueued,
+                'rejected': self._rejected,
+                'processed': self._processed,
+                'failed': self._failed,
+                'payment_lane': {
+                    'workers': self.payment_workers,
+                    'depth': sum(shard.qsize() for shard in self._payment_queues),
+                    'processed': self._payment_processed,
+                    'queue_wait': percentiles(payment_wait_times)
+                }
+            }
+        
+        stats['handler_latency'] = {
+            **percentiles(handler_times),
+            'max_ms': round(max(handler_times, default=0) * 1000, 3)
+        }
+        stats['queue_wait'] = {
+            **percentiles(wait_times),
+            'max_ms': round(max(wait_times, default=0) * 1000, 3)
+        }
+        return stats
+    
+    def close(self, timeout: float = 10.0):
+        """Para de aceitar updates e aguarda os workers esvaziarem as filas"""
+        if self._closed:
+            return
+        self._closed = True
+        for shard in self._queues + self._payment_queues:
+            shard.put(self._STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
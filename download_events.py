@@ -0,0 +1,186 @@
+import os
+import atexit
+import logging
+import threading
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Deque
+
+import rollups
+
+logger = logging.getLogger(__name__)
+
+# Status HTTP que representam um download efetivamente servido
+SERVED_STATUSES = (200, 206)
+
+CREATE_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS download_events (
+        id INTEGER PRIMARY KEY,
+        occurred_at TIMESTAMP NOT NULL,
+        download_token TEXT NOT NULL,
+        download_id INTEGER,
+        user_id INTEGER,
+        product_id INTEGER,
+        ip TEXT,
+        user_agent TEXT,
+        bytes_served INTEGER NOT NULL DEFAULT 0,
+        range_start INTEGER,
+        range_end INTEGER,
+        status INTEGER NOT NULL,
+        latency_ms REAL,
+        reason TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_download_events_occurred_at ON download_events (occurred_at)',
+    'CREATE INDEX IF NOT EXISTS idx_download_events_user ON download_events (user_id, occurred_at)',
+    'CREATE INDEX IF NOT EXISTS idx_download_events_ip ON download_events (ip, occurred_at)',
+    'CREATE INDEX IF NOT EXISTS idx_download_events_token ON download_events (download_token)',
+]
+
+_COLUMNS = (
+    'occurred_at', 'download_token', 'download_id', 'user_id', 'product_id', 'ip',
+    'user_agent', 'bytes_served', 'range_start', 'range_end', 'status', 'latency_ms', 'reason'
+)
+
+
+class DownloadEventLog:
+    """Log append-only de downloads, gravado em lotes a partir de um buffer em memória"""
+    
+    def __init__(self, db_manager, flush_interval_ms: int = None, batch_size: int = None,
+                 max_buffer: int = None):
+        self.db = db_manager
+        self.flush_interval = (flush_interval_ms or int(os.getenv('DOWNLOAD_EVENTS_FLUSH_MS', 1000))) / 1000
+        self.batch_size = batch_size or int(os.getenv('DOWNLOAD_EVENTS_BATCH_SIZE', 500))
+        self.max_buffer = max_buffer or int(os.getenv('DOWNLOAD_EVENTS_MAX_BUFFER', 50000))
+        
+        # deque com maxlen descarta o evento mais antigo em O(1) quando o buffer enche
+        self._buffer: Deque[tuple] = deque(maxlen=self.max_buffer)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        
+        # Contadores expostos em get_stats()
+        self._recorded = 0
+        self._written = 0
+        self._batches = 0
+        self._dropped = 0
+        self._flush_errors = 0
+    
+    def record(self, download_token: str, status: int, ip: str = None, user_agent: str = None,
+               bytes_served: int = 0, range_start: int = None, range_end: int = None,
+               latency_ms: float = None, download_id: int = None, user_id: int = None,
+               product_id: int = None, reason: str = None):
+        """Enfileira um evento de download (não toca no banco)"""
+        occurred_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        event = (
+            occurred_at, download_token, download_id, user_id, product_id, ip,
+            user_agent, bytes_served, range_start, range_end, status,
+            round(latency_ms, 3) if latency_ms is not None else None, reason
+        )
+        
+        with self._lock:
+            if len(self._buffer) == self.max_buffer:
+                self._dropped += 1
+            self._buffer.append(event)
+            self._recorded += 1
+            pending = len(self._buffer)
+        
+        self._ensure_thread()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+    
+    def _ensure_thread(self):
+        """Inicia a thread de gravação no primeiro evento"""
+        if self._thread is not None or self._closed:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='download-events', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+    
+    def _run(self):
+        """Loop da thread de gravação"""
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def flush(self) -> int:
+        """Grava os eventos pendentes numa única transação e compacta os contadores"""
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return 0
+            
+            try:
+                with self.db.connection() as conn:
+                    conn.executemany(f'''
+                        INSERT INTO download_events ({', '.join(_COLUMNS)})
+                        VALUES ({', '.join('?' for _ in _COLUMNS)})
+                    ''', batch)
+                    self._compact(conn, batch)
+            except Exception as e:
+                logger.error(f"Erro ao gravar {len(batch)} eventos de download: {e}")
+                self._flush_errors += 1
+                with self._lock:
+                    # Devolve o lote ao buffer respeitando o limite
+                    room = self.max_buffer - len(self._buffer)
+                    self._dropped += max(0, len(batch) - room)
+                    if room:
+                        self._buffer.extendleft(reversed(batch[-room:]))
+                return 0
+            
+            self._written += len(batch)
+            self._batches += 1
+            return len(batch)
+    
+    @staticmethod
+    def _compact(conn, batch: List[tuple]):
+        """Deriva do lote o último acesso de cada download e os rollups por horário de acesso"""
+        last_access: Dict[int, str] = {}
+        served = Counter()
+        for event in batch:
+            occurred_at, download_id, product_id, status = event[0], event[2], event[4], event[10]
+            if status not in SERVED_STATUSES or download_id is None:
+                continue
+            if occurred_at > last_access.get(download_id, ''):
+                last_access[download_id] = occurred_at
+            if product_id is not None:
+                served[(product_id, occurred_at[:13] + ':00:00')] += 1
+        
+        if last_access:
+            conn.executemany('''
+                UPDATE downloads
+                SET last_access = ?
+                WHERE id = ? AND (last_access IS NULL OR last_access < ?)
+            ''', [(at, download_id, at) for download_id, at in last_access.items()])
+        
+        for (product_id, hour), count in served.items():
+            rollups.bump(conn, product_id, at=hour, downloads=count)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores do log de eventos"""
+        return {
+            'buffered': len(self._buffer),
+            'recorded': self._recorded,
+            'written': self._written,
+            'batches': self._batches,
+            'dropped': self._dropped,
+            'flush_errors': self._flush_errors
+        }
+    
+    def close(self):
+        """Grava o que estiver no buffer e encerra a thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self.flush()
@@ -1,12 +1,12 @@
 import os
 import logging
-import sqlite3
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
 from flask import Flask, request, jsonify, send_file, abort, render_template_string
 from flask_cors import CORS
 from database import DatabaseManager
 from payment_processor import PaymentProcessor
+import rollups
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +76,9 @@ class DownloadManager:
                 'success': True,
                 'file_path': file_path,
                 'filename': f"{download_access['product_name']}.mp4",
+                'download_id': download_access['id'],
+                'user_id': download_access['user_id'],
+                'product_id': download_access['product_id'],
                 'download_count': download_access['download_count'] + 1,
                 'max_downloads': download_access['max_downloads']
             }
@@ -101,70 +104,46 @@ class DownloadManager:
         logger.info(f"Download realizado: {log_entry}")
     
     def get_download_stats(self, days: int = 30) -> Dict[str, Any]:
-        """Retorna estatísticas de downloads"""
-        with sqlite3.connect(self.db.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Downloads por período
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_downloads,
-                    COUNT(DISTINCT user_id) as unique_users,
-                    COUNT(DISTINCT product_id) as products_downloaded
-                FROM downloads 
-                WHERE last_access >= datetime('now', '-{} days')
-                AND download_count > 0
-            '''.format(days))
-            
-            stats = cursor.fetchone()
+        """Retorna estatísticas de downloads (a partir dos rollups)"""
+        with self.db.connection() as conn:
+            products = rollups.window_totals(conn, days)
             
-            # Produtos mais baixados
+            # Usuários distintos não somam entre baldes: consulta indexada no log de eventos
+            cursor = conn.cursor()
             cursor.execute('''
-                SELECT 
-                    p.name,
-                    SUM(d.download_count) as total_downloads
-                FROM downloads d
-                JOIN products p ON d.product_id = p.id
-                WHERE d.last_access >= datetime('now', '-{} days')
-                AND d.download_count > 0
-                GROUP BY p.id, p.name
-                ORDER BY total_downloads DESC
-                LIMIT 5
-            '''.format(days))
-            
-            top_downloads = cursor.fetchall()
-            
-            return {
-                'period_days': days,
-                'total_downloads': stats[0] or 0,
-                'unique_users': stats[1] or 0,
-                'products_downloaded': stats[2] or 0,
-                'top_downloads': [
-                    {
-                        'product_name': row[0],
-                        'download_count': row[1]
-                    }
-                    for row in top_downloads
-                ]
-            }
+                SELECT COUNT(DISTINCT user_id)
+                FROM download_events 
+                WHERE occurred_at >= datetime('now', ?)
+                AND status IN (200, 206)
+            ''', (f'-{int(days)} days',))
+            unique_users = cursor.fetchone()[0]
+        
+        downloaded = [row for row in products if row['downloads'] > 0]
+        
+        # Produtos mais baixados
+        top_downloads = sorted(downloaded, key=lambda row: row['downloads'], reverse=True)[:5]
+        
+        return {
+            'period_days': days,
+            'total_downloads': sum(row['downloads'] for row in downloaded),
+            'unique_users': unique_users or 0,
+            'products_downloaded': len(downloaded),
+            'top_downloads': [
+                {
+                    'product_name': row['name'],
+                    'download_count': row['downloads']
+                }
+                for row in top_downloads
+            ]
+        }
     
     def cleanup_expired_tokens(self):
-        """Remove tokens expirados do banco de dados"""
+        """Arquiva tokens expirados em lotes curtos, mantendo o histórico"""
         try:
-            with sqlite3.connect(self.db.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    DELETE FROM downloads 
-                    WHERE expires_at < datetime('now')
-                ''')
-                deleted_count = cursor.rowcount
-                conn.commit()
-                
-                if deleted_count > 0:
-                    logger.info(f"Removidos {deleted_count} tokens expirados")
-                
-                return deleted_count
-                
+            archived = self.db.archive_expired_downloads()['archived']
+            if archived > 0:
+                logger.info(f"Arquivados {archived} tokens expirados")
+            return archived
         except Exception as e:
             logger.error(f"Erro na limpeza de tokens: {e}")
             return 0
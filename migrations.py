@@ -0,0 +1,347 @@
+import os
+import re
+import ast
+import sys
+import glob
+import sqlite3
+import logging
+from typing import List, Dict, Any, Optional
+
+import search
+import rollups
+import refunds
+import download_events
+
+logger = logging.getLogger(__name__)
+
+# Tabelas que crescem com o histórico e nunca devem ser varridas por inteiro
+LARGE_TABLES = {'users', 'transactions', 'downloads', 'downloads_archive', 'download_events'}
+
+# Marcador para consultas que varrem a tabela de propósito (ex.: backfill)
+FULL_SCAN_OK = '-- full-scan-ok'
+
+
+# Cada migração: (versão, descrição, passos). Um passo é um SQL ou uma
+# função que recebe o cursor. Migrações são aplicadas uma única vez e
+# nunca devem ser editadas depois de publicadas: crie uma nova versão.
+MIGRATIONS = [
+    (1, 'Tabelas iniciais', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            price_stars INTEGER NOT NULL,
+            file_path TEXT NOT NULL,
+            thumbnail_path TEXT,
+            file_size INTEGER,
+            duration_seconds INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            amount_stars INTEGER NOT NULL,
+            telegram_payment_id TEXT UNIQUE,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS downloads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            download_token TEXT UNIQUE NOT NULL,
+            download_count INTEGER DEFAULT 0,
+            max_downloads INTEGER DEFAULT 3,
+            last_access TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            description TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'Índices das consultas de limpeza, relatórios e anti-pirataria', [
+        'CREATE INDEX IF NOT EXISTS idx_downloads_expires_at ON downloads (expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_user_last_access ON downloads (user_id, last_access)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_transaction_id ON downloads (transaction_id)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_last_access ON downloads (last_access)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_created_at ON downloads (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_product_id ON downloads (product_id)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_status_created ON transactions (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_product_status ON transactions (product_id, status)',
+    ]),
+    (3, 'Rollups horários/diários de vendas e downloads por produto', [
+        *rollups.CREATE_STATEMENTS,
+        rollups.backfill,
+    ]),
+    (4, 'Log append-only de eventos de download', download_events.CREATE_STATEMENTS),
+    (5, 'Arquivo de downloads expirados', [
+        '''
+        CREATE TABLE IF NOT EXISTS downloads_archive (
+            id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            download_token TEXT NOT NULL,
+            download_count INTEGER DEFAULT 0,
+            max_downloads INTEGER DEFAULT 3,
+            last_access TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_archive_created_at ON downloads_archive (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_downloads_archive_transaction_id ON downloads_archive (transaction_id)',
+    ]),
+    (6, 'Janela de update_ids recebidos pelo webhook', [
+        '''
+        CREATE TABLE IF NOT EXISTS webhook_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (7, 'Categoria dos produtos (filtro do catálogo paginado)', [
+        'ALTER TABLE products ADD COLUMN category TEXT',
+    ]),
+    (8, 'file_ids do Telegram por bot e produto (evita reenviar arquivos)', [
+        '''
+        CREATE TABLE IF NOT EXISTS product_file_ids (
+            bot_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            source_path TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_id, product_id, kind)
+        )
+        ''',
+    ]),
+    (9, 'Modo de entrega por produto (link HTTP ou vídeo pelo Telegram)', [
+        'ALTER TABLE products ADD COLUMN delivery_mode TEXT',
+    ]),
+    (10, 'Índice FTS5 de nome e descrição dos produtos (busca inline)', search.CREATE_STATEMENTS),
+    (11, 'Updates do long polling já confirmados ao Telegram e ainda não processados', [
+        '''
+        CREATE TABLE IF NOT EXISTS polled_updates (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (12, 'Lotes de reembolso com checkpoint por transação', refunds.CREATE_STATEMENTS),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Retorna a versão atual do esquema (0 se nunca migrado)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn: sqlite3.Connection) -> List[int]:
+    """Aplica as migrações pendentes, cada uma em sua própria transação"""
+    applied = []
+    if get_schema_version(conn) >= LATEST_VERSION:
+        return applied
+    
+    if conn.in_transaction:
+        conn.commit()
+    
+    for version, description, steps in MIGRATIONS:
+        # BEGIN IMMEDIATE serializa processos que iniciam ao mesmo tempo
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            
+            cursor = conn.cursor()
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        applied.append(version)
+        logger.info(f"Migração {version} aplicada: {description}")
+    
+    return applied
+
+
+_SQL_START = re.compile(r'^\s*(SELECT|UPDATE|DELETE|INSERT|REPLACE|WITH)\s')
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_SQL_KEYWORDS = {
+    'where', 'join', 'left', 'inner', 'outer', 'cross', 'on', 'group', 'order',
+    'limit', 'set', 'values', 'using', 'select', 'returning', 'union', 'having',
+    'natural', 'as', 'default'
+}
+
+
+def collect_queries(paths: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Extrai as consultas SQL literais dos módulos Python do projeto"""
+    if paths is None:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        paths = sorted(glob.glob(os.path.join(base_dir, '*.py')))
+    
+    queries = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=path)
+        
+        # Partes de f-strings não são consultas completas
+        fstring_parts = {
+            id(value)
+            for node in ast.walk(tree) if isinstance(node, ast.JoinedStr)
+            for value in node.values
+        }
+        
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Constant) or not isinstance(node.value, str):
+                continue
+            if id(node) in fstring_parts or not _SQL_START.match(node.value):
+                continue
+            queries.append({
+                'file': os.path.basename(path),
+                'line': node.lineno,
+                'sql': node.value.strip()
+            })
+    
+    return queries
+
+
+def _table_aliases(sql: str) -> Dict[str, str]:
+    """Mapeia apelidos (e nomes) usados na consulta para a tabela real"""
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in _SQL_KEYWORDS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def check_query_plans(conn: sqlite3.Connection,
+                      queries: Optional[List[Dict[str, Any]]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Roda EXPLAIN QUERY PLAN em cada consulta e aponta varreduras nas tabelas grandes"""
+    if queries is None:
+        queries = collect_queries()
+    
+    report = {'ok': [], 'full_scans': [], 'errors': []}
+    for query in queries:
+        sql = query['sql']
+        # Placeholders de str.format viram um número qualquer
+        prepared = re.sub(r'\{[^{}]*\}', '1', sql)
+        params = [None] * prepared.count('?')
+        
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {prepared}", params).fetchall()
+        except sqlite3.Error as e:
+            report['errors'].append({**query, 'error': str(e)})
+            continue
+        
+        aliases = _table_aliases(sql)
+        scans = []
+        for row in plan:
+            detail = row[3]
+            match = re.match(r'SCAN (\w+)', detail)
+            if not match:
+                continue
+            table = aliases.get(match.group(1).lower(), match.group(1).lower())
+            if table in LARGE_TABLES:
+                scans.append(detail)
+        
+        if scans and FULL_SCAN_OK not in sql:
+            report['full_scans'].append({**query, 'plan': scans})
+        else:
+            report['ok'].append(query)
+    
+    return report
+
+
+def main(argv: List[str] = None) -> int:
+    """Aplica migrações (padrão) ou verifica planos de consulta (--check)"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Migrações do esquema do banco de dados')
+    parser.add_argument('--db', default='bot_database.db',
+                        help='Arquivo do banco (use :memory: para um esquema vazio)')
+    parser.add_argument('--check', action='store_true',
+                        help='Falha se alguma consulta varrer uma tabela grande')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    conn = sqlite3.connect(args.db)
+    try:
+        applied = apply_migrations(conn)
+        print(f"📦 Esquema na versão {get_schema_version(conn)} "
+              f"({len(applied)} migrações aplicadas agora)")
+        
+        if not args.check:
+            return 0
+        
+        report = check_query_plans(conn)
+        for item in report['errors']:
+            print(f"⚠️  {item['file']}:{item['line']} não pôde ser analisada: {item['error']}")
+        for item in report['full_scans']:
+            print(f"❌ {item['file']}:{item['line']} varre tabela grande: {'; '.join(item['plan'])}")
+        
+        print(f"✅ {len(report['ok'])} consultas OK, "
+              f"{len(report['full_scans'])} com varredura, {len(report['errors'])} com erro")
+        return 1 if report['full_scans'] else 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
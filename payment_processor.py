@@ -1,4 +1,8 @@
 import os
+import time
+import base64
+import struct
+import secrets
 import logging
 import hashlib
 import hmac
@@ -6,15 +10,66 @@ import json
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
 from database import DatabaseManager
+import rollups
 
 logger = logging.getLogger(__name__)
 
+# Payload assinado: prefixo + base64url(usuário, produto, preço, nonce, expiração + HMAC truncado)
+SIGNED_PAYLOAD_PREFIX = 's1.'
+_PAYLOAD_STRUCT = struct.Struct('>qIIII')
+_SIGNATURE_SIZE = 12
+
+
+def sign_invoice_payload(key: bytes, telegram_user_id: int, product_id: int, price_stars: int,
+                         ttl_seconds: int) -> str:
+    """Gera o invoice_payload assinado (cabe com folga no limite de 128 bytes do Telegram)"""
+    body = _PAYLOAD_STRUCT.pack(telegram_user_id, product_id, price_stars,
+                                secrets.randbits(32), int(time.time()) + ttl_seconds)
+    signature = hmac.new(key, body, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+    return SIGNED_PAYLOAD_PREFIX + base64.urlsafe_b64encode(body + signature).decode().rstrip('=')
+
+
+def parse_invoice_payload(key: bytes, payload: str) -> Optional[Dict[str, Any]]:
+    """Decodifica um payload assinado; None se estiver malformado ou a assinatura não conferir"""
+    try:
+        encoded = payload[len(SIGNED_PAYLOAD_PREFIX):]
+        raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (ValueError, TypeError):
+        return None
+    if len(raw) != _PAYLOAD_STRUCT.size + _SIGNATURE_SIZE:
+        return None
+    
+    body, signature = raw[:_PAYLOAD_STRUCT.size], raw[_PAYLOAD_STRUCT.size:]
+    expected = hmac.new(key, body, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+    if not hmac.compare_digest(signature, expected):
+        return None
+    
+    user_id, product_id, price_stars, nonce, expires_at = _PAYLOAD_STRUCT.unpack(body)
+    return {
+        'telegram_user_id': user_id,
+        'product_id': product_id,
+        'price_stars': price_stars,
+        'nonce': nonce,
+        'expires_at': expires_at
+    }
+
+
+def is_signed_payload(payload) -> bool:
+    return isinstance(payload, str) and payload.startswith(SIGNED_PAYLOAD_PREFIX)
+
+
 class PaymentProcessor:
     """Processador de pagamentos para Telegram Stars"""
     
     def __init__(self, db_manager: DatabaseManager, bot_token: str):
         self.db = db_manager
         self.bot_token = bot_token
+        
+        # INVOICE_MODE=signed: fatura sem linha pendente no banco (payload assinado com HMAC)
+        self.signed_invoices = os.getenv('INVOICE_MODE', 'transaction').lower() == 'signed'
+        self.invoice_ttl = int(os.getenv('INVOICE_TTL_MINUTES', 60)) * 60
+        secret = os.getenv('INVOICE_SECRET') or f"invoice:{bot_token}"
+        self._invoice_key = hashlib.sha256(secret.encode()).digest()
     
     def validate_payment_data(self, payment_data: Dict[str, Any]) -> bool:
         """Valida dados de pagamento recebidos do Telegram"""
@@ -43,26 +98,36 @@ class PaymentProcessor:
             logger.error(f"Erro na validação de pagamento: {e}")
             return False
     
-    def process_pre_checkout(self, query_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Processa query de pré-checkout"""
+    def create_invoice_payload(self, telegram_user_id: int, product: Dict[str, Any]) -> str:
+        """Payload assinado da fatura (modo signed): nada é gravado até o pagamento"""
+        return sign_invoice_payload(self._invoice_key, telegram_user_id, product['id'],
+                                    product['price_stars'], self.invoice_ttl)
+    
+    def process_pre_checkout(self, query_data: Dict[str, Any], cached_only: bool = False) -> Optional[Dict[str, Any]]:
+        """Processa query de pré-checkout (cached_only: None se a transação não estiver na memória)"""
+        if is_signed_payload(query_data.get('invoice_payload')):
+            return self._pre_checkout_signed(query_data)
+        
         try:
             transaction_id = int(query_data.get('invoice_payload', 0))
             
-            # Buscar transação no banco
-            transaction = self.get_transaction_by_id(transaction_id)
+            # Transação pendente e produto vêm da memória: o caminho de aprovação não consulta o banco
+            transaction = self.db.get_pending_transaction(transaction_id, cached_only=cached_only)
             if not transaction:
+                if cached_only:
+                    return None
+                
+                # Rejeição: só aqui o banco diz se a transação existe
+                if self.get_transaction_by_id(transaction_id):
+                    return {
+                        'ok': False,
+                        'error_message': 'Transação já processada'
+                    }
                 return {
                     'ok': False,
                     'error_message': 'Transação não encontrada'
                 }
             
-            # Verificar se transação já foi processada
-            if transaction['status'] != 'pending':
-                return {
-                    'ok': False,
-                    'error_message': 'Transação já processada'
-                }
-            
             # Buscar produto
             product = self.db.get_product_by_id(transaction['product_id'])
             if not product or not product['is_active']:
@@ -90,44 +155,66 @@ class PaymentProcessor:
                 'error_message': 'Erro interno do servidor'
             }
     
+    def _pre_checkout_signed(self, query_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Valida um payload assinado só com a assinatura e o catálogo em memória (sem consultar o banco)"""
+        invoice = parse_invoice_payload(self._invoice_key, query_data['invoice_payload'])
+        if invoice is None:
+            logger.warning("Pré-checkout com payload de fatura inválido")
+            return {'ok': False, 'error_message': 'Fatura inválida'}
+        
+        if invoice['expires_at'] < time.time():
+            return {'ok': False, 'error_message': 'Fatura expirada. Use /catalogo para gerar outra.'}
+        
+        if invoice['telegram_user_id'] != (query_data.get('from') or {}).get('id'):
+            return {'ok': False, 'error_message': 'Fatura emitida para outro usuário'}
+        
+        product = self.db.get_product_by_id(invoice['product_id'])
+        if not product or not product['is_active']:
+            return {'ok': False, 'error_message': 'Produto não disponível'}
+        
+        # O preço assinado precisa bater com o cobrado e com o preço atual
+        price = invoice['price_stars']
+        if query_data.get('total_amount') != price or price != product['price_stars']:
+            return {'ok': False, 'error_message': 'Valor incorreto'}
+        
+        return {'ok': True}
+    
     def process_successful_payment(self, payment_data: Dict[str, Any], user_id: int) -> Dict[str, Any]:
-        """Processa pagamento bem-sucedido"""
+        """Processa pagamento bem-sucedido (idempotente: reentregas devolvem o download existente)"""
+        completed = False
         try:
             # Validar dados do pagamento
             if not self.validate_payment_data(payment_data):
                 raise ValueError("Dados de pagamento inválidos")
             
-            transaction_id = int(payment_data['invoice_payload'])
+            if is_signed_payload(payment_data['invoice_payload']):
+                return self._complete_signed_payment(payment_data, user_id)
             
-            # Buscar transação
-            transaction = self.get_transaction_by_id(transaction_id)
-            if not transaction:
-                raise ValueError("Transação não encontrada")
-            
-            # Verificar se já foi processada
-            if transaction['status'] == 'completed':
-                logger.warning(f"Transação {transaction_id} já foi processada")
-                return self.get_existing_download_info(transaction_id)
+            transaction_id = int(payment_data['invoice_payload'])
             
-            # Atualizar transação
-            self.db.update_transaction_payment(
+            # Conclusão e download numa única transação; só uma entrega concorrente vence
+            download_token, expiry_hours, max_downloads = self._new_download_settings()
+            purchase = self.db.complete_payment(
                 transaction_id=transaction_id,
                 telegram_payment_id=payment_data['telegram_payment_charge_id'],
-                status='completed'
+                download_token=download_token,
+                expiry_hours=expiry_hours,
+                max_downloads=max_downloads
             )
             
-            # Gerar acesso de download
-            download_info = self.create_download_access(transaction)
+            if purchase is None:
+                completed = True
+                logger.warning(f"Transação {transaction_id} já foi processada")
+                return self._existing_download(transaction_id)
             
-            # Log da transação
+            completed = True
             self.log_transaction(transaction_id, payment_data, 'completed')
-            
-            return download_info
+            return self._download_info(purchase, download_token, max_downloads, created=True)
             
         except Exception as e:
             logger.error(f"Erro ao processar pagamento: {e}")
-            # Marcar transação como erro
-            if 'transaction_id' in locals():
+            # Marcar transação como erro (nunca uma que já foi concluída)
+            if 'transaction_id' in locals() and not completed:
                 self.db.update_transaction_payment(
                     transaction_id=transaction_id,
                     telegram_payment_id=payment_data.get('telegram_payment_charge_id', ''),
@@ -135,16 +222,76 @@ class PaymentProcessor:
                 )
             raise
     
-    def create_download_access(self, transaction: Dict[str, Any]) -> Dict[str, Any]:
-        """Cria acesso de download para uma transação"""
-        import secrets
+    def _existing_download(self, transaction_id: int) -> Dict[str, Any]:
+        """Download de uma transação já concluída por outra entrega do mesmo pagamento"""
+        download_info = self.get_existing_download_info(transaction_id)
+        if download_info is not None:
+            download_info['created'] = False
+            return download_info
+        
+        transaction = self.get_transaction_by_id(transaction_id)
+        if not transaction:
+            raise ValueError("Transação não encontrada")
+        if transaction['status'] != 'completed':
+            raise ValueError(f"Transação {transaction_id} não pode ser concluída (status {transaction['status']})")
+        
+        # Concluída sem download (gravada antes da conclusão atômica): cria o acesso agora
+        return self.create_download_access(transaction)
+    
+    def _complete_signed_payment(self, payment_data: Dict[str, Any], telegram_user_id: int) -> Dict[str, Any]:
+        """Grava a transação (já concluída) de uma fatura assinada; reentregas devolvem o download existente"""
+        invoice = parse_invoice_payload(self._invoice_key, payment_data['invoice_payload'])
+        if invoice is None:
+            raise ValueError("Payload de fatura inválido")
         
-        # Gerar token único
-        download_token = secrets.token_urlsafe(32)
+        # O Telegram já cobrou: a expiração não vale mais aqui, e o acesso vai para quem pagou
+        charge_id = payment_data['telegram_payment_charge_id']
+        user_id = self.db.get_or_create_user_id(telegram_user_id)
+        download_token, expiry_hours, max_downloads = self._new_download_settings()
+        purchase = self.db.create_completed_purchase(
+            user_id=user_id,
+            product_id=invoice['product_id'],
+            amount_stars=payment_data['total_amount'],
+            telegram_payment_id=charge_id,
+            download_token=download_token,
+            expiry_hours=expiry_hours,
+            max_downloads=max_downloads
+        )
         
-        # Configurações padrão
-        expiry_hours = int(os.getenv('DOWNLOAD_EXPIRY_HOURS', 24))
-        max_downloads = int(os.getenv('MAX_DOWNLOADS_PER_PURCHASE', 3))
+        if purchase is None:
+            logger.warning(f"Pagamento {charge_id} já foi processado")
+            return self._existing_download(self.db.get_transaction_id_by_payment(charge_id))
+        
+        self.log_transaction(purchase['transaction_id'], payment_data, 'completed')
+        return self._download_info(purchase, download_token, max_downloads, created=True)
+    
+    @staticmethod
+    def _new_download_settings():
+        """Token novo, validade (horas) e limite de downloads de um acesso"""
+        return (
+            secrets.token_urlsafe(32),
+            int(os.getenv('DOWNLOAD_EXPIRY_HOURS', 24)),
+            int(os.getenv('MAX_DOWNLOADS_PER_PURCHASE', 3))
+        )
+    
+    @staticmethod
+    def _download_info(purchase: Dict[str, Any], download_token: str, max_downloads: int,
+                       created: bool) -> Dict[str, Any]:
+        base_url = os.getenv('WEBHOOK_URL', 'http://localhost:5000')
+        return {
+            'download_id': purchase['download_id'],
+            'download_token': download_token,
+            'download_url': f"{base_url}/download/{download_token}",
+            'product_id': purchase['product_id'],
+            'product_name': purchase['product_name'],
+            'expires_at': purchase['expires_at'].isoformat(),
+            'max_downloads': max_downloads,
+            'created': created
+        }
+    
+    def create_download_access(self, transaction: Dict[str, Any]) -> Dict[str, Any]:
+        """Cria acesso de download para uma transação"""
+        download_token, expiry_hours, max_downloads = self._new_download_settings()
         
         # Criar registro de download
         download_id = self.db.create_download_access(
@@ -156,26 +303,17 @@ class PaymentProcessor:
             max_downloads=max_downloads
         )
         
-        # Buscar informações do produto
         product = self.db.get_product_by_id(transaction['product_id'])
-        
-        # Gerar URL de download
-        base_url = os.getenv('WEBHOOK_URL', 'http://localhost:5000')
-        download_url = f"{base_url}/download/{download_token}"
-        
-        return {
+        return self._download_info({
             'download_id': download_id,
-            'download_token': download_token,
-            'download_url': download_url,
-            'product_name': product['name'],
-            'expires_at': (datetime.now() + timedelta(hours=expiry_hours)).isoformat(),
-            'max_downloads': max_downloads
-        }
+            'product_id': transaction['product_id'],
+            'product_name': product['name'] if product else None,
+            'expires_at': datetime.now() + timedelta(hours=expiry_hours)
+        }, download_token, max_downloads, created=True)
     
     def get_existing_download_info(self, transaction_id: int) -> Dict[str, Any]:
         """Busca informações de download existentes para uma transação"""
-        with sqlite3.connect(self.db.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self.db.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT d.*, p.name as product_name
@@ -194,6 +332,7 @@ class PaymentProcessor:
                     'download_id': download['id'],
                     'download_token': download['download_token'],
                     'download_url': download_url,
+                    'product_id': download['product_id'],
                     'product_name': download['product_name'],
                     'expires_at': download['expires_at'],
                     'max_downloads': download['max_downloads'],
@@ -204,10 +343,7 @@ class PaymentProcessor:
     
     def get_transaction_by_id(self, transaction_id: int) -> Optional[Dict[str, Any]]:
         """Busca transação por ID"""
-        import sqlite3
-        
-        with sqlite3.connect(self.db.db_path) as conn:
-            conn.row_factory = sqlite3.Row
+        with self.db.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE id = ?", (transaction_id,))
             row = cursor.fetchone()
@@ -226,62 +362,44 @@ class PaymentProcessor:
         
         logger.info(f"Transação processada: {json.dumps(log_entry)}")
     
-    def refund_payment(self, telegram_payment_id: str) -> bool:
-        """Processa reembolso (funcionalidade futura)"""
-        # Implementar lógica de reembolso quando necessário
-        # Por enquanto, apenas log
+    def refund_payment(self, telegram_payment_id: str, reason: str = None) -> bool:
+        """Reembolsa um pagamento pelo refundStarPayment e revoga o download; True se reembolsado"""
+        from refunds import RefundEngine
+        
         logger.info(f"Solicitação de reembolso para pagamento: {telegram_payment_id}")
-        return False
+        engine = RefundEngine(self, workers=1)
+        job_id, total = engine.create_job(payment_ids=[telegram_payment_id], reason=reason)
+        if not total:
+            logger.warning(f"Pagamento {telegram_payment_id} não encontrado, não concluído ou já em reembolso")
+            return False
+        return engine.run(job_id)['refunded'] == total
     
     def get_payment_statistics(self, days: int = 30) -> Dict[str, Any]:
-        """Retorna estatísticas de pagamento"""
-        import sqlite3
+        """Retorna estatísticas de pagamento (a partir dos rollups)"""
+        with self.db.connection() as conn:
+            products = rollups.window_totals(conn, days)
         
-        with sqlite3.connect(self.db.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Total de vendas nos últimos X dias
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_sales,
-                    SUM(amount_stars) as total_revenue,
-                    AVG(amount_stars) as avg_sale_value
-                FROM transactions 
-                WHERE status = 'completed' 
-                AND created_at >= datetime('now', '-{} days')
-            '''.format(days))
-            
-            stats = cursor.fetchone()
-            
-            # Produtos mais vendidos
-            cursor.execute('''
-                SELECT 
-                    p.name,
-                    COUNT(*) as sales_count,
-                    SUM(t.amount_stars) as revenue
-                FROM transactions t
-                JOIN products p ON t.product_id = p.id
-                WHERE t.status = 'completed'
-                AND t.created_at >= datetime('now', '-{} days')
-                GROUP BY p.id, p.name
-                ORDER BY sales_count DESC
-                LIMIT 5
-            '''.format(days))
-            
-            top_products = cursor.fetchall()
-            
-            return {
-                'period_days': days,
-                'total_sales': stats[0] or 0,
-                'total_revenue': stats[1] or 0,
-                'average_sale_value': stats[2] or 0,
-                'top_products': [
-                    {
-                        'name': row[0],
-                        'sales_count': row[1],
-                        'revenue': row[2]
-                    }
-                    for row in top_products
-                ]
-            }
-
+        total_sales = sum(row['sales'] for row in products)
+        total_revenue = sum(row['revenue'] for row in products)
+        
+        # Produtos mais vendidos
+        top_products = sorted(
+            (row for row in products if row['sales'] > 0),
+            key=lambda row: row['sales'],
+            reverse=True
+        )[:5]
+        
+        return {
+            'period_days': days,
+            'total_sales': total_sales,
+            'total_revenue': total_revenue,
+            'average_sale_value': total_revenue / total_sales if total_sales else 0,
+            'top_products': [
+                {
+                    'name': row['name'],
+                    'sales_count': row['sales'],
+                    'revenue': row['revenue']
+                }
+                for row in top_products
+            ]
+        }
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+from telebot import apihelper, types
+
+from dispatcher import UpdateDispatcher, percentiles
+
+logger = logging.getLogger(__name__)
+
+# Tipos de update que os handlers tratam; o Telegram não envia os demais
+ALLOWED_UPDATES = ['message', 'callback_query', 'pre_checkout_query', 'inline_query']
+
+
+class PollingRunner:
+    """Long polling com offset persistido no banco e updates processados em ordem por chat"""
+    
+    def __init__(self, telegram_bot, workers: int = None, timeout: int = None, limit: int = None):
+        self.telegram_bot = telegram_bot
+        self.db = telegram_bot.db
+        self.token = telegram_bot.bot.token
+        self.timeout = timeout or int(os.getenv('POLLING_TIMEOUT', 30))
+        self.limit = limit or int(os.getenv('POLLING_LIMIT', 100))
+        self.stats_interval = int(os.getenv('POLLING_STATS_INTERVAL', 300))
+        
+        # Offset = próximo update_id esperado; ao ser enviado no getUpdates, confirma os anteriores
+        self.offset_key = f'polling_offset:{telegram_bot.bot_id}'
+        
+        self.dispatcher = UpdateDispatcher(
+            self._handle,
+            workers=workers or int(os.getenv('POLLING_WORKERS', 8)),
+            max_queue=max(self.limit * 8, 1000),
+            name='polling'
+        )
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        
+        # Contadores expostos em get_stats()
+        self._offset: Optional[int] = None
+        self._polls = 0
+        self._empty_polls = 0
+        self._errors = 0
+        self._updates = 0
+        self._recovered = 0
+        self._poll_times = deque(maxlen=2048)
+        self._store_times = deque(maxlen=2048)
+        self._batch_sizes = deque(maxlen=2048)
+    
+    def _handle(self, update: types.Update):
+        """Processa o update e o retira da tabela polled_updates (um reinício não o repete)"""
+        try:
+            self.telegram_bot.handle_update(update)
+        finally:
+            self.db.finish_polled_update(update.update_id)
+    
+    def load_offset(self) -> Optional[int]:
+        """Último offset confirmado, gravado no banco"""
+        value = self.db.get_setting(self.offset_key)
+        return int(value) if value else None
+    
+    def _dispatch(self, updates: List[types.Update]):
+        for update in updates:
+            while not self.dispatcher.submit(update):
+                # Fila do chat cheia: espera os workers esvaziarem em vez de descartar
+                self.dispatcher.wait_idle(1.0)
+    
+    def recover(self) -> int:
+        """Reprocessa updates confirmados ao Telegram mas não concluídos antes da última parada"""
+        updates = [types.Update.de_json(payload) for payload in self.db.get_polled_updates()]
+        self._dispatch(updates)
+        with self._lock:
+            self._recovered += len(updates)
+        return len(updates)
+    
+    def poll_once(self, offset: Optional[int]) -> Optional[int]:
+        """Busca um lote, grava-o com o novo offset e o entrega aos workers; devolve o offset"""
+        started = time.monotonic()
+        raw_updates = apihelper.get_updates(
+            self.token, offset, self.limit, timeout=10,
+            allowed_updates=ALLOWED_UPDATES, long_polling_timeout=self.timeout
+        )
+        polled = time.monotonic()
+        
+        with self._lock:
+            self._polls += 1
+            if not raw_updates:
+                self._empty_polls += 1
+            else:
+                # Polls vazios duram o timeout inteiro: só os com updates medem a latência real
+                self._poll_times.append(polled - started)
+                self._batch_sizes.append(len(raw_updates))
+        if not raw_updates:
+            return offset
+        
+        # O próximo getUpdates confirma este lote ao Telegram: antes disso ele fica gravado
+        # no banco, junto com o offset, e sobrevive a uma queda sem segurar o polling
+        offset = max(raw['update_id'] for raw in raw_updates) + 1
+        self.db.store_polled_updates(
+            self.offset_key, offset,
+            [(raw['update_id'], json.dumps(raw)) for raw in raw_updates]
+        )
+        with self._lock:
+            self._offset = offset
+            self._updates += len(raw_updates)
+            self._store_times.append(time.monotonic() - polled)
+        
+        self._dispatch([types.Update.de_json(raw) for raw in raw_updates])
+        return offset
+    
+    def run(self):
+        """Loop de polling até stop() ou Ctrl+C"""
+        offset = self.load_offset()
+        with self._lock:
+            self._offset = offset
+        recovered = self.recover()
+        logger.info(f"Polling iniciado (offset {offset}, {recovered} updates recuperados, "
+                    f"updates: {', '.join(ALLOWED_UPDATES)})")
+        
+        backoff = 1
+        last_stats = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                try:
+                    offset = self.poll_once(offset)
+                    backoff = 1
+                except Exception as e:
+                    with self._lock:
+                        self._errors += 1
+                    logger.error(f"Erro no getUpdates: {e}")
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, 30)
+                
+                if self.stats_interval and time.monotonic() - last_stats >= self.stats_interval:
+                    last_stats = time.monotonic()
+                    logger.info(f"Polling: {self.get_stats()}")
+        finally:
+            self.dispatcher.close()
+    
+    def stop(self):
+        """Encerra o loop após o poll em andamento"""
+        self._stop.set()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna offset, contadores, latência do getUpdates e tamanho dos lotes"""
+        with self._lock:
+            poll_times = list(self._poll_times)
+            store_times = list(self._store_times)
+            batch_sizes = list(self._batch_sizes)
+            stats = {
+                'offset': self._offset,
+                'allowed_updates': ALLOWED_UPDATES,
+                'polls': self._polls,
+                'empty_polls': self._empty_polls,
+                'errors': self._errors,
+                'updates': self._updates,
+                'recovered': self._recovered
+            }
+        
+        ordered = sorted(batch_sizes)
+        stats['batch_size'] = {
+            'mean': round(sum(ordered) / len(ordered), 2) if ordered else 0,
+            'p95': ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)] if ordered else 0,
+            'max': ordered[-1] if ordered else 0
+        }
+        stats['poll_latency'] = percentiles(poll_times)
+        stats['store_latency'] = percentiles(store_times)
+        stats['dispatcher'] = self.dispatcher.get_stats()
+        return stats
@@ -1,8 +1,8 @@
 import os
-import sqlite3
 import logging
 from datetime import datetime
 from typing import Dict, Any, List, Optional
+import rollups
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +14,8 @@ class ProductManager:
     
     def create_product(self, name: str, description: str, price_stars: int, 
                       file_path: str, thumbnail_path: str = None, 
-                      duration_seconds: int = None) -> int:
+                      duration_seconds: int = None, category: str = None,
+                      delivery_mode: str = None) -> int:
         """Cria um novo produto"""
         try:
             # Verificar se arquivo existe
@@ -24,19 +25,22 @@ class ProductManager:
             # Obter tamanho do arquivo
             file_size = os.path.getsize(file_path)
             
-            with sqlite3.connect(self.db.db_path) as conn:
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO products (name, description, price_stars, file_path, 
-                                        thumbnail_path, file_size, duration_seconds)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                                        thumbnail_path, file_size, duration_seconds, category,
+                                        delivery_mode)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (name, description, price_stars, file_path, thumbnail_path, 
-                      file_size, duration_seconds))
-                conn.commit()
+                      file_size, duration_seconds, category, delivery_mode))
                 product_id = cursor.lastrowid
-                
-                logger.info(f"Produto criado: ID {product_id}, Nome: {name}")
-                return product_id
+            
+            # Invalidar cache só depois do commit
+            self.db.invalidate_catalog()
+            
+            logger.info(f"Produto criado: ID {product_id}, Nome: {name}")
+            return product_id
                 
         except Exception as e:
             logger.error(f"Erro ao criar produto: {e}")
@@ -48,7 +52,8 @@ class ProductManager:
             # Campos permitidos para atualização
             allowed_fields = [
                 'name', 'description', 'price_stars', 'file_path', 
-                'thumbnail_path', 'duration_seconds', 'is_active'
+                'thumbnail_path', 'duration_seconds', 'category', 'delivery_mode',
+                'is_active'
             ]
             
             # Filtrar campos válidos
@@ -61,20 +66,21 @@ class ProductManager:
             set_clause = ', '.join([f"{field} = ?" for field in update_fields.keys()])
             values = list(update_fields.values()) + [product_id]
             
-            with sqlite3.connect(self.db.db_path) as conn:
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute(f'''
                     UPDATE products 
                     SET {set_clause}
                     WHERE id = ?
                 ''', values)
-                conn.commit()
                 
                 success = cursor.rowcount > 0
-                if success:
-                    logger.info(f"Produto {product_id} atualizado: {update_fields}")
-                
-                return success
+            
+            if success:
+                self.db.invalidate_catalog()
+                logger.info(f"Produto {product_id} atualizado: {update_fields}")
+            
+            return success
                 
         except Exception as e:
             logger.error(f"Erro ao atualizar produto {product_id}: {e}")
@@ -87,8 +93,7 @@ class ProductManager:
     def get_product_stats(self, product_id: int) -> Dict[str, Any]:
         """Retorna estatísticas de um produto"""
         try:
-            with sqlite3.connect(self.db.db_path) as conn:
-                conn.row_factory = sqlite3.Row
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 
                 # Informações básicas do produto
@@ -98,41 +103,26 @@ class ProductManager:
                 if not product:
                     return None
                 
-                # Estatísticas de vendas
-                cursor.execute('''
-                    SELECT 
-                        COUNT(*) as total_sales,
-                        SUM(amount_stars) as total_revenue,
-                        AVG(amount_stars) as avg_price
-                    FROM transactions 
-                    WHERE product_id = ? AND status = 'completed'
-                ''', (product_id,))
-                
-                sales_stats = cursor.fetchone()
-                
-                # Estatísticas de downloads
-                cursor.execute('''
-                    SELECT 
-                        COUNT(*) as total_downloads,
-                        AVG(download_count) as avg_downloads_per_purchase
-                    FROM downloads 
-                    WHERE product_id = ? AND download_count > 0
-                ''', (product_id,))
-                
-                download_stats = cursor.fetchone()
-                
-                return {
-                    'product': dict(product),
-                    'sales': {
-                        'total_sales': sales_stats['total_sales'] or 0,
-                        'total_revenue': sales_stats['total_revenue'] or 0,
-                        'average_price': sales_stats['avg_price'] or 0
-                    },
-                    'downloads': {
-                        'total_downloads': download_stats['total_downloads'] or 0,
-                        'avg_downloads_per_purchase': download_stats['avg_downloads_per_purchase'] or 0
-                    }
+                # Totais acumulados nos rollups
+                totals = rollups.product_totals(conn, product_id)
+            
+            sales = totals['sales']
+            used_deliveries = totals['used_deliveries']
+            
+            return {
+                'product': dict(product),
+                'sales': {
+                    'total_sales': sales,
+                    'total_revenue': totals['revenue'],
+                    'average_price': totals['revenue'] / sales if sales else 0
+                },
+                'downloads': {
+                    'total_downloads': used_deliveries,
+                    'avg_downloads_per_purchase': (
+                        totals['delivery_downloads'] / used_deliveries if used_deliveries else 0
+                    )
                 }
+            }
                 
         except Exception as e:
             logger.error(f"Erro ao buscar estatísticas do produto {product_id}: {e}")
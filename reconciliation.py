@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Callable, Iterator
+
+import requests
+
+from bot_api import api_base_url, call_bot_api
+from payment_processor import PaymentProcessor, is_signed_payload, parse_invoice_payload
+
+logger = logging.getLogger(__name__)
+
+CURSOR_KEY = 'star_reconciliation_offset'
+
+# Status em que a cobrança ainda não virou download (o mesmo UPDATE condicional de complete_payment)
+REPAIRABLE_STATUSES = ('pending', 'error')
+
+
+def invoice_charge(transaction: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Dados da cobrança de uma fatura (StarTransaction paga por um usuário); None para os demais tipos"""
+    source = transaction.get('source') or {}
+    if source.get('type') != 'user' or 'invoice_payload' not in source:
+        return None
+    if source.get('transaction_type', 'invoice_payment') != 'invoice_payment':
+        return None
+    return {
+        'telegram_payment_id': transaction['id'],
+        'telegram_user_id': source['user']['id'],
+        'invoice_payload': source['invoice_payload'],
+        'amount_stars': transaction['amount'],
+        'date': transaction['date']
+    }
+
+
+class StarReconciler:
+    """Concilia as cobranças do getStarTransactions com a tabela transactions, página a página"""
+    
+    def __init__(self, payment_processor: PaymentProcessor, api_url: str = None, page_size: int = None,
+                 min_age: int = None, session: requests.Session = None):
+        self.payments = payment_processor
+        self.db = payment_processor.db
+        self.token = payment_processor.bot_token
+        self.api_url = api_base_url(api_url)
+        self.page_size = min(page_size or int(os.getenv('RECONCILE_PAGE_SIZE', 100)), 100)
+        
+        # Cobranças recentes ainda podem estar chegando pelo successful_payment
+        self.min_age = min_age if min_age is not None else int(os.getenv('RECONCILE_MIN_AGE_SECONDS', 300))
+        self.session = session or requests.Session()
+    
+    def load_cursor(self) -> int:
+        """Quantas transações do getStarTransactions já foram conciliadas"""
+        return int(self.db.get_setting(CURSOR_KEY) or 0)
+    
+    def pages(self, offset: int) -> Iterator[List[Dict[str, Any]]]:
+        """Páginas do getStarTransactions (ordem cronológica) a partir de offset, uma de cada vez"""
+        while True:
+            page = call_bot_api(self.session, self.api_url, self.token, 'getStarTransactions',
+                                {'offset': offset, 'limit': self.page_size})['transactions']
+            if not page:
+                return
+            yield page
+            offset += len(page)
+            if len(page) < self.page_size:
+                return
+    
+    def run(self, max_pages: int = None,
+            notify: Callable[[int, Dict[str, Any]], None] = None) -> Dict[str, Any]:
+        """Percorre as transações novas, repara pagamentos perdidos e avança o cursor gravado"""
+        started = time.monotonic()
+        cursor = self.load_cursor()
+        report = {'start_cursor': cursor, 'pages': 0, 'scanned': 0, 'charges': 0, 'matched': 0,
+                  'repaired': 0, 'unmatched': 0, 'skipped': 0}
+        cutoff = time.time() - self.min_age
+        
+        for page in self.pages(cursor):
+            # Para na primeira cobrança recente demais: o cursor não passa dela
+            ready = []
+            for transaction in page:
+                if transaction['date'] > cutoff:
+                    break
+                ready.append(transaction)
+            
+            repairs = self._plan_repairs(ready, report)
+            cursor += len(ready)
+            purchases = self.db.repair_payments(CURSOR_KEY, cursor, repairs)
+            
+            for repair, purchase in zip(repairs, purchases):
+                if purchase is None:
+                    # Concluída por outra entrega no meio tempo (ou erro já registrado no log)
+                    report['skipped'] += 1
+                    continue
+                report['repaired'] += 1
+                logger.warning(f"Pagamento {repair['telegram_payment_id']} conciliado: transação "
+                               f"{purchase['transaction_id']} concluída com acesso de download")
+                if notify is not None:
+                    self._notify(notify, repair, purchase)
+            
+            report['pages'] += 1
+            report['scanned'] += len(ready)
+            if len(ready) < len(page) or (max_pages and report['pages'] >= max_pages):
+                break
+        
+        report['cursor'] = cursor
+        report['duration_ms'] = round((time.monotonic() - started) * 1000, 3)
+        return report
+    
+    def _plan_repairs(self, transactions: List[Dict[str, Any]],
+                      report: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Cobranças da página sem transação concluída no banco -> reparos a aplicar"""
+        charges = [charge for charge in map(invoice_charge, transactions) if charge is not None]
+        report['charges'] += len(charges)
+        
+        # Uma consulta por página, pelo índice único de telegram_payment_id
+        known = self.db.find_payment_ids([charge['telegram_payment_id'] for charge in charges])
+        repairs = []
+        for charge in charges:
+            transaction = known.get(charge['telegram_payment_id'])
+            if transaction is not None and transaction['status'] not in REPAIRABLE_STATUSES:
+                report['matched'] += 1
+                continue
+            
+            # Sem transação ou com o id da cobrança gravado numa transação que falhou ('error')
+            repair = self._repair_for(charge, transaction)
+            if repair is None:
+                report['unmatched'] += 1
+                logger.error(f"Cobrança {charge['telegram_payment_id']} sem transação correspondente "
+                             f"(payload {charge['invoice_payload']!r})")
+                continue
+            repairs.append(repair)
+        return repairs
+    
+    def _repair_for(self, charge: Dict[str, Any],
+                    transaction: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """Reparo de uma cobrança: conclui a transação pendente ou grava a da fatura assinada"""
+        download_token, expiry_hours, max_downloads = self.payments._new_download_settings()
+        repair = {
+            'telegram_payment_id': charge['telegram_payment_id'],
+            'telegram_user_id': charge['telegram_user_id'],
+            'amount_stars': charge['amount_stars'],
+            'download_token': download_token,
+            'expires_at': datetime.now() + timedelta(hours=expiry_hours),
+            'max_downloads': max_downloads,
+            'transaction_id': None,
+            'product_id': None
+        }
+        
+        # Transação que já tem o id da cobrança: basta concluí-la
+        if transaction is not None:
+            repair['transaction_id'] = transaction['id']
+            return repair
+        
+        payload = charge['invoice_payload']
+        if is_signed_payload(payload):
+            invoice = parse_invoice_payload(self.payments._invoice_key, payload)
+            if invoice is None:
+                return None
+            repair['product_id'] = invoice['product_id']
+            return repair
+        
+        if not payload.isdigit():
+            return None
+        transaction = self.payments.get_transaction_by_id(int(payload))
+        if transaction is None or transaction['status'] not in ('pending', 'error'):
+            return None
+        repair['transaction_id'] = transaction['id']
+        repair['product_id'] = transaction['product_id']
+        return repair
+    
+    def send_confirmation(self, telegram_user_id: int, download_info: Dict[str, Any]):
+        """Envia ao comprador a mesma confirmação de pagamento do bot (notify padrão)"""
+        from bot import build_download_confirmation
+        
+        text, keyboard = build_download_confirmation(download_info)
+        call_bot_api(self.session, self.api_url, self.token, 'sendMessage', {
+            'chat_id': telegram_user_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+            'reply_markup': keyboard.to_dict()
+        })
+    
+    def _notify(self, notify: Callable, repair: Dict[str, Any], purchase: Dict[str, Any]):
+        try:
+            notify(repair['telegram_user_id'], self.payments._download_info(
+                purchase, repair['download_token'], repair['max_downloads'], created=True
+            ))
+        except Exception as e:
+            logger.error(f"Erro ao avisar o comprador do pagamento {repair['telegram_payment_id']}: {e}")
+
+
+def main(argv: List[str] = None) -> int:
+    """Concilia os pagamentos em Stars com o banco"""
+    import argparse
+    from dotenv import load_dotenv
+    from database import DatabaseManager
+    
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Conciliação de pagamentos com o getStarTransactions')
+    parser.add_argument('--db', default='bot_database.db', help='Arquivo do banco')
+    parser.add_argument('--api-url', default=None, help='URL base da Bot API (padrão: TELEGRAM_API_URL)')
+    parser.add_argument('--max-pages', type=int, default=None, help='Limita as páginas desta execução')
+    parser.add_argument('--notify', action='store_true', help='Envia o link de download aos compradores reparados')
+    parser.add_argument('--reset', action='store_true', help='Recomeça do início do histórico')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        print("❌ Configure BOT_TOKEN no arquivo .env")
+        return 1
+    
+    db_manager = DatabaseManager(args.db)
+    reconciler = StarReconciler(PaymentProcessor(db_manager, token), api_url=args.api_url)
+    if args.reset:
+        db_manager.set_setting(CURSOR_KEY, '0')
+    
+    notify = reconciler.send_confirmation if args.notify else None
+    report = reconciler.run(max_pages=args.max_pages, notify=notify)
+    print(f"✅ {report['scanned']} transações lidas, {report['charges']} cobranças, "
+          f"{report['repaired']} reparadas, {report['unmatched']} sem correspondência "
+          f"(cursor {report['cursor']})")
+    return 0 if not report['unmatched'] else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+import requests
+
+import rollups
+from bot_api import api_base_url, call_bot_api, BotApiError
+from send_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Lotes de reembolso: cada item é um checkpoint (pending -> refunded/failed)
+CREATE_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS refund_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reason TEXT,
+        criteria TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        total INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS refund_items (
+        job_id INTEGER NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        telegram_payment_id TEXT NOT NULL,
+        telegram_user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (job_id, transaction_id),
+        FOREIGN KEY (job_id) REFERENCES refund_jobs (id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_refund_items_transaction ON refund_items (transaction_id, status)',
+]
+
+# Erro do refundStarPayment quando o reembolso já foi feito (ex.: antes de uma queda)
+ALREADY_REFUNDED = 'CHARGE_ALREADY_REFUNDED'
+
+
+class RefundEngine:
+    """Reembolsos em massa pelo refundStarPayment: workers limitados, taxa controlada e retomada após queda"""
+    
+    def __init__(self, payment_processor, api_url: str = None, workers: int = None, rate: float = None,
+                 batch_size: int = None, session: requests.Session = None):
+        self.db = payment_processor.db
+        self.token = payment_processor.bot_token
+        self.api_url = api_base_url(api_url)
+        self.workers = workers or int(os.getenv('REFUND_WORKERS', 4))
+        self.rate = rate or float(os.getenv('REFUND_RATE', 5))
+        self.batch_size = batch_size or int(os.getenv('REFUND_BATCH_SIZE', 50))
+        self.session = session or requests.Session()
+        
+        self._bucket = TokenBucket(self.rate, 1, time.monotonic())
+        self._bucket_lock = threading.Lock()
+    
+    def create_job(self, product_id: int = None, since: str = None, until: str = None,
+                   payment_ids: List[str] = None, reason: str = None) -> Tuple[int, int]:
+        """Seleciona as compras concluídas que casam com os filtros; devolve (job_id, total)"""
+        conditions, params = [], []
+        if product_id is not None:
+            conditions.append('t.product_id = ?')
+            params.append(product_id)
+        if since:
+            conditions.append('t.created_at >= ?')
+            params.append(since)
+        if until:
+            conditions.append('t.created_at < ?')
+            params.append(until)
+        if payment_ids:
+            conditions.append(f"t.telegram_payment_id IN ({', '.join('?' for _ in payment_ids)})")
+            params.extend(payment_ids)
+        if not conditions:
+            raise ValueError("Informe produto, período ou lista de pagamentos")
+        
+        criteria = {'product_id': product_id, 'since': since, 'until': until, 'payment_ids': payment_ids}
+        return self.db.submit_write(self._create_job, reason, json.dumps(criteria),
+                                    ' AND '.join(conditions), params).result()
+    
+    @staticmethod
+    def _create_job(conn, reason, criteria, where, params):
+        job_id = conn.execute(
+            "INSERT INTO refund_jobs (reason, criteria) VALUES (?, ?)", (reason, criteria)
+        ).lastrowid
+        
+        # Compras já pendentes em outro lote ficam de fora (nunca reembolsadas duas vezes)
+        total = conn.execute(f'''
+            INSERT INTO refund_items (job_id, transaction_id, telegram_payment_id, telegram_user_id)
+            SELECT ?, t.id, t.telegram_payment_id, u.telegram_id
+            FROM transactions t
+            JOIN users u ON u.id = t.user_id
+            WHERE t.status = 'completed' AND t.telegram_payment_id IS NOT NULL AND {where}
+              AND NOT EXISTS (
+                  SELECT 1 FROM refund_items i
+                  WHERE i.transaction_id = t.id AND i.status = 'pending'
+              )
+        ''', (job_id, *params)).rowcount
+        conn.execute("UPDATE refund_jobs SET total = ? WHERE id = ?", (total, job_id))
+        return job_id, total
+    
+    def run(self, job_id: int, retry_failed: bool = False) -> Dict[str, Any]:
+        """Processa os itens pendentes do lote (retomando de onde parou) e devolve o resumo"""
+        if retry_failed:
+            self.db.submit_write(self._retry_failed, job_id).result()
+        
+        started = time.monotonic()
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='refund') as executor:
+            while True:
+                items = self._pending_items(job_id, last_id)
+                if not items:
+                    break
+                
+                results = list(executor.map(self._refund_one, items))
+                
+                # Checkpoint: estado dos itens, transações e downloads gravados juntos
+                tokens = self.db.submit_write(self._apply_results, job_id, results).result()
+                for token in tokens:
+                    self.db.invalidate_download_token(token)
+                last_id = items[-1]['transaction_id']
+        
+        self.db.submit_write(self._finish_job, job_id).result()
+        job = self.get_job(job_id)
+        logger.info(f"Reembolso {job_id}: {job['refunded']} reembolsados, {job['failed']} com erro "
+                    f"em {time.monotonic() - started:.1f}s")
+        return job
+    
+    def _pending_items(self, job_id: int, last_id: int) -> List[Dict[str, Any]]:
+        with self.db.connection() as conn:
+            rows = conn.execute('''
+                SELECT transaction_id, telegram_payment_id, telegram_user_id FROM refund_items
+                WHERE job_id = ? AND transaction_id > ? AND status = 'pending'
+                ORDER BY transaction_id
+                LIMIT ?
+            ''', (job_id, last_id, self.batch_size)).fetchall()
+        return [dict(row) for row in rows]
+    
+    def _throttle(self):
+        """Espera a vez no limite de REFUND_RATE chamadas por segundo (compartilhado pelos workers)"""
+        while True:
+            with self._bucket_lock:
+                wait = self._bucket.wait_time(time.monotonic())
+                if wait == 0:
+                    self._bucket.take()
+                    return
+            time.sleep(wait)
+    
+    def _refund_one(self, item: Dict[str, Any]) -> Tuple[int, str, Optional[str]]:
+        """Chama o refundStarPayment de um item; devolve (transaction_id, status, erro)"""
+        self._throttle()
+        try:
+            call_bot_api(self.session, self.api_url, self.token, 'refundStarPayment', {
+                'user_id': item['telegram_user_id'],
+                'telegram_payment_charge_id': item['telegram_payment_id']
+            })
+        except BotApiError as e:
+            if ALREADY_REFUNDED in str(e):
+                return item['transaction_id'], 'refunded', None
+            logger.error(f"Erro ao reembolsar {item['telegram_payment_id']}: {e}")
+            return item['transaction_id'], 'failed', str(e)
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Erro ao reembolsar {item['telegram_payment_id']}: {e}")
+            return item['transaction_id'], 'failed', str(e)
+        return item['transaction_id'], 'refunded', None
+    
+    @staticmethod
+    def _apply_results(conn, job_id, results) -> List[str]:
+        """Grava o lote de resultados; revoga os downloads e marca as transações reembolsadas"""
+        conn.executemany('''
+            UPDATE refund_items SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND transaction_id = ?
+        ''', [(status, error, job_id, transaction_id) for transaction_id, status, error in results])
+        
+        refunded = [transaction_id for transaction_id, status, _ in results if status == 'refunded']
+        if not refunded:
+            return []
+        
+        placeholders = ', '.join('?' for _ in refunded)
+        rows = conn.execute(f'''
+            UPDATE transactions SET status = 'refunded'
+            WHERE id IN ({placeholders}) AND status = 'completed'
+            RETURNING product_id, amount_stars, completed_at
+        ''', refunded).fetchall()
+        for row in rows:
+            rollups.bump(conn, row['product_id'], at=row['completed_at'],
+                         sales=-1, revenue=-row['amount_stars'])
+        
+        # Token revogado = expirado e sem downloads restantes (a limpeza o arquiva depois)
+        revoked = conn.execute(f'''
+            UPDATE downloads SET expires_at = ?, max_downloads = download_count
+            WHERE transaction_id IN ({placeholders})
+            RETURNING download_token
+        ''', [datetime.now(), *refunded]).fetchall()
+        return [row[0] for row in revoked]
+    
+    @staticmethod
+    def _retry_failed(conn, job_id):
+        conn.execute('''
+            UPDATE refund_items SET status = 'pending', error = NULL
+            WHERE job_id = ? AND status = 'failed'
+        ''', (job_id,))
+        conn.execute("UPDATE refund_jobs SET status = 'running', finished_at = NULL WHERE id = ?", (job_id,))
+    
+    @staticmethod
+    def _finish_job(conn, job_id):
+        conn.execute('''
+            UPDATE refund_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND NOT EXISTS (
+                SELECT 1 FROM refund_items WHERE job_id = ? AND status = 'pending'
+            )
+        ''', (job_id, job_id))
+    
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Lote com a contagem de itens por estado"""
+        with self.db.connection() as conn:
+            job = conn.execute("SELECT * FROM refund_jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(conn.execute('''
+                SELECT status, COUNT(*) FROM refund_items WHERE job_id = ? GROUP BY status
+            ''', (job_id,)).fetchall())
+        return {
+            **dict(job),
+            'pending': counts.get('pending', 0),
+            'refunded': counts.get('refunded', 0),
+            'failed': counts.get('failed', 0)
+        }
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """Lotes de reembolso, do mais recente ao mais antigo"""
+        with self.db.connection() as conn:
+            ids = [row[0] for row in conn.execute("SELECT id FROM refund_jobs ORDER BY id DESC")]
+        return [self.get_job(job_id) for job_id in ids]
+
+
+def main(argv: List[str] = None) -> int:
+    """Cria, retoma ou lista lotes de reembolso"""
+    import argparse
+    from dotenv import load_dotenv
+    from database import DatabaseManager
+    from payment_processor import PaymentProcessor
+    
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Reembolsos em massa (refundStarPayment)')
+    parser.add_argument('--db', default='bot_database.db', help='Arquivo do banco')
+    parser.add_argument('--api-url', default=None, help='URL base da Bot API (padrão: TELEGRAM_API_URL)')
+    parser.add_argument('--product', type=int, help='Reembolsa as compras deste produto')
+    parser.add_argument('--since', help='Compras a partir desta data (AAAA-MM-DD[ HH:MM:SS])')
+    parser.add_argument('--until', help='Compras antes desta data')
+    parser.add_argument('--payments', help='Lista de telegram_payment_charge_id separados por vírgula')
+    parser.add_argument('--reason', help='Motivo registrado no lote')
+    parser.add_argument('--resume', type=int, metavar='JOB', help='Retoma um lote interrompido')
+    parser.add_argument('--retry-failed', action='store_true', help='Com --resume: tenta de novo os que falharam')
+    parser.add_argument('--list', action='store_true', help='Lista os lotes de reembolso')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        print("❌ Configure BOT_TOKEN no arquivo .env")
+        return 1
+    
+    engine = RefundEngine(PaymentProcessor(DatabaseManager(args.db), token), api_url=args.api_url)
+    
+    if args.list:
+        for job in engine.list_jobs():
+            print(f"#{job['id']} {job['status']} {job['refunded']}/{job['total']} reembolsados, "
+                  f"{job['failed']} com erro, {job['pending']} pendentes ({job['reason'] or '-'})")
+        return 0
+    
+    if args.resume:
+        job_id = args.resume
+    else:
+        payment_ids = [value.strip() for value in args.payments.split(',')] if args.payments else None
+        job_id, total = engine.create_job(args.product, args.since, args.until, payment_ids, args.reason)
+        print(f"📋 Lote {job_id}: {total} compras a reembolsar")
+    
+    job = engine.run(job_id, retry_failed=args.retry_failed)
+    print(f"✅ Lote {job_id}: {job['refunded']} reembolsados, {job['failed']} com erro, "
+          f"{job['pending']} pendentes")
+    return 0 if not job['failed'] and not job['pending'] else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
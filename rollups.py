@@ -0,0 +1,184 @@
+import sys
+import sqlite3
+import logging
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Métricas mantidas por produto em cada balde (hora ou dia, em UTC):
+#   sales, revenue          -> pelo horário de conclusão da transação
+#   deliveries, delivery_downloads, used_deliveries
+#                           -> pelo horário de criação do acesso de download
+#   downloads               -> pelo horário em que o download aconteceu
+METRICS = ('sales', 'revenue', 'deliveries', 'delivery_downloads', 'used_deliveries', 'downloads')
+
+ROLLUP_TABLES = (
+    ('product_stats_hourly', '%Y-%m-%d %H:00:00'),
+    ('product_stats_daily', '%Y-%m-%d'),
+)
+
+CREATE_STATEMENTS = [
+    f'''
+    CREATE TABLE IF NOT EXISTS {table} (
+        bucket TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        sales INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        deliveries INTEGER NOT NULL DEFAULT 0,
+        delivery_downloads INTEGER NOT NULL DEFAULT 0,
+        used_deliveries INTEGER NOT NULL DEFAULT 0,
+        downloads INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, product_id)
+    )
+    '''
+    for table, _ in ROLLUP_TABLES
+] + [
+    'CREATE INDEX IF NOT EXISTS idx_product_stats_daily_product ON product_stats_daily (product_id, bucket)'
+]
+
+
+def bump(conn: sqlite3.Connection, product_id: int, at: Optional[str] = None, **deltas: int):
+    """Soma deltas às métricas do produto nos baldes horário e diário de 'at' (UTC; None = agora)"""
+    columns = [metric for metric in METRICS if deltas.get(metric)]
+    if not columns:
+        return
+    
+    values = [deltas[metric] for metric in columns]
+    column_list = ', '.join(columns)
+    placeholders = ', '.join('?' for _ in columns)
+    updates = ', '.join(f"{metric} = {metric} + excluded.{metric}" for metric in columns)
+    
+    for table, bucket_format in ROLLUP_TABLES:
+        conn.execute(f'''
+            INSERT INTO {table} (bucket, product_id, {column_list})
+            VALUES (strftime(?, COALESCE(?, 'now')), ?, {placeholders})
+            ON CONFLICT (bucket, product_id) DO UPDATE SET {updates}
+        ''', (bucket_format, at, product_id, *values))
+
+
+def window_totals(conn: sqlite3.Connection, days: int) -> List[Dict[str, Any]]:
+    """Totais por produto nos últimos N dias (dia parcial por hora, dias cheios por dia)"""
+    offset = f'-{int(days)} days'
+    cursor = conn.execute('''
+        SELECT
+            r.product_id,
+            p.name,
+            SUM(r.sales) AS sales,
+            SUM(r.revenue) AS revenue,
+            SUM(r.deliveries) AS deliveries,
+            SUM(r.delivery_downloads) AS delivery_downloads,
+            SUM(r.used_deliveries) AS used_deliveries,
+            SUM(r.downloads) AS downloads
+        FROM (
+            SELECT product_id, sales, revenue, deliveries, delivery_downloads, used_deliveries, downloads
+            FROM product_stats_hourly
+            WHERE bucket >= strftime('%Y-%m-%d %H:00:00', 'now', ?)
+            AND bucket < datetime(date('now', ?, '+1 day'))
+            UNION ALL
+            SELECT product_id, sales, revenue, deliveries, delivery_downloads, used_deliveries, downloads
+            FROM product_stats_daily
+            WHERE bucket >= date('now', ?, '+1 day')
+        ) r
+        LEFT JOIN products p ON p.id = r.product_id
+        GROUP BY r.product_id, p.name
+    ''', (offset, offset, offset))
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def product_totals(conn: sqlite3.Connection, product_id: int) -> Dict[str, int]:
+    """Totais de todo o histórico de um produto"""
+    cursor = conn.execute('''
+        SELECT
+            SUM(sales) AS sales,
+            SUM(revenue) AS revenue,
+            SUM(deliveries) AS deliveries,
+            SUM(delivery_downloads) AS delivery_downloads,
+            SUM(used_deliveries) AS used_deliveries,
+            SUM(downloads) AS downloads
+        FROM product_stats_daily
+        WHERE product_id = ?
+    ''', (product_id,))
+    row = cursor.fetchone()
+    return {metric: (row[metric] or 0) for metric in METRICS}
+
+
+def backfill(cursor, downloads_source: str = 'downloads'):
+    """Recalcula as tabelas de rollup a partir de transactions e de downloads_source (tabela ou subconsulta)"""
+    cursor.execute("DELETE FROM product_stats_hourly")
+    cursor.execute("DELETE FROM product_stats_daily")
+    
+    # Downloads antigos só guardam o último acesso: o contador inteiro vai para essa hora
+    cursor.execute(f'''
+        INSERT INTO product_stats_hourly
+            (bucket, product_id, sales, revenue, deliveries, delivery_downloads, used_deliveries, downloads)
+        SELECT bucket, product_id, SUM(sales), SUM(revenue), SUM(deliveries),
+               SUM(delivery_downloads), SUM(used_deliveries), SUM(downloads)
+        FROM (
+            SELECT strftime('%Y-%m-%d %H:00:00', COALESCE(completed_at, created_at)) AS bucket,
+                   product_id, 1 AS sales, amount_stars AS revenue, 0 AS deliveries,
+                   0 AS delivery_downloads, 0 AS used_deliveries, 0 AS downloads
+            FROM transactions
+            WHERE status = 'completed'
+            UNION ALL
+            SELECT strftime('%Y-%m-%d %H:00:00', created_at), product_id, 0, 0, 1,
+                   download_count, download_count > 0, 0
+            FROM {downloads_source}
+            UNION ALL
+            SELECT strftime('%Y-%m-%d %H:00:00', last_access), product_id, 0, 0, 0, 0, 0, download_count
+            FROM {downloads_source}
+            WHERE last_access IS NOT NULL AND download_count > 0
+        )
+        GROUP BY bucket, product_id
+        -- full-scan-ok
+    ''')
+    cursor.execute('''
+        INSERT INTO product_stats_daily
+            (bucket, product_id, sales, revenue, deliveries, delivery_downloads, used_deliveries, downloads)
+        SELECT substr(bucket, 1, 10), product_id, SUM(sales), SUM(revenue), SUM(deliveries),
+               SUM(delivery_downloads), SUM(used_deliveries), SUM(downloads)
+        FROM product_stats_hourly
+        GROUP BY substr(bucket, 1, 10), product_id
+    ''')
+
+
+def rebuild(cursor):
+    """Recalcula as tabelas de rollup incluindo os downloads arquivados (banco já migrado)"""
+    # Downloads arquivados (migração 5) continuam fazendo parte do histórico
+    columns = 'product_id, download_count, last_access, created_at'
+    backfill(cursor, f"(SELECT {columns} FROM downloads UNION ALL SELECT {columns} FROM downloads_archive)")
+
+
+def main(argv: List[str] = None) -> int:
+    """Recalcula as tabelas de rollup de um banco existente"""
+    import argparse
+    from migrations import apply_migrations
+    
+    parser = argparse.ArgumentParser(description='Tabelas de rollup de vendas e downloads')
+    parser.add_argument('--db', default='bot_database.db', help='Arquivo do banco')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Recalcula todos os rollups a partir das tabelas brutas')
+    args = parser.parse_args(argv)
+    
+    if not args.backfill:
+        parser.print_help()
+        return 0
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        apply_migrations(conn)
+        # BEGIN IMMEDIATE bloqueia escritas durante o recálculo para não perder incrementos
+        conn.execute("BEGIN IMMEDIATE")
+        rebuild(conn.cursor())
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM product_stats_hourly").fetchone()[0]
+        print(f"✅ Rollups recalculados: {count} baldes horários")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,10 +22,12 @@ def main():
     
     print("🤖 Iniciando Telegram Video Bot...")
     print("📋 Modo: Polling (desenvolvimento)")
+    if os.getenv('BOT_ASYNC', 'false').lower() == 'true':
+        print("⚡ Runtime: asyncio (BOT_ASYNC=true)")
     
     try:
-        # Criar e iniciar bot
-        bot = create_bot(bot_token)
+        # Criar e iniciar bot (handlers rodam nos workers do PollingRunner)
+        bot = create_bot(bot_token, threaded=False)
         print("✅ Bot configurado com sucesso!")
         print("🚀 Bot iniciado! Pressione Ctrl+C para parar.")
         
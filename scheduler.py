@@ -4,7 +4,10 @@ import time
 import logging
 from datetime import datetime
 from database import DatabaseManager
+from backup import BackupManager
 from delivery_system import DeliveryScheduler
+from payment_processor import PaymentProcessor
+from reconciliation import StarReconciler
 
 # Configuração de logging
 logging.basicConfig(
@@ -23,6 +26,11 @@ class AutomatedScheduler:
     def __init__(self):
         self.db_manager = DatabaseManager()
         self.delivery_scheduler = DeliveryScheduler(self.db_manager)
+        self.backup_manager = BackupManager(self.db_manager.db_path)
+        
+        # Conciliação com o getStarTransactions (precisa do token do bot)
+        token = os.getenv('BOT_TOKEN')
+        self.reconciler = StarReconciler(PaymentProcessor(self.db_manager, token)) if token else None
         self.setup_schedules()
     
     def setup_schedules(self):
@@ -37,8 +45,17 @@ class AutomatedScheduler:
         # Relatório diário - às 9:00
         schedule.every().day.at("09:00").do(self.generate_daily_report)
         
-        # Backup do banco de dados - às 3:00
-        schedule.every().day.at("03:00").do(self.backup_database)
+        # Backup do banco de dados - às 3:00 ou a cada BACKUP_INTERVAL_HOURS
+        backup_interval = int(os.getenv('BACKUP_INTERVAL_HOURS', 0))
+        if backup_interval > 0:
+            schedule.every(backup_interval).hours.do(self.backup_database)
+        else:
+            schedule.every().day.at("03:00").do(self.backup_database)
+        
+        # Conciliação de pagamentos - a cada RECONCILE_INTERVAL_HOURS (0 = desligada)
+        reconcile_interval = int(os.getenv('RECONCILE_INTERVAL_HOURS', 1))
+        if self.reconciler is not None and reconcile_interval > 0:
+            schedule.every(reconcile_interval).hours.do(self.reconcile_payments)
         
         logger.info("Agendamentos configurados com sucesso")
     
@@ -83,43 +100,33 @@ class AutomatedScheduler:
             logger.error(f"Erro na geração do relatório diário: {e}")
     
     def backup_database(self):
-        """Tarefa: Backup do banco de dados"""
+        """Tarefa: Backup online do banco de dados"""
         try:
-            import shutil
-            
-            # Criar diretório de backup
-            backup_dir = 'backups'
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            # Nome do arquivo de backup
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_file = f"{backup_dir}/database_backup_{timestamp}.db"
-            
-            # Copiar banco de dados
-            shutil.copy2(self.db_manager.db_path, backup_file)
-            
-            logger.info(f"Backup do banco criado: {backup_file}")
-            
-            # Manter apenas os últimos 7 backups
-            self.cleanup_old_backups(backup_dir, keep_count=7)
-            
+            result = self.backup_manager.create_backup()
+            logger.info(f"Backup concluído: {result['file']} em {result['duration_ms']} ms")
         except Exception as e:
             logger.error(f"Erro no backup do banco: {e}")
     
-    def cleanup_old_backups(self, backup_dir: str, keep_count: int = 7):
+    def reconcile_payments(self):
+        """Tarefa: Conciliação dos pagamentos em Stars com o banco"""
+        try:
+            notify = None
+            if os.getenv('RECONCILE_NOTIFY', 'true').lower() == 'true':
+                notify = self.reconciler.send_confirmation
+            report = self.reconciler.run(notify=notify)
+            logger.info(f"Conciliação concluída: {report['scanned']} transações lidas, "
+                        f"{report['repaired']} pagamentos reparados, "
+                        f"{report['unmatched']} sem correspondência")
+        except Exception as e:
+            logger.error(f"Erro na conciliação de pagamentos: {e}")
+    
+    def cleanup_old_backups(self, backup_dir: str = None, keep_count: int = 7):
         """Remove backups antigos, mantendo apenas os mais recentes"""
         try:
-            import glob
-            
-            # Listar arquivos de backup
-            backup_files = glob.glob(f"{backup_dir}/database_backup_*.db")
-            backup_files.sort(reverse=True)  # Mais recentes primeiro
-            
-            # Remover backups antigos
-            for old_backup in backup_files[keep_count:]:
-                os.remove(old_backup)
-                logger.info(f"Backup antigo removido: {old_backup}")
-                
+            manager = self.backup_manager
+            if backup_dir and backup_dir != manager.backup_dir:
+                manager = BackupManager(self.db_manager.db_path, backup_dir=backup_dir)
+            manager.cleanup_old_backups(keep_count)
         except Exception as e:
             logger.error(f"Erro na limpeza de backups: {e}")
     
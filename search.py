@@ -0,0 +1,187 @@
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import deque
+from typing import List, Dict, Any, Tuple
+
+from cache import LRUCache, ProductRecord
+from dispatcher import percentiles
+
+logger = logging.getLogger(__name__)
+
+# Índice FTS5 com conteúdo externo (products), mantido por triggers a cada escrita na tabela
+CREATE_STATEMENTS = [
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO products_fts (rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    ''',
+    "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+]
+
+# Letras e dígitos; '_' e pontuação separam palavras, como no unicode61
+_WORD = re.compile(r'[^\W_]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokens como o unicode61 do FTS5 os vê: minúsculos e sem acentos"""
+    decomposed = unicodedata.normalize('NFKD', (text or '').lower())
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return _WORD.findall(stripped)
+
+
+def match_expression(tokens: List[str]) -> str:
+    """Consulta FTS5: todos os termos, cada um como prefixo ("vid"* "aula"*)"""
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def matches(tokens: List[str], product: ProductRecord) -> bool:
+    """Mesmo critério do MATCH, em memória: cada termo é prefixo de alguma palavra do produto"""
+    words = tokenize(f"{product['name']} {product.get('description') or ''}")
+    return all(any(word.startswith(token) for word in words) for token in tokens)
+
+
+class ProductSearch:
+    """Busca de produtos por texto (FTS5) com cache de consultas e reaproveitamento de prefixos"""
+    
+    def __init__(self, db_manager, cache_size: int = None, max_results: int = None):
+        self.db = db_manager
+        self.max_results = max_results or int(os.getenv('SEARCH_MAX_RESULTS', 100))
+        
+        # Ordenar por relevância (bm25) custa proporcional ao número de casamentos:
+        # consultas mais amplas que isso saem por ordem de cadastro (mais novos primeiro)
+        self.rank_limit = int(os.getenv('SEARCH_RANK_LIMIT', 2000))
+        
+        # (versão do catálogo, termos) -> (ids, completo); completo = o FTS não cortou o resultado
+        self.cache = LRUCache(maxsize=cache_size or int(os.getenv('SEARCH_CACHE_SIZE', 2000)))
+        
+        # Contadores expostos em get_stats()
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._prefix_hits = 0
+        self._fts_queries = 0
+        self._unranked = 0
+        self._latencies = deque(maxlen=2048)
+    
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[ProductRecord], bool]:
+        """Produtos ativos que casam com a consulta (mais relevantes primeiro) e se há mais resultados"""
+        started = time.perf_counter()
+        version = self.db.catalog.current_version()
+        tokens = tokenize(query)
+        
+        if tokens:
+            ids = self._lookup(version, tokens)
+        else:
+            # Consulta vazia: catálogo na ordem padrão
+            ids = [product['id'] for product in self.db.get_active_products()[:self.max_results]]
+        
+        products = [self.db.get_product_by_id(product_id) for product_id in ids[offset:offset + limit]]
+        
+        with self._lock:
+            self._queries += 1
+            self._latencies.append(time.perf_counter() - started)
+        return [product for product in products if product is not None], len(ids) > offset + limit
+    
+    def _lookup(self, version: int, tokens: List[str]) -> List[int]:
+        key = (version, tuple(tokens))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached[0]
+        
+        # Digitação incremental: se um prefixo da consulta já tem resultado completo em cache,
+        # a resposta é um subconjunto dele e pode ser filtrada em memória
+        ids = self._from_prefix(version, tokens)
+        if ids is not None:
+            with self._lock:
+                self._prefix_hits += 1
+            self.cache.put(key, (ids, True))
+            return ids
+        
+        expression = match_expression(tokens)
+        with self.db.connection() as conn:
+            # Ordem de rowid o FTS5 entrega sem pontuar: barato e interrompido pelo LIMIT
+            rows = conn.execute('''
+                SELECT rowid FROM products_fts
+                WHERE products_fts MATCH ?
+                ORDER BY rowid DESC
+                LIMIT ?
+            ''', (expression, self.rank_limit + 1)).fetchall()
+            ranked = len(rows) <= self.rank_limit
+            if ranked:
+                rows = conn.execute('''
+                    SELECT rowid FROM products_fts
+                    WHERE products_fts MATCH ?
+                    ORDER BY rank
+                    LIMIT ?
+                ''', (expression, self.max_results)).fetchall()
+        
+        rows = rows[:self.max_results]
+        complete = len(rows) < self.max_results
+        
+        # Inativos ficam de fora pelo catálogo em memória (só contém produtos ativos)
+        ids = [row[0] for row in rows if self.db.get_product_by_id(row[0]) is not None]
+        
+        with self._lock:
+            self._fts_queries += 1
+            self._unranked += not ranked
+        self.cache.put(key, (ids, complete))
+        return ids
+    
+    def _from_prefix(self, version: int, tokens: List[str]):
+        """Filtra o resultado completo de uma consulta mais curta já em cache (None se não houver)"""
+        text = ' '.join(tokens)
+        for end in range(len(text) - 1, 0, -1):
+            shorter = tokenize(text[:end])
+            if not shorter or shorter == tokens:
+                continue
+            cached = self.cache.get((version, tuple(shorter)))
+            if cached is None or not cached[1]:
+                continue
+            
+            result = []
+            for product_id in cached[0]:
+                product = self.db.get_product_by_id(product_id)
+                if product is not None and matches(tokens, product):
+                    result.append(product_id)
+            return result
+        return None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna contadores de consultas, acertos de cache e latência"""
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = {
+                'queries': self._queries,
+                'prefix_hits': self._prefix_hits,
+                'fts_queries': self._fts_queries,
+                'unranked_queries': self._unranked
+            }
+        stats['cache'] = self.cache.get_stats()
+        stats['latency'] = percentiles(latencies)
+        return stats
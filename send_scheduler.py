@@ -0,0 +1,338 @@
+import os
+import time
+import heapq
+import atexit
+import asyncio
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Any, Optional
+
+from dispatcher import percentiles
+
+logger = logging.getLogger(__name__)
+
+# Prioridades (menor = mais urgente): pagamentos passam na frente de tudo
+PRIORITY_PAYMENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_PAYMENT: 'payment',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_BULK: 'bulk'
+}
+
+
+def retry_after_of(error: Exception) -> Optional[float]:
+    """Segundos pedidos pelo Telegram num erro 429 (None para qualquer outro erro)"""
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return float(parameters.get('retry_after', 1))
+
+
+def file_positions(args, kwargs) -> list:
+    """(arquivo, posição) dos argumentos que são arquivos abertos: um reenvio precisa voltar ao início"""
+    return [(value, value.tell()) for value in (*args, *kwargs.values())
+            if hasattr(value, 'read') and hasattr(value, 'seek') and value.seekable()]
+
+
+class TokenBucket:
+    """Balde de fichas: `rate` envios por segundo com rajadas de até `capacity`"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+    
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+    
+    def wait_time(self, now: float) -> float:
+        """Segundos até haver uma ficha disponível (0 = pode enviar agora)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    def block(self, now: float, seconds: float):
+        """Suspende o balde (ex.: retry_after de um 429)"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+
+class _Ticket:
+    __slots__ = ('chat_id', 'priority', 'enqueued_at', 'future')
+    
+    def __init__(self, chat_id, priority):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.future = Future()
+
+
+class SendScheduler:
+    """Libera envios para a Bot API respeitando o limite global, o limite por chat e a prioridade"""
+    
+    def __init__(self, global_rate: float = None, chat_rate: float = None, chat_burst: float = None,
+                 group_rate_per_min: float = None, max_retries: int = None):
+        self.global_rate = global_rate or float(os.getenv('BOT_SEND_RATE', 30))
+        self.chat_rate = chat_rate or float(os.getenv('BOT_CHAT_RATE', 1))
+        self.chat_burst = chat_burst or float(os.getenv('BOT_CHAT_BURST', 3))
+        self.group_rate = (group_rate_per_min or float(os.getenv('BOT_GROUP_RATE_PER_MIN', 20))) / 60
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('BOT_SEND_RETRIES', 3))
+        
+        now = time.monotonic()
+        self._global = TokenBucket(self.global_rate, self.global_rate, now)
+        self._chats: Dict[int, TokenBucket] = {}
+        
+        # Fila de prontos (prioridade, ordem) e fila de adiados (horário, ordem)
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        
+        # Contadores expostos em get_stats()
+        self._granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._wait_times = {priority: deque(maxlen=2048) for priority in PRIORITY_NAMES}
+        self._chat_throttled = 0
+        self._global_throttled = 0
+        self._retries = 0
+        self._gave_up = 0
+        
+        self._thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Grupos e canais (IDs negativos) têm limite por minuto bem menor
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > 10000:
+                self._prune(now)
+        return bucket
+    
+    def _prune(self, now: float):
+        """Descarta baldes de chats ociosos (cheios e sem bloqueio)"""
+        for chat_id, bucket in list(self._chats.items()):
+            if bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+    
+    def acquire(self, chat_id: Optional[int], priority: int = PRIORITY_INTERACTIVE) -> Future:
+        """Pede vez para um envio; o Future resolve (com a espera em segundos) quando puder enviar"""
+        ticket = _Ticket(chat_id, priority)
+        with self._cond:
+            if self._closed:
+                ticket.future.set_result(0.0)
+                return ticket.future
+            heapq.heappush(self._ready, (priority, next(self._seq), ticket))
+            self._cond.notify()
+        return ticket.future
+    
+    def penalize(self, chat_id: Optional[int], retry_after: float):
+        """Aplica o retry_after de um 429 ao chat (ou ao limite global, sem chat)"""
+        with self._cond:
+            now = time.monotonic()
+            bucket = self._global if chat_id is None else self._chat_bucket(chat_id, now)
+            bucket.block(now, retry_after)
+            self._retries += 1
+        logger.warning(f"429 da Bot API para o chat {chat_id}: aguardando {retry_after}s")
+    
+    def _run(self):
+        """Loop do escalonador: libera o ticket mais prioritário cujo chat e limite global permitem"""
+        while True:
+            with self._cond:
+                ticket = self._next_ticket()
+                if ticket is None:
+                    return
+            
+            waited = time.monotonic() - ticket.enqueued_at
+            self._wait_times[ticket.priority].append(waited)
+            ticket.future.set_result(waited)
+    
+    def _next_ticket(self) -> Optional[_Ticket]:
+        """Retira o próximo ticket liberado (chamado com o lock); None ao fechar"""
+        while True:
+            if self._closed:
+                return None
+            
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, ticket = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (ticket.priority, seq, ticket))
+            
+            if not self._ready:
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+            
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                self._global_throttled += 1
+                self._cond.wait(wait)
+                continue
+            
+            _, seq, ticket = heapq.heappop(self._ready)
+            if ticket.chat_id is not None:
+                bucket = self._chat_bucket(ticket.chat_id, now)
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    # Chat no limite: adia só este envio, os outros chats seguem
+                    self._chat_throttled += 1
+                    heapq.heappush(self._delayed, (now + wait, seq, ticket))
+                    continue
+                bucket.take()
+            
+            self._global.take()
+            self._granted[ticket.priority] += 1
+            return ticket
+    
+    def call(self, chat_id: Optional[int], func, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        """Executa func(*args, **kwargs) na vez do chat, repetindo após 429"""
+        files = file_positions(args, kwargs)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(chat_id, priority).result()
+            for file, position in files:
+                file.seek(position)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                retry_after = retry_after_of(e)
+                if retry_after is None or attempt == self.max_retries:
+                    if retry_after is not None:
+                        self._gave_up += 1
+                    raise
+                self.penalize(chat_id, retry_after)
+    
+    async def acall(self, chat_id: Optional[int], func, *args, priority: int = PRIORITY_INTERACTIVE,
+                    **kwargs):
+        """Versão assíncrona de call(): aguarda a vez sem bloquear o event loop"""
+        files = file_positions(args, kwargs)
+        for attempt in range(self.max_retries + 1):
+            await asyncio.wrap_future(self.acquire(chat_id, priority))
+            for file, position in files:
+                file.seek(position)
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                retry_after = retry_after_of(e)
+                if retry_after is None or attempt == self.max_retries:
+                    if retry_after is not None:
+                        self._gave_up += 1
+                    raise
+                self.penalize(chat_id, retry_after)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna filas, liberações por prioridade, esperas e contadores de limitação"""
+        with self._cond:
+            waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+            for _, _, ticket in self._ready + self._delayed:
+                waiting[PRIORITY_NAMES[ticket.priority]] += 1
+            stats = {
+                'global_rate': self.global_rate,
+                'chat_rate': self.chat_rate,
+                'waiting': waiting,
+                'delayed': len(self._delayed),
+                'tracked_chats': len(self._chats),
+                'chat_throttled': self._chat_throttled,
+                'global_throttled': self._global_throttled,
+                'retries_429': self._retries,
+                'gave_up_429': self._gave_up
+            }
+            lanes = {
+                PRIORITY_NAMES[priority]: (self._granted[priority], list(self._wait_times[priority]))
+                for priority in PRIORITY_NAMES
+            }
+        
+        stats['lanes'] = {
+            name: {'granted': granted, 'queue_wait': percentiles(waits)}
+            for name, (granted, waits) in lanes.items()
+        }
+        return stats
+    
+    def close(self):
+        """Libera os tickets pendentes e encerra a thread do escalonador"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            pending = [ticket for _, _, ticket in self._ready + self._delayed]
+            self._ready.clear()
+            self._delayed.clear()
+            self._cond.notify_all()
+        for ticket in pending:
+            ticket.future.set_result(0.0)
+
+
+class ScheduledBot:
+    """Envolve um TeleBot/AsyncTeleBot: os métodos de envio passam pelo SendScheduler"""
+    
+    # Método -> posição do chat_id nos argumentos posicionais
+    CHAT_ARGUMENT = {
+        'send_message': 0,
+        'send_photo': 0,
+        'send_video': 0,
+        'send_document': 0,
+        'send_invoice': 0,
+        'copy_message': 0,
+        'forward_message': 0,
+        'edit_message_text': 1,
+        'edit_message_caption': 1,
+        'edit_message_reply_markup': 0,
+        'delete_message': 0
+    }
+    
+    def __init__(self, bot, scheduler: Optional[SendScheduler]):
+        self._bot = bot
+        self.scheduler = scheduler
+    
+    def __getattr__(self, name):
+        attr = getattr(self._bot, name)
+        position = self.CHAT_ARGUMENT.get(name)
+        if position is None:
+            return attr
+        
+        scheduler = self.scheduler
+        if scheduler is None:
+            # Escalonador desligado: só descarta o argumento de prioridade
+            if asyncio.iscoroutinefunction(attr):
+                async def direct(*args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+                    return await attr(*args, **kwargs)
+            else:
+                def direct(*args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+                    return attr(*args, **kwargs)
+            return direct
+        
+        def chat_of(args, kwargs):
+            if 'chat_id' in kwargs:
+                return kwargs['chat_id']
+            return args[position] if len(args) > position else None
+        
+        if asyncio.iscoroutinefunction(attr):
+            async def scheduled(*args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+                return await scheduler.acall(chat_of(args, kwargs), attr, *args, priority=priority, **kwargs)
+        else:
+            def scheduled(*args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+                return scheduler.call(chat_of(args, kwargs), attr, *args, priority=priority, **kwargs)
+        return scheduled
+
+
+def scheduled_bot(bot):
+    """Coloca o bot atrás de um SendScheduler (desligável com BOT_SEND_SCHEDULER=false)"""
+    enabled = os.getenv('BOT_SEND_SCHEDULER', 'true').lower() == 'true'
+    return ScheduledBot(bot, SendScheduler() if enabled else None)
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from database import DatabaseManager
+from payment_processor import PaymentProcessor
+from reconciliation import StarReconciler
+
+
+class FakeBotApi:
+    """Servidor HTTP local que responde getStarTransactions com um histórico fixo"""
+    
+    def __init__(self, transactions):
+        self.transactions = transactions
+        self.calls = []
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                params = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+                method = self.path.rsplit('/', 1)[-1]
+                fake.calls.append((method, params))
+                if method == 'getStarTransactions':
+                    offset = params.get('offset', 0)
+                    result = {'transactions': fake.transactions[offset:offset + params.get('limit', 100)]}
+                else:
+                    result = True
+                body = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def star_transaction(charge_id: str, telegram_user_id: int, payload: str, amount: int = 10) -> dict:
+    return {
+        'id': charge_id,
+        'amount': amount,
+        'date': int(time.time()) - 3600,
+        'source': {
+            'type': 'user',
+            'user': {'id': telegram_user_id, 'is_bot': False, 'first_name': 'Teste'},
+            'invoice_payload': payload
+        }
+    }
+
+
+class StarReconcilerTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DatabaseManager(os.path.join(self.directory, 'bot.db'))
+        with self.db.connection() as conn:
+            conn.execute("INSERT INTO products (name, price_stars, file_path) VALUES ('Vídeo', 10, '/x')")
+        self.db.invalidate_catalog()
+        self.payments = PaymentProcessor(self.db, '123:abc')
+        self.user_id = self.db.get_or_create_user_id(1000)
+    
+    def tearDown(self):
+        self.api.close()
+        self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+    
+    def transaction(self, transaction_id: int) -> dict:
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT * FROM transactions WHERE id = ?", (transaction_id,)).fetchone()
+            downloads = conn.execute(
+                "SELECT COUNT(*) FROM downloads WHERE transaction_id = ?", (transaction_id,)
+            ).fetchone()[0]
+        return dict(row, downloads=downloads)
+    
+    def test_repairs_error_row_with_charge_id(self):
+        # ch1: entregue normalmente; ch2: falhou depois da cobrança e ficou 'error' com o id gravado
+        completed = self.db.create_transaction(self.user_id, 1, 10)
+        self.db.complete_payment(completed, 'ch1', 'token-ch1')
+        failed = self.db.create_transaction(self.user_id, 1, 10)
+        self.db.update_transaction_payment(failed, 'ch2', status='error')
+        
+        self.api = FakeBotApi([
+            star_transaction('ch1', 1000, str(completed)),
+            star_transaction('ch2', 1000, str(failed)),
+        ])
+        report = StarReconciler(self.payments, api_url=self.api.url).run()
+        
+        self.assertEqual(report['matched'], 1)
+        self.assertEqual(report['repaired'], 1)
+        self.assertEqual(report['cursor'], 2)
+        self.assertEqual(self.transaction(failed)['status'], 'completed')
+        self.assertEqual(self.transaction(failed)['downloads'], 1)
+        self.assertEqual(self.transaction(completed)['downloads'], 1)
+    
+    def test_repairs_pending_transaction_and_notifies(self):
+        pending = self.db.create_transaction(self.user_id, 1, 10)
+        self.api = FakeBotApi([star_transaction('ch3', 1000, str(pending))])
+        reconciler = StarReconciler(self.payments, api_url=self.api.url)
+        
+        report = reconciler.run(notify=reconciler.send_confirmation)
+        
+        self.assertEqual(report['repaired'], 1)
+        self.assertEqual(self.transaction(pending)['status'], 'completed')
+        sent = [params for method, params in self.api.calls if method == 'sendMessage']
+        self.assertEqual([params['chat_id'] for params in sent], [1000])
+        
+        # Uma nova execução começa do cursor gravado e não repara de novo
+        self.assertEqual(reconciler.run()['repaired'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from database import DatabaseManager
+from payment_processor import PaymentProcessor
+
+
+class RefundPaymentTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = DatabaseManager(os.path.join(self.directory, 'bot.db'))
+        with self.db.connection() as conn:
+            conn.execute("INSERT INTO products (name, price_stars, file_path) VALUES ('Vídeo', 10, '/x')")
+        self.db.invalidate_catalog()
+        self.payments = PaymentProcessor(self.db, '123:abc')
+        
+        user_id = self.db.get_or_create_user_id(1000)
+        self.transaction_id = self.db.create_transaction(user_id, 1, 10)
+        self.db.complete_payment(self.transaction_id, 'ch1', 'token-ch1')
+    
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+    
+    @mock.patch('refunds.call_bot_api', return_value=True)
+    def test_refund_marks_transaction_and_revokes_token(self, call_bot_api):
+        self.assertTrue(self.payments.refund_payment('ch1', reason='teste'))
+        
+        call_bot_api.assert_called_once()
+        method, params = call_bot_api.call_args.args[3:5]
+        self.assertEqual(method, 'refundStarPayment')
+        self.assertEqual(params, {'user_id': 1000, 'telegram_payment_charge_id': 'ch1'})
+        
+        with self.db.connection() as conn:
+            status = conn.execute(
+                "SELECT status FROM transactions WHERE id = ?", (self.transaction_id,)
+            ).fetchone()[0]
+            download = conn.execute(
+                "SELECT expires_at, max_downloads, download_count FROM downloads WHERE download_token = ?",
+                ('token-ch1',)
+            ).fetchone()
+            items = conn.execute("SELECT status FROM refund_items").fetchall()
+        
+        self.assertEqual(status, 'refunded')
+        self.assertEqual(download['max_downloads'], download['download_count'])
+        self.assertLessEqual(datetime.fromisoformat(str(download['expires_at'])), datetime.now())
+        self.assertEqual([row[0] for row in items], ['refunded'])
+    
+    @mock.patch('refunds.call_bot_api', return_value=True)
+    def test_refund_of_refunded_payment_is_refused(self, call_bot_api):
+        self.assertTrue(self.payments.refund_payment('ch1'))
+        self.assertFalse(self.payments.refund_payment('ch1'))
+        self.assertEqual(call_bot_api.call_count, 1)
+    
+    @mock.patch('refunds.call_bot_api', return_value=True)
+    def test_unknown_payment_is_not_refunded(self, call_bot_api):
+        self.assertFalse(self.payments.refund_payment('desconhecido'))
+        call_bot_api.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()